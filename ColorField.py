@@ -0,0 +1,92 @@
+import numpy as np
+from PyQt5.QtCore import QPointF, QRect, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter, QPen
+from PyQt5.QtWidgets import QWidget
+
+HUE_MAXIMUM = 360
+VALUE_MAXIMUM = 255
+CURSOR_RADIUS = 6
+
+
+def hsv_to_rgb(hue, saturation, value):
+    # QColor.setHsv と同じ範囲（hue: 0-359, saturation/value: 0-255）の配列を (..., 3) の uint8 にまとめて変換する
+    hue = np.mod(np.asarray(hue, dtype=float), 360.0) / 60.0
+    saturation = np.asarray(saturation, dtype=float) / 255.0
+    value = np.asarray(value, dtype=float) / 255.0
+    hue, saturation, value = np.broadcast_arrays(hue, saturation, value)
+
+    chroma = value * saturation
+    second = chroma * (1.0 - np.abs(np.mod(hue, 2.0) - 1.0))
+    zero = np.zeros_like(chroma)
+    sector = np.minimum(hue.astype(int), 5)
+    red = np.choose(sector, [chroma, second, zero, zero, second, chroma])
+    green = np.choose(sector, [second, chroma, chroma, second, zero, zero])
+    blue = np.choose(sector, [zero, zero, second, chroma, chroma, second])
+    minimum = value - chroma
+    rgb = np.stack([red + minimum, green + minimum, blue + minimum], axis=-1)
+    return np.rint(rgb * 255.0).astype(np.uint8)
+
+
+def render_hue_value_field(width: int, height: int, saturation=255) -> QImage:
+    # 横が色相（左から 0-359）、縦が明度（上が 255）の平面を1枚の画像にする
+    hue = (np.arange(width) + 0.5) * HUE_MAXIMUM / width
+    value = (1.0 - np.arange(height) / max(1, height - 1)) * VALUE_MAXIMUM
+    rgb = hsv_to_rgb(hue[np.newaxis, :], saturation, value[:, np.newaxis]).astype(np.uint32)
+    pixels = np.ascontiguousarray(0xff000000 | (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2])
+    # QImage は配列のメモリを参照するだけなので、copy して持たせる
+    return QImage(pixels.data, width, height, width * 4, QImage.Format_RGB32).copy()
+
+
+class ColorFieldWidget(QWidget):
+    # 色相×明度の平面は大きさが変わった時だけ作り直し、膝の値ごとにはカーソルだけを描き直す
+    def __init__(self, saturation=255, parent=None):
+        super().__init__(parent)
+        self.saturation = saturation
+        self.field_image = QImage()
+        self.cursor_hue = 0
+        self.cursor_value = 0
+        self.is_fixed = False  # Shift で色を決めている間はカーソルの色を変える
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+
+    def map_to_widget(self, hue, value) -> QPointF:
+        return QPointF(hue * self.width() / HUE_MAXIMUM, (1.0 - value / VALUE_MAXIMUM) * (self.height() - 1))
+
+    def get_cursor_rect(self) -> QRect:
+        center = self.map_to_widget(self.cursor_hue, self.cursor_value).toPoint()
+        margin = CURSOR_RADIUS + 2
+        return QRect(center.x() - margin, center.y() - margin, margin * 2 + 1, margin * 2 + 1)
+
+    def set_cursor(self, hue, value):
+        if (hue, value) == (self.cursor_hue, self.cursor_value):
+            return
+        self.update(self.get_cursor_rect())
+        self.cursor_hue = hue
+        self.cursor_value = value
+        self.update(self.get_cursor_rect())
+
+    def set_fixed(self, is_fixed: bool):
+        if is_fixed != self.is_fixed:
+            self.is_fixed = is_fixed
+            self.update(self.get_cursor_rect())
+
+    def get_color(self) -> QColor:
+        color = QColor()
+        color.setHsv(int(self.cursor_hue) % HUE_MAXIMUM, self.saturation, int(self.cursor_value), 255)
+        return color
+
+    def resizeEvent(self, event):
+        self.field_image = QImage()  # 次に描く時に今の大きさで作り直す
+
+    def paintEvent(self, event):
+        if self.field_image.size() != self.size():
+            self.field_image = render_hue_value_field(self.width(), self.height(), self.saturation)
+        painter = QPainter(self)
+        painter.drawImage(event.rect(), self.field_image, event.rect())
+
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setBrush(Qt.NoBrush)
+        center = self.map_to_widget(self.cursor_hue, self.cursor_value)
+        painter.setPen(QPen(Qt.black, 3))
+        painter.drawEllipse(center, CURSOR_RADIUS, CURSOR_RADIUS)
+        painter.setPen(QPen(QColor(255, 160, 0) if self.is_fixed else Qt.white, 1.5))
+        painter.drawEllipse(center, CURSOR_RADIUS, CURSOR_RADIUS)
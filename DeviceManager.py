@@ -0,0 +1,111 @@
+import re
+import threading
+import time
+
+import serial
+from serial.tools import list_ports
+
+import SensorProtocol
+
+BAUD_RATE = 460800
+PREFERRED_PORTS = ['/dev/cu.usbmodem142201']  # 実験で使っていたポートは最初に試す
+CANDIDATE_PORT_PATTERN = re.compile(r"usbmodem|usbserial|ttyACM|ttyUSB|^COM\d+", re.IGNORECASE)
+PROBE_TIMEOUT = 2.0  # 1ポートあたりの確認時間[s]（開くとリセットされるマイコンがあるため長めにとる）
+PROBE_LINES = 3  # この数だけ続けて正しいフレームが読めたらセンサとみなす
+READ_TIMEOUT = 1.0  # 接続後にこの時間データが来なければ切断とみなす
+SCAN_INTERVAL = 2.0
+REJECT_BACKOFF = 5.0  # センサでなかったポートをもう一度確認するまでの時間[s]（起動の遅いセンサのため、失敗のたびに倍にする）
+REJECT_BACKOFF_MAXIMUM = 60.0
+
+
+class DeviceManager():
+    def __init__(self, num_of_values, baud_rate=BAUD_RATE, preferred_ports=PREFERRED_PORTS,
+                 probe_timeout=PROBE_TIMEOUT, framing=SensorProtocol.FramingMode.TEXT):
+        self.num_of_values = num_of_values
+        self.framing = framing
+        self.baud_rate = baud_rate
+        self.preferred_ports = preferred_ports
+        self.probe_timeout = probe_timeout
+
+        # センサではなかったポート -> (もう一度確認する時刻[time.monotonic], 続けて失敗した回数)
+        # 時間が経つか、抜き差しされたら再度確認する
+        self.rejected_ports = {}
+
+        # 複数のセンサを使う時に、接続済みのポートを他のスレッドが開かないようにする
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def list_candidate_ports(self, port=None):
+        # port（ポート名かシリアル番号）を指定した時は、そのポートだけを候補にする
+        ports = {}
+        for port_info in list_ports.comports():
+            if port_info.vid is not None or CANDIDATE_PORT_PATTERN.search(port_info.device):
+                ports[port_info.device] = (port_info.device, port_info.serial_number)
+
+        # 無くなったポートは次に現れた時に確認し直す
+        now = time.monotonic()
+        port_ids = set(ports.values())
+        self.rejected_ports = {port_id: rejection for port_id, rejection in self.rejected_ports.items()
+                               if port_id in port_ids}
+
+        candidates = [device for device in self.preferred_ports if device in ports]
+        candidates += sorted(device for device in ports if device not in candidates)
+        self.connections = [connection for connection in self.connections if connection.is_open]
+        connected_ports = set(connection.port for connection in self.connections)
+        candidates = [device for device in candidates
+                      if self.rejected_ports.get(ports[device], (now, 0))[0] <= now and device not in connected_ports]
+        if port is not None:
+            candidates = [device for device in candidates if port in ports[device]]
+        return candidates, ports
+
+    def probe(self, connection: serial.Serial):
+        deadline = time.monotonic() + self.probe_timeout
+        frame_parser = SensorProtocol.SensorFrameParser(self.num_of_values, self.framing)  # 途中から読み始めた行は捨てる
+        valid_frames = 0
+        try:
+            while time.monotonic() < deadline:
+                num_of_malformed_frames = frame_parser.num_of_malformed_frames
+                frames = frame_parser.feed(connection.read(max(1, connection.in_waiting)))
+                if frame_parser.num_of_malformed_frames > num_of_malformed_frames:
+                    valid_frames = 0
+                valid_frames += len(frames)
+                if valid_frames >= PROBE_LINES:
+                    connection.timeout = READ_TIMEOUT
+                    return connection
+        except (serial.SerialException, OSError):
+            pass
+
+        connection.close()
+        return None
+
+    def connect(self, is_interrupted=lambda: False, port=None):
+        # センサが見つかるまでポートを探し続ける（見つかる前に中断されたら None を返す）
+        while not is_interrupted():
+            with self.lock:
+                connection = self.find_device(is_interrupted, port)
+            if connection is not None:
+                return connection
+
+            deadline = time.monotonic() + SCAN_INTERVAL
+            while time.monotonic() < deadline and not is_interrupted():
+                time.sleep(0.1)
+        return None
+
+    def find_device(self, is_interrupted, port=None):
+        candidates, ports = self.list_candidate_ports(port)
+        for device in candidates:
+            if is_interrupted():
+                return None
+            try:
+                connection = serial.Serial(device, self.baud_rate, timeout=self.probe_timeout)
+            except (serial.SerialException, OSError):
+                continue  # 他のアプリが使用中など。次の探索でもう一度試す
+
+            if self.probe(connection) is not None:
+                self.rejected_ports.pop(ports[device], None)
+                self.connections.append(connection)
+                return connection
+            _, num_of_rejections = self.rejected_ports.get(ports[device], (0.0, 0))
+            backoff = min(REJECT_BACKOFF * 2 ** num_of_rejections, REJECT_BACKOFF_MAXIMUM)
+            self.rejected_ports[ports[device]] = (time.monotonic() + backoff, num_of_rejections + 1)
+        return None
@@ -0,0 +1,129 @@
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QRect, QSize, QTimer, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader, QPainter
+
+BAND_HEIGHT = 1024  # 大きな画像を分割して読み込む時の1回の高さ[px]
+CACHE_SIZE = 8  # 変換済みの画像を残しておく数
+
+
+def read_scaled_image(file_path: str, target_size: QSize):
+    reader = QImageReader(file_path)
+    reader.setAutoTransform(True)
+    source_size = reader.size()
+    if not source_size.isValid():
+        return QImage()
+
+    if reader.supportsOption(QImageIOHandler.ScaledSize):
+        # デコーダが縮小しながら読める（JPEG など）
+        reader.setScaledSize(target_size)
+        image = reader.read()
+
+    elif reader.supportsOption(QImageIOHandler.ClipRect) and source_size.height() > BAND_HEIGHT:
+        # 帯状に切り出して読み、縮小しながら貼り合わせる（元の解像度の画像全体をメモリに置かない）
+        image = QImage(target_size, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        scale_y = target_size.height() / source_size.height()
+        for top in range(0, source_size.height(), BAND_HEIGHT):
+            band_reader = QImageReader(file_path)
+            band = QRect(0, top, source_size.width(), min(BAND_HEIGHT, source_size.height() - top))
+            band_reader.setClipRect(band)
+            target_top = round(top * scale_y)
+            target_bottom = round((top + band.height()) * scale_y)
+            if target_bottom > target_top:
+                band_reader.setScaledSize(QSize(target_size.width(), target_bottom - target_top))
+                painter.drawImage(0, target_top, band_reader.read())
+        painter.end()
+
+    else:
+        image = reader.read()
+        if not image.isNull():
+            image = image.scaled(target_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+    return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+
+class ImageLoadTask(QRunnable):
+    def __init__(self, loader, request_id, file_path, target_size, device_pixel_ratio):
+        super().__init__()
+        self.loader = loader
+        self.request_id = request_id
+        self.file_path = file_path
+        self.target_size = target_size
+        self.device_pixel_ratio = device_pixel_ratio
+
+    def run(self):
+        # QImage は GUI スレッド以外でも扱える（QPixmap への変換は GUI スレッドで行う）
+        size = QSize(round(self.target_size.width() * self.device_pixel_ratio),
+                     round(self.target_size.height() * self.device_pixel_ratio))
+        image = read_scaled_image(self.file_path, size)
+        image.setDevicePixelRatio(self.device_pixel_ratio)
+        self.loader.imageDecodedSignal.emit(self.request_id, self.file_path, image)
+
+
+class ImageLoader(QObject):
+    imageLoadedSignal = pyqtSignal(int, QImage)
+    imageDecodedSignal = pyqtSignal(int, str, QImage)  # ワーカスレッドから GUI スレッドへ渡すため
+
+    def __init__(self, budget=None, parent=None):
+        super().__init__(parent)
+        self.budget = budget  # MemoryBudget（変換済みの画像はファイルから作り直せるので、足りなければ捨てる）
+        self.thread_pool = QThreadPool()
+        self.thread_pool.setMaxThreadCount(1)
+        self.cache = OrderedDict()
+        self.pending_keys = {}
+        self.next_request_id = 0
+        self.imageDecodedSignal.connect(self.image_decoded)
+
+    def get_cache_key(self, file_path, target_size, device_pixel_ratio):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return file_path, stat.st_mtime_ns, stat.st_size, target_size.width(), target_size.height(), device_pixel_ratio
+
+    def load(self, file_path: str, target_size: QSize, device_pixel_ratio=1.0):
+        # 読み込みの番号を返し、読み込めたら imageLoadedSignal で知らせる
+        request_id = self.next_request_id
+        self.next_request_id += 1
+
+        key = self.get_cache_key(file_path, target_size, device_pixel_ratio)
+        if key is not None and key in self.cache:
+            self.cache.move_to_end(key)
+            if self.budget is not None:
+                self.budget.touch(self, key)
+            # 呼び出し側が番号を受け取って登録してから知らせる（キャッシュに無い時と同じく後で届く）
+            image = self.cache[key]
+            QTimer.singleShot(0, lambda: self.imageLoadedSignal.emit(request_id, image))
+            return request_id
+
+        self.pending_keys[request_id] = key
+        self.thread_pool.start(ImageLoadTask(self, request_id, file_path, target_size, device_pixel_ratio))
+        return request_id
+
+    def image_decoded(self, request_id, file_path, image):
+        key = self.pending_keys.pop(request_id, None)
+        if key is not None and not image.isNull():
+            self.cache[key] = image
+            while len(self.cache) > CACHE_SIZE:
+                old_key, _ = self.cache.popitem(last=False)
+                if self.budget is not None:
+                    self.budget.discard(self, old_key)
+            if self.budget is not None:
+                self.budget.add(self, key, image.sizeInBytes())
+        self.imageLoadedSignal.emit(request_id, image)
+
+    def evict(self, key):
+        self.cache.pop(key, None)
+
+    def get_memory_usage(self) -> int:
+        return sum(image.sizeInBytes() for image in self.cache.values())
+
+    def clear_cache(self):
+        if self.budget is not None:
+            for key in self.cache:
+                self.budget.discard(self, key)
+        self.cache.clear()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PyQt5.QtCore import QEvent, QPoint, QPointF, Qt
+from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
+from PyQt5.QtWidgets import QApplication
+
+import Timing
+
+# 1行に1つの入力を JSON で書く
+#   type: mouse（Canvas へのマウス）, key（MainWindow へのキー）, wheel, knee（control_params_with_knee）,
+#         knee_gesture（knee_gesture_detected）, knee_enabled（キャリブレーション完了）, ui（ボタンや表の操作）, slider, picture, action
+#   t: 記録開始からの時間[ns]（Timing.now_ns）
+#   clock: その入力を処理する間に ExperimentController が使う時刻[ns]（Timing.now_ns）
+#   start には記録開始時の通し番号（Timing.get_sequence）も書き、再生ではそこから番号を振り直す
+MOUSE_EVENT_TYPES = {"press": QEvent.MouseButtonPress, "move": QEvent.MouseMove, "release": QEvent.MouseButtonRelease}
+
+
+def get_session_digest(window):
+    # 線のデータと計測の記録が同じかを比べるためのハッシュ
+    digest = hashlib.sha1()
+    for canvas in window.canvas:
+        for path, color, pen_width in canvas.iter_strokes():
+            elements = [(path.elementAt(i).x, path.elementAt(i).y) for i in range(path.elementCount())]
+            digest.update(np.array(elements, dtype=float).tobytes())
+            digest.update(np.array([color.rgba(), pen_width], dtype=np.int64).tobytes())
+        digest.update(b"|")
+    digest.update(np.ascontiguousarray(window.experiment_controller.frame_records, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+class InputRecorder():
+    def __init__(self, file_path: str, window):
+        self.file_path = file_path
+        self.file = open(file_path, "w", encoding="utf-8")
+        self.start_ns = Timing.now_ns()
+        self.current_time = self.start_ns
+        self.record("start", digest=get_session_digest(window), sequence=Timing.get_sequence())
+
+    def get_time(self):
+        return self.current_time
+
+    def record(self, kind: str, **data):
+        # 入力ごとに時刻を1回だけ読み、その入力の処理中は同じ時刻を使う（再生で同じ値にするため）
+        self.current_time = Timing.now_ns()
+        data["type"] = kind
+        data["t"] = self.current_time - self.start_ns
+        data["clock"] = self.current_time
+        self.file.write(json.dumps(data, separators=(',', ':')) + "\n")
+
+    def record_mouse(self, layer: int, event_name: str, event):
+        self.record("mouse", layer=layer, event=event_name, x=event.localPos().x(), y=event.localPos().y(),
+                    button=int(event.button()), buttons=int(event.buttons()), modifiers=int(event.modifiers()))
+
+    def record_key(self, event_name: str, event):
+        self.record("key", event=event_name, key=event.key(), modifiers=int(event.modifiers()), text=event.text(),
+                    auto_repeat=event.isAutoRepeat())
+
+    def record_wheel(self, event):
+        self.record("wheel", x=event.posF().x(), y=event.posF().y(), angle_x=event.angleDelta().x(),
+                    angle_y=event.angleDelta().y(), modifiers=int(event.modifiers()))
+
+    def close(self, window):
+        self.record("end", digest=get_session_digest(window))
+        self.file.close()
+
+
+def read_input_record(file_path: str):
+    with open(file_path, encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class InputPlayer():
+    # 記録した入力を同じ入口（イベントハンドラやスロット）に順に渡す
+    def __init__(self, window, is_real_time=False, is_saving=False):
+        self.window = window
+        self.is_real_time = is_real_time
+        self.is_saving = is_saving  # 計測結果の保存も再生する
+        self.current_time = Timing.now_ns()
+        self.processing_times = {}  # 種類 -> 処理時間[s] のリスト
+        self.start_digest = None
+        self.end_digest = None
+
+    def get_time(self):
+        return self.current_time
+
+    def play(self, file_path: str):
+        app = QApplication.instance()
+        self.window.experiment_controller.clock = self.get_time
+        start_ns = Timing.now_ns()
+        for record in read_input_record(file_path):
+            if record["type"] == "start":
+                self.start_digest = record["digest"]
+                Timing.set_sequence(record["sequence"])
+                continue
+            if record["type"] == "end":
+                self.end_digest = record["digest"]
+                continue
+
+            if self.is_real_time:
+                while Timing.now_ns() - start_ns < record["t"]:
+                    app.processEvents()
+            self.current_time = record["clock"]
+
+            # 処理時間には、その入力で必要になった再描画も含める
+            begin = time.perf_counter()
+            self.dispatch(record)
+            app.processEvents()
+            self.processing_times.setdefault(record["type"], []).append(time.perf_counter() - begin)
+        self.window.experiment_controller.clock = Timing.now_ns
+
+    def dispatch(self, record):
+        window = self.window
+        kind = record["type"]
+        if kind == "mouse":
+            canvas = window.canvas[record["layer"]]
+            event = QMouseEvent(MOUSE_EVENT_TYPES[record["event"]], QPointF(record["x"], record["y"]),
+                                Qt.MouseButton(record["button"]), Qt.MouseButtons(record["buttons"]),
+                                Qt.KeyboardModifiers(record["modifiers"]))
+            if record["event"] == "press":
+                canvas.mousePressEvent(event)
+            elif record["event"] == "move":
+                canvas.mouseMoveEvent(event)
+            else:
+                canvas.mouseReleaseEvent(event)
+        elif kind == "key":
+            event = QKeyEvent(QEvent.KeyPress if record["event"] == "press" else QEvent.KeyRelease, record["key"],
+                              Qt.KeyboardModifiers(record["modifiers"]), record["text"], record["auto_repeat"])
+            if record["event"] == "press":
+                window.keyPressEvent(event)
+            else:
+                window.keyReleaseEvent(event)
+        elif kind == "wheel":
+            position = QPointF(record["x"], record["y"])
+            window.wheelEvent(QWheelEvent(position, window.mapToGlobal(position.toPoint()), QPoint(),
+                                          QPoint(record["angle_x"], record["angle_y"]), Qt.NoButton,
+                                          Qt.KeyboardModifiers(record["modifiers"]), Qt.NoScrollPhase, False))
+        elif kind == "knee":
+            window.control_params_with_knee(record["x"], record["y"], record["timestamp_ns"])
+        elif kind == "knee_gesture":
+            window.knee_gesture_detected(record["gesture"], record["timestamp_ns"], record["latency_ns"])
+        elif kind == "knee_enabled":
+            window.knee_calibration_finished(record["x"], record["y"])
+        elif kind == "ui":
+            if record["slot"] == "table_item_clicked":
+                window.table_item_clicked(window.canvasNameTableModel.index(record["row"], record["column"]))
+            else:
+                getattr(window, record["slot"])()
+        elif kind == "slider":
+            getattr(window, record["name"] + "Slider").setValue(record["value"])
+        elif kind == "picture":
+            window.load_picture_file(record["layer"], record["file_name"])
+        elif kind == "action":
+            if record["name"] == "start_experiment":
+                window.start_experiment()
+            elif record["name"] == "save_picture_and_experiment" and self.is_saving:
+                window.save_picture_and_experiment()
+
+    def get_summary(self):
+        lines = []
+        for kind, times in self.processing_times.items():
+            times = np.array(times) * 1000
+            lines.append("{:>12}: {:6d} events, mean {:.3f} ms, p50 {:.3f} ms, p95 {:.3f} ms, max {:.3f} ms"
+                         .format(kind, len(times), times.mean(), np.percentile(times, 50), np.percentile(times, 95),
+                                 times.max()))
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python InputRecorder.py input_record.jsonl [--real-time] [--save]")
+        sys.exit(1)
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # 画面が無くても再生できるように
+    import paintSoft
+
+    app = QApplication(sys.argv)
+    paintSoft.is_journaling = False  # 再生した操作でジャーナルを作らない・復元しない
+    window = paintSoft.MainWindow()
+    window.timer_thread.stop()  # 膝の値は記録から与える
+
+    player = InputPlayer(window, is_real_time="--real-time" in sys.argv, is_saving="--save" in sys.argv)
+    initial_digest = get_session_digest(window)
+    begin = time.perf_counter()
+    player.play(sys.argv[1])
+    print("replayed in {:.3f} s".format(time.perf_counter() - begin))
+    print(player.get_summary())
+    if player.start_digest != initial_digest:
+        print("warning: the recording did not start from an empty session")
+    print("identical: {}".format(get_session_digest(window) == player.end_digest))
+    window.close()
@@ -0,0 +1,296 @@
+import math
+
+import numpy as np
+
+DEFAULT_RATE = 100.0  # 最初のサンプルなど時間差が取れない時に使うサンプリング周波数[Hz]
+RECURRENCE_BLOCK = 32  # 一括処理で漸化式をまとめて解くサンプル数
+
+
+def smoothing_factor(cutoff, dt):
+    tau = 1.0 / (2 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+def get_time_steps(timestamps, num_of_samples):
+    if timestamps is None:
+        return np.full(num_of_samples, 1.0 / DEFAULT_RATE)
+    dt = np.diff(np.asarray(timestamps, dtype=float), prepend=np.nan)
+    dt[~(dt > 0)] = 1.0 / DEFAULT_RATE
+    return dt
+
+
+def solve_first_order_recurrence(alpha, values, initial):
+    # y[n] = alpha[n] * x[n] + (1 - alpha[n]) * y[n-1] をブロックごとに累積積で解く
+    # alpha: (N,) or (N, C), values: (N, C), initial: (C,)
+    alpha = np.broadcast_to(alpha.reshape(alpha.shape[0], -1), values.shape)
+    result = np.empty_like(values)
+    previous = np.asarray(initial, dtype=float)
+
+    for start in range(0, values.shape[0], RECURRENCE_BLOCK):
+        a = alpha[start:start + RECURRENCE_BLOCK]
+        x = values[start:start + RECURRENCE_BLOCK]
+        decay = np.cumprod(1.0 - a, axis=0)
+
+        if decay.min() < 1e-200:
+            # 減衰が大きすぎると割り算が不安定になるので逐次計算する
+            for i in range(a.shape[0]):
+                previous = a[i] * x[i] + (1.0 - a[i]) * previous
+                result[start + i] = previous
+            continue
+
+        block = decay * (previous + np.cumsum(a * x / decay, axis=0))
+        result[start:start + RECURRENCE_BLOCK] = block
+        previous = block[-1]
+
+    return result
+
+
+def solve_affine_recurrence(transition, offset):
+    # s[n] = transition[n] @ s[n-1] + offset[n] を、写像を倍々に合成して（log2(N) 回の配列演算で）解く
+    # transition: (N, 2, 2)（全チャンネルで共通）, offset: (N, 2, C)
+    # s[n] = transition[n] @ s[-1] + offset[n] となる (transition, offset) を返す
+    transition = transition.copy()
+    offset = offset.copy()
+    step = 1
+    while step < len(transition):
+        offset[step:] += np.einsum('nij,njc->nic', transition[step:], offset[:-step])
+        transition[step:] = np.einsum('nij,njk->nik', transition[step:], transition[:-step])
+        step *= 2
+    return transition, offset
+
+
+class EmaFilter():
+    name = "ema"
+
+    def __init__(self, alpha=0.7):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+
+    def describe(self):
+        return "{} alpha={}".format(self.name, self.alpha)
+
+    def filter(self, value, timestamp=None):
+        value = np.asarray(value, dtype=float)
+        if self.previous is None:
+            # 従来の実装と同じく0から立ち上げる
+            self.previous = np.zeros_like(value)
+        self.previous = (value - self.previous) * self.alpha + self.previous
+        return self.previous
+
+    def filter_batch(self, values, timestamps=None):
+        values = np.asarray(values, dtype=float).reshape(len(values), -1)
+        initial = self.previous if self.previous is not None else np.zeros(values.shape[1])
+        alpha = np.full(values.shape[0], self.alpha)
+        result = solve_first_order_recurrence(alpha, values, initial)
+        if len(result) > 0:
+            self.previous = result[-1].copy()
+        return result
+
+
+class OneEuroFilter():
+    # Casiez et al. の 1€ Filter。速度が小さい時は強く平滑化し、速い時は遅延を減らす
+    # 速度は生の入力の差分から求める（一括処理をベクトル化できるようにするため）
+    name = "one_euro"
+
+    def __init__(self, min_cutoff=1.0, beta=0.3, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self):
+        self.previous_value = None
+        self.previous_filtered = None
+        self.previous_derivative = None
+        self.previous_timestamp = None
+
+    def describe(self):
+        return "{} min_cutoff={} beta={} d_cutoff={}".format(self.name, self.min_cutoff, self.beta, self.d_cutoff)
+
+    def filter(self, value, timestamp=None):
+        value = np.asarray(value, dtype=float)
+        if self.previous_value is None:
+            self.previous_value = value
+            self.previous_filtered = value
+            self.previous_derivative = np.zeros_like(value)
+            self.previous_timestamp = timestamp
+            return value
+
+        dt = 1.0 / DEFAULT_RATE
+        if timestamp is not None and self.previous_timestamp is not None and timestamp > self.previous_timestamp:
+            dt = timestamp - self.previous_timestamp
+
+        derivative = (value - self.previous_value) / dt
+        alpha_d = smoothing_factor(self.d_cutoff, dt)
+        derivative = alpha_d * derivative + (1.0 - alpha_d) * self.previous_derivative
+
+        cutoff = self.min_cutoff + self.beta * np.abs(derivative)
+        alpha = 1.0 / (1.0 + 1.0 / (2 * math.pi * cutoff * dt))
+        filtered = alpha * value + (1.0 - alpha) * self.previous_filtered
+
+        self.previous_value = value
+        self.previous_filtered = filtered
+        self.previous_derivative = derivative
+        self.previous_timestamp = timestamp
+        return filtered
+
+    def filter_batch(self, values, timestamps=None):
+        values = np.asarray(values, dtype=float).reshape(len(values), -1)
+        if len(values) == 0:
+            return values.copy()
+
+        dt = get_time_steps(timestamps, len(values))
+        if self.previous_value is None:
+            # 先頭のサンプルはそのまま出力する
+            previous_value = values[0]
+            previous_filtered = values[0]
+            previous_derivative = np.zeros(values.shape[1])
+        else:
+            previous_value = self.previous_value
+            previous_filtered = self.previous_filtered
+            previous_derivative = self.previous_derivative
+            if timestamps is not None and self.previous_timestamp is not None \
+                    and timestamps[0] > self.previous_timestamp:
+                dt[0] = timestamps[0] - self.previous_timestamp
+
+        raw_derivative = np.diff(values, axis=0, prepend=previous_value.reshape(1, -1)) / dt[:, np.newaxis]
+        alpha_d = 1.0 / (1.0 + 1.0 / (2 * math.pi * self.d_cutoff * dt))
+        derivative = solve_first_order_recurrence(alpha_d, raw_derivative, previous_derivative)
+
+        cutoff = self.min_cutoff + self.beta * np.abs(derivative)
+        alpha = 1.0 / (1.0 + 1.0 / (2 * math.pi * cutoff * dt[:, np.newaxis]))
+        filtered = solve_first_order_recurrence(alpha, values, previous_filtered)
+
+        self.previous_value = values[-1].copy()
+        self.previous_filtered = filtered[-1].copy()
+        self.previous_derivative = derivative[-1].copy()
+        if timestamps is not None:
+            self.previous_timestamp = timestamps[-1]
+        return filtered
+
+
+class KalmanFilter():
+    # 等速度モデルのカルマンフィルタ。各チャンネルを独立に [位置, 速度] で推定する
+    name = "kalman"
+
+    def __init__(self, process_noise=50.0, measurement_noise=0.05):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.velocity = None
+        self.covariance = None  # (p00, p01, p11)
+        self.previous_timestamp = None
+
+    def describe(self):
+        return "{} process_noise={} measurement_noise={}".format(self.name, self.process_noise,
+                                                                   self.measurement_noise)
+
+    def step(self, value, dt):
+        p00, p01, p11 = self.covariance
+        q = self.process_noise
+
+        # 予測
+        position = self.position + self.velocity * dt
+        p00 = p00 + dt * (2 * p01 + dt * p11) + q * dt ** 4 / 4
+        p01 = p01 + dt * p11 + q * dt ** 3 / 2
+        p11 = p11 + q * dt ** 2
+
+        # 更新
+        innovation = value - position
+        gain_denominator = p00 + self.measurement_noise
+        k0 = p00 / gain_denominator
+        k1 = p01 / gain_denominator
+        self.position = position + k0 * innovation
+        self.velocity = self.velocity + k1 * innovation
+        self.covariance = ((1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01)
+        return self.position
+
+    def filter(self, value, timestamp=None):
+        value = np.asarray(value, dtype=float)
+        if self.position is None:
+            self.position = value
+            self.velocity = np.zeros_like(value)
+            self.covariance = (np.full_like(value, self.measurement_noise), np.zeros_like(value),
+                               np.full_like(value, self.process_noise))
+            self.previous_timestamp = timestamp
+            return value
+
+        dt = 1.0 / DEFAULT_RATE
+        if timestamp is not None and self.previous_timestamp is not None and timestamp > self.previous_timestamp:
+            dt = timestamp - self.previous_timestamp
+        self.previous_timestamp = timestamp
+        return self.step(value, dt)
+
+    def get_gains(self, dt):
+        # 共分散とゲインの更新は値によらず、全チャンネルで同じなので、先に1チャンネル分だけ求める
+        p00, p01, p11 = (float(np.ravel(p)[0]) for p in self.covariance)
+        q = self.process_noise
+        gains = np.empty((len(dt), 2))
+        for i, step in enumerate(dt.tolist()):
+            p00 = p00 + step * (2 * p01 + step * p11) + q * step ** 4 / 4
+            p01 = p01 + step * p11 + q * step ** 3 / 2
+            p11 = p11 + q * step ** 2
+            gain_denominator = p00 + self.measurement_noise
+            k0 = p00 / gain_denominator
+            k1 = p01 / gain_denominator
+            gains[i] = k0, k1
+            p00, p01, p11 = (1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01
+        self.covariance = (np.full_like(self.position, p00), np.full_like(self.position, p01),
+                           np.full_like(self.position, p11))
+        return gains[:, 0], gains[:, 1]
+
+    def filter_batch(self, values, timestamps=None):
+        # ゲインの列を先に求め、[位置, 速度] の更新は線形の漸化式として配列演算でまとめて解く
+        values = np.asarray(values, dtype=float).reshape(len(values), -1)
+        result = np.empty_like(values)
+        if len(values) == 0:
+            return result
+
+        dt = get_time_steps(timestamps, len(values))
+        start = 0
+        if self.position is None:
+            result[0] = self.filter(values[0], None if timestamps is None else timestamps[0])
+            start = 1
+        elif timestamps is not None and self.previous_timestamp is not None \
+                and timestamps[0] > self.previous_timestamp:
+            dt[0] = timestamps[0] - self.previous_timestamp
+
+        if start < len(values):
+            dt = dt[start:]
+            measured = values[start:]
+            k0, k1 = self.get_gains(dt)
+
+            # 予測してから更新する1ステップ: 位置 = (1-k0)(位置 + 速度 dt) + k0 値, 速度 = 速度 - k1(位置 + 速度 dt) + k1 値
+            transition = np.empty((len(dt), 2, 2))
+            transition[:, 0, 0] = 1 - k0
+            transition[:, 0, 1] = (1 - k0) * dt
+            transition[:, 1, 0] = -k1
+            transition[:, 1, 1] = 1 - k1 * dt
+            offset = np.stack([k0[:, np.newaxis] * measured, k1[:, np.newaxis] * measured], axis=1)
+            transition, offset = solve_affine_recurrence(transition, offset)
+
+            states = np.einsum('nij,jc->nic', transition, np.stack([self.position, self.velocity])) + offset
+            result[start:] = states[:, 0]
+            self.position = states[-1, 0].copy()
+            self.velocity = states[-1, 1].copy()
+
+        if timestamps is not None:
+            self.previous_timestamp = timestamps[-1]
+        return result
+
+
+FILTERS = {
+    EmaFilter.name: EmaFilter,
+    OneEuroFilter.name: OneEuroFilter,
+    KalmanFilter.name: KalmanFilter,
+}
+
+
+def create_filter(name: str, **params):
+    return FILTERS[name](**params)
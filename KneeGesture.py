@@ -0,0 +1,137 @@
+from enum import Enum
+
+import numpy as np
+
+# 膝のジェスチャの判定（フィルタをかける前のセンサの値で、速度とチャンネルごとの距離の形から判定する）
+# 膝の近さは 64 - 最も近いセンサの距離（KneePosition.get_position の y と同じ向き）
+LIFT_MARGIN = 2.0  # キャリブレーションの上限（knee_pos_y_maximum）からこれだけ近づいたら膝を上げた
+RELEASE_MARGIN = 0.0  # 上げた後、上限からの差がこれを下回ったら下ろした（間はヒステリシス）
+ONSET_VELOCITY = 40.0  # 近づく速さがこれを越えたフレームを動き始めとする[/s]
+MIN_CONTRAST = 4.0  # 距離の中央値と最小値の差がこれ以上の時だけ膝とみなす（脚全体や手が横切った時を除く）
+MAX_LATENCY = 0.06  # 動き始めからこの時間[s]で必ず判定する（上限を越えていなくても、ヒステリシスの範囲に入っていれば上げたとする）
+TAP_TIME = 0.3  # 上げてからこの時間[s]以内に下ろしたらタップ
+HOLD_TIME = 0.6  # 上げたままこの時間[s]が過ぎたらホールド
+VELOCITY_FRAMES = 3  # 速度を求めるフレーム数（1フレームの差だけではばらつきが大きい）
+
+
+class GestureType(Enum):
+    LIFT_OFF = 0  # 膝を上げた
+    TAP = 1  # 上げてすぐ下ろした
+    HOLD = 2  # 上げたまま止めている
+    RELEASE = 3  # 下ろした（タップでない時）
+
+
+class GestureState(Enum):
+    RESTING = 0
+    RISING = 1
+    LIFTED = 2
+
+
+class GestureEvent():
+    def __init__(self, gesture: GestureType, timestamp_ns: int, onset_ns: int):
+        self.gesture = gesture
+        self.timestamp_ns = timestamp_ns  # 判定したフレームのセンサの値を読んだ時刻
+        self.onset_ns = onset_ns  # 判定のもとになった動きが始まった時刻
+        self.latency_ns = timestamp_ns - onset_ns  # 判定の遅れ
+
+
+class KneeGestureRecognizer():
+    # フレームごとに update を呼び、判定できたジェスチャを GestureEvent のリストで受け取る
+    # 判定の遅れは、膝を上げた時は MAX_LATENCY（+1フレーム）まで、タップは下ろし始めてから MAX_LATENCY までに収まる
+    def __init__(self, **params):
+        self.set_params(**params)
+        self.times = np.zeros(VELOCITY_FRAMES, dtype=np.int64)
+        self.nearnesses = np.zeros(VELOCITY_FRAMES, dtype=float)
+        self.reset()
+
+    def set_params(self, lift_margin=LIFT_MARGIN, release_margin=RELEASE_MARGIN, onset_velocity=ONSET_VELOCITY,
+                   min_contrast=MIN_CONTRAST, max_latency=MAX_LATENCY, tap_time=TAP_TIME, hold_time=HOLD_TIME):
+        # 操作モードごとに変える（判定の途中でも状態はそのまま）
+        self.lift_margin = lift_margin
+        self.release_margin = release_margin
+        self.onset_velocity = onset_velocity
+        self.min_contrast = min_contrast
+        self.max_latency_ns = int(max_latency * 1e9)
+        self.tap_time_ns = int(tap_time * 1e9)
+        self.hold_time_ns = int(hold_time * 1e9)
+
+    def reset(self):
+        # 接続し直した時、膝が離れた時に呼ぶ
+        self.state = GestureState.RESTING
+        self.num_of_frames = 0
+        self.onset_ns = 0  # 上げ始め（RISING, LIFTED）・下ろし始め（LIFTED で下がっている時）の時刻
+        self.lift_ns = 0  # LIFT_OFF を判定した時刻
+        self.is_falling = False
+        self.is_held = False
+
+    def get_velocity(self):
+        if self.num_of_frames < VELOCITY_FRAMES:
+            return 0.0
+        newest = (self.num_of_frames - 1) % VELOCITY_FRAMES
+        oldest = self.num_of_frames % VELOCITY_FRAMES
+        dt = (self.times[newest] - self.times[oldest]) * 1e-9
+        if dt <= 0:
+            return 0.0
+        return (self.nearnesses[newest] - self.nearnesses[oldest]) / dt
+
+    def update(self, distances, timestamp_ns: int, y_maximum: float):
+        nearest_distance = np.min(distances)
+        nearness = 64 - nearest_distance
+        is_knee_shape = np.median(distances) - nearest_distance >= self.min_contrast
+
+        index = self.num_of_frames % VELOCITY_FRAMES
+        self.times[index] = timestamp_ns
+        self.nearnesses[index] = nearness
+        self.num_of_frames += 1
+        velocity = self.get_velocity()
+
+        lift_level = y_maximum + self.lift_margin
+        release_level = y_maximum + self.release_margin
+        events = []
+
+        if self.state == GestureState.RESTING:
+            # 速度が取れないほどゆっくり上げた時は、上限を越えたフレームを動き始めとする
+            if (velocity > self.onset_velocity or nearness >= lift_level) and is_knee_shape:
+                self.state = GestureState.RISING
+                self.onset_ns = timestamp_ns
+
+        if self.state == GestureState.RISING:
+            if nearness >= lift_level and is_knee_shape:
+                self.lift(events, timestamp_ns)
+            elif timestamp_ns - self.onset_ns >= self.max_latency_ns:
+                # 遅れの上限に達した。ヒステリシスの範囲まで来ていれば上げたとみなす
+                if nearness > release_level and is_knee_shape:
+                    self.lift(events, timestamp_ns)
+                else:
+                    self.state = GestureState.RESTING
+            elif velocity < 0:
+                self.state = GestureState.RESTING  # 上限の手前で戻った
+
+        elif self.state == GestureState.LIFTED:
+            if velocity < -self.onset_velocity and not self.is_falling:
+                self.is_falling = True
+                self.onset_ns = timestamp_ns
+            elif velocity >= 0:
+                self.is_falling = False
+
+            if nearness <= release_level or (self.is_falling and nearness < lift_level and
+                                              timestamp_ns - self.onset_ns >= self.max_latency_ns):
+                onset_ns = self.onset_ns if self.is_falling else timestamp_ns
+                if timestamp_ns - self.lift_ns <= self.tap_time_ns:
+                    events.append(GestureEvent(GestureType.TAP, timestamp_ns, onset_ns))
+                else:
+                    events.append(GestureEvent(GestureType.RELEASE, timestamp_ns, onset_ns))
+                self.state = GestureState.RESTING
+                self.is_falling = False
+            elif not self.is_held and timestamp_ns - self.lift_ns >= self.hold_time_ns:
+                self.is_held = True
+                events.append(GestureEvent(GestureType.HOLD, timestamp_ns, self.lift_ns + self.hold_time_ns))
+
+        return events
+
+    def lift(self, events, timestamp_ns):
+        self.state = GestureState.LIFTED
+        self.lift_ns = timestamp_ns
+        self.is_falling = False
+        self.is_held = False
+        events.append(GestureEvent(GestureType.LIFT_OFF, timestamp_ns, self.onset_ns))
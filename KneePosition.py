@@ -1,21 +1,98 @@
+from enum import Enum
+
 import serial
 import numpy as np
 from PyQt5.QtCore import QThread, pyqtSignal
 
-NUM_OF_SENSORS = 10
-WAITING_FRAMES = 100
-ALPHA_EMA = 0.7
+import DeviceManager
+import KneeFilter
+import KneeGesture
+import RawSensorLog
+import SensorFusion
+import SensorProtocol
+import Timing
+
+NUM_OF_SENSORS = 10  # 1つのセンサアレイのセンサ数
+NUM_OF_SENSOR_ARRAYS = 1  # 2以上の時は複数のポートから同時に読み込み、センサを連結して使う
+# 各センサアレイのポート名かシリアル番号（チャンネルの順）。空の時はポート名の順に連結する
+SENSOR_ARRAY_PORTS = []
+WAITING_FRAMES = 100  # センサ値の統計（平均・分散）をとるフレーム数
+SKIP_FRAMES = 10  # 接続直後に読み飛ばすフレーム数(欠けたデータが読み込まれるのを避ける)
+SENSOR_FRAMING = SensorProtocol.FramingMode.TEXT  # BINARY はチェックサム付きのファームウェア用
+
+# 膝の有無の判定（センサとの距離。何も無い時は SensorFusion.FAR_DISTANCE）
+LEG_PRESENT_DISTANCE = 40  # どれかのセンサがこれより近ければ膝がある
+LEG_ABSENT_DISTANCE = 50  # 全てのセンサがこれより遠ければ膝が離れた（間はヒステリシス）
+
+# チャンネルごとの外れ値（1フレームだけ飛んだ値）の除去
+OUTLIER_SIGMA = 4.0  # 平均から標準偏差のこの倍より離れた値を外れ値とする
+OUTLIER_MIN_DEVIATION = 8.0  # ただし、平均からの差がこれ以下なら外れ値としない（止まっている時は分散が小さいため）
+OUTLIER_MIN_FRAMES = 10  # 統計がこのフレーム数に満たない間は除去しない
+
+# 膝の座標の平滑化に使うフィルタ（KneeFilter.FILTERS のいずれか）
+KNEE_FILTER = KneeFilter.OneEuroFilter.name
+KNEE_FILTER_PARAMS = {}
+
+class SensorHistory():
+    # 直近 size フレームのセンサ値のリングバッファ
+    # チャンネルごとの和と二乗和を足し引きして、平均・分散をフレームごとに O(チャンネル数) で更新する
+    def __init__(self, size: int, num_of_channels: int):
+        self.values = np.zeros((size, num_of_channels), dtype=float)
+        self.value_sum = np.zeros(num_of_channels, dtype=float)
+        self.square_sum = np.zeros(num_of_channels, dtype=float)
+        self.num_of_frames = 0
+        self.index = 0  # 次に書き込む行
+
+    def reset(self):
+        self.value_sum[:] = 0
+        self.square_sum[:] = 0
+        self.num_of_frames = 0
+        self.index = 0
+
+    def append(self, values):
+        size = len(self.values)
+        if self.num_of_frames == size:
+            removed = self.values[self.index]
+            self.value_sum -= removed
+            self.square_sum -= removed * removed
+        else:
+            self.num_of_frames += 1
+        self.values[self.index] = values
+        self.value_sum += values
+        self.square_sum += values * values
+
+        self.index = (self.index + 1) % size
+        if self.index == 0:
+            # 足し引きの丸め誤差がたまらないよう、1周ごとに計算し直す（1フレームあたりでは O(チャンネル数)）
+            self.value_sum = self.values.sum(axis=0)
+            self.square_sum = np.einsum('ij,ij->j', self.values, self.values)
+
+    def get_mean(self):
+        return self.value_sum / max(1, self.num_of_frames)
+
+    def get_variance(self):
+        mean = self.get_mean()
+        return np.maximum(self.square_sum / max(1, self.num_of_frames) - mean * mean, 0.0)
+
 
 class KneePosition():
 
-    def __init__(self):
-        self.distance_sensor_array_communication = serial.Serial('/dev/cu.usbmodem142201', 460800)
-        for i in range(10):
-            self.distance_sensor_array_communication.readline()  # 読み飛ばし(欠けたデータが読み込まれるのを避ける)
+    def __init__(self, distance_sensor_array_communication=None, num_of_sensors=NUM_OF_SENSORS):
+        self.num_of_sensors = num_of_sensors
+        self.distance_sensor_array_communication = None
+        self.sensor_stream = None  # 複数のセンサアレイを使う時の SensorFusion.FusedSensorStream
+        self.frame_parser = SensorProtocol.SensorFrameParser(num_of_sensors, SENSOR_FRAMING)
+        if distance_sensor_array_communication is not None:
+            self.set_communication(distance_sensor_array_communication)
+
+        # 膝の座標の平滑化
+        self.position_filter = KneeFilter.create_filter(KNEE_FILTER, **KNEE_FILTER_PARAMS)
 
-        # （仮の）膝の座標値
-        self.old_x = 0
-        self.old_y = 0
+        # 最後に使ったセンサの値を読んだ時刻[ns]（Timing.now_ns、GUI スレッドに届いた時刻ではない）
+        self.read_timestamp_ns = 0
+
+        # 生のセンサ値の記録（start_raw_logging で有効になる）
+        self.raw_logger = None
 
         # キャリブレーションの記録
         self.knee_pos_x_minimum = 2
@@ -26,36 +103,39 @@ class KneePosition():
         self.knee_pos_y_maximum = 53
 
         # 膝検出・位置計算用
-        self.sensor_val = np.zeros(NUM_OF_SENSORS, dtype=np.float)
-        self.weight = ([1.00] * NUM_OF_SENSORS)
-        self.val = np.zeros((WAITING_FRAMES, NUM_OF_SENSORS), dtype=np.float)
-        self.leg_flag = False
-        self.sensor_flt = np.zeros((WAITING_FRAMES, NUM_OF_SENSORS), dtype=np.float)
+        self.sensor_val = np.full(self.num_of_sensors, SensorFusion.FAR_DISTANCE, dtype=float)  # 外れ値を除いた最新の値
+        self.weight = np.ones(self.num_of_sensors, dtype=float)
+        self.sensor_index = np.arange(self.num_of_sensors, dtype=float)
+        self.sensor_history = SensorHistory(WAITING_FRAMES, self.num_of_sensors)  # 生の値（外れ値も含む）
+        self.is_outlier = np.zeros(self.num_of_sensors, dtype=bool)  # 前のフレームで外れ値とした
+        self.leg_flag = False  # 膝がセンサの前にある
+        self.num_of_outliers = 0
+
+    def set_communication(self, distance_sensor_array_communication):
+        self.distance_sensor_array_communication = distance_sensor_array_communication
+        self.frame_parser.reset(SKIP_FRAMES)
+        self.sensor_history.reset()
+
+    def set_sensor_stream(self, sensor_stream):
+        self.sensor_stream = sensor_stream
+        self.sensor_history.reset()
+
+    def close_communication(self):
+        if self.distance_sensor_array_communication is not None:
+            try:
+                self.distance_sensor_array_communication.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.distance_sensor_array_communication = None
 
     def calibrate_knee_position(self):
-        print("Set up EMA...")
-        for i in range(30):
-            x, y = self.get_position()
-            print("frames: {}, x: {}, y: {}".format(i, x, y))
-
-        calibration_frames = 20
-
-        calibration_x = np.zeros(calibration_frames, dtype=np.float)
-        calibration_y = np.zeros(calibration_frames, dtype=np.float)
-
-        print("Start Calibration")
-
-        for i in range(calibration_frames):
-            x, y = self.get_position()
-            print("frames: {}, x: {}, y: {}".format(i, x, y))
-            calibration_x[i] = x
-            calibration_y[i] = y
-
-        calibrate_value_x = np.average(calibration_x)
-        calibrate_value_y = np.average(calibration_y)
-
-        print("Success Calibration with x: {}, y: {} .".format(calibrate_value_x, calibrate_value_y))
+        # 同期的にキャリブレーションする（TimerThread では run の中で KneeCalibration を1フレームずつ進める）
+        calibration = KneeCalibration()
+        while not calibration.update(*self.get_position()):
+            pass
+        self.apply_calibration(*calibration.result())
 
+    def apply_calibration(self, calibrate_value_x, calibrate_value_y):
         self.knee_pos_x_center = calibrate_value_x
         self.knee_pos_x_maximum = calibrate_value_x + 0.5
         self.knee_pos_x_minimum = calibrate_value_x - 0.5
@@ -64,10 +144,48 @@ class KneePosition():
         self.knee_pos_y_maximum = calibrate_value_y + 2
         self.knee_pos_y_minimum = calibrate_value_y - 1
 
+    def start_raw_logging(self, file_path: str):
+        self.stop_raw_logging()
+        if self.sensor_stream is not None:
+            # 連結した値は読む間隔でしか取れないので、センサアレイごとに全てのフレームを記録する
+            self.sensor_stream.start_raw_logging(file_path)
+            return
+        self.raw_logger = RawSensorLog.RawSensorLogger(file_path, self.num_of_sensors)
+
+    def stop_raw_logging(self):
+        if self.sensor_stream is not None:
+            self.sensor_stream.stop_raw_logging()
+        raw_logger = self.raw_logger
+        self.raw_logger = None
+        if raw_logger is not None:
+            raw_logger.close()
+
     def get_distance(self):
-        distances = float(0)
-        while self.distance_sensor_array_communication.in_waiting > 1 or distances == float(0):
-            distances = self.distance_sensor_array_communication.readline().strip().decode("utf-8").split(',')
+        if self.sensor_stream is not None:
+            distances = self.sensor_stream.get_distance()
+            self.read_timestamp_ns = self.sensor_stream.latest_timestamp
+            return distances
+
+        # 届いているバイトをまとめて読み、溜まっていたフレームのうち最新のものを使う
+        # （1度に読んだフレームは同じ時刻にする）
+        connection = self.distance_sensor_array_communication
+        distances = None
+        while distances is None or connection.in_waiting > 0:
+            data = connection.read(max(1, connection.in_waiting))
+            self.read_timestamp_ns = Timing.now_ns()
+            if not data:
+                # 読み込みがタイムアウトした（センサが止まった、または抜かれた）
+                raise serial.SerialException("No data from the sensor array.")
+            frames = self.frame_parser.feed(data)
+            if len(frames) == 0:
+                continue
+
+            # 読み飛ばすフレームも含めて全て記録する
+            raw_logger = self.raw_logger
+            if raw_logger is not None:
+                for frame in frames:
+                    raw_logger.append(frame, self.read_timestamp_ns)
+            distances = frames[-1]
 
         return distances
 
@@ -95,54 +213,222 @@ class KneePosition():
 
         return x, y
 
-    def get_position(self):
-        weight = ([1.00] * NUM_OF_SENSORS)
+    def reject_outliers(self, distances):
+        # 直近の平均から大きく外れた値は前の値に置き換える
+        # 2フレーム続けて外れた時は実際に動いたとみなして受け入れる（動き始めの遅れは1フレームまで）
+        if self.sensor_history.num_of_frames >= OUTLIER_MIN_FRAMES:
+            deviation = np.abs(distances - self.sensor_history.get_mean())
+            is_far = deviation > OUTLIER_SIGMA * np.sqrt(self.sensor_history.get_variance()) + OUTLIER_MIN_DEVIATION
+            is_outlier = is_far & ~self.is_outlier
+            self.is_outlier = is_far
+            self.num_of_outliers += int(np.count_nonzero(is_outlier))
+            accepted = np.where(is_outlier, self.sensor_val, distances)
+        else:
+            accepted = distances
+        self.sensor_history.append(distances)
+        self.sensor_val = accepted
+        return accepted
+
+    def update_leg_presence(self, distances):
+        nearest_distance = np.min(distances)
+        if self.leg_flag:
+            if nearest_distance > LEG_ABSENT_DISTANCE:
+                self.leg_flag = False
+        elif nearest_distance < LEG_PRESENT_DISTANCE:
+            self.leg_flag = True
+            self.position_filter.reset()  # 離れる前の座標から続けてフィルタしない
+        return self.leg_flag
 
-        sensor_values = self.get_distance()
-        sensor_values = [64 - float(v) for v in sensor_values]  # 計算を容易にするため膝との距離を反転（要らないかもしれない）
+    def get_position(self):
+        distances = self.reject_outliers(np.asarray(self.get_distance(), dtype=float))
+        self.update_leg_presence(distances)
+        sensor_values = 64 - distances  # 計算を容易にするため膝との距離を反転（要らないかもしれない）
 
         max_distance = np.max(sensor_values)
 
         new_y = max_distance
 
-        for i in range(NUM_OF_SENSORS):
-            weight[i] = 1 / (max_distance - sensor_values[i] + 2)
-        weight_sum = np.sum(weight)
+        # 膝に近いセンサほど重くした重心（センサ数によらない）
+        weight = 1 / (max_distance - sensor_values + 2)
+        new_x = np.dot(self.sensor_index, weight) / np.sum(weight)
 
-        new_x = 0
+        new_x, new_y = self.position_filter.filter((new_x, new_y), Timing.to_seconds(self.read_timestamp_ns))
 
-        for i in range(NUM_OF_SENSORS):
-            new_x += (i * weight[i] / weight_sum)
+        # 膝を上げた（モードの切り替え）は KneeGesture でフィルタをかける前の値から判定する
+        return new_x, new_y
 
-        new_x = (new_x - self.old_x) * ALPHA_EMA + self.old_x
-        self.old_x = new_x
+class CalibrationState(Enum):
+    WARMING_UP = 0
+    CALIBRATING = 1
+    CALIBRATED = 2
 
-        new_y = (new_y - self.old_y) * ALPHA_EMA + self.old_y
-        self.old_y = new_y
 
-        if new_y > self.knee_pos_y_maximum + 2:
-            new_y = 0
+class KneeCalibration():
+    # 1フレームずつ進めるキャリブレーションの状態機械
+    # フィルタが落ち着くまで読み飛ばした後、直近のフレームのばらつきが小さくなったら中心位置を確定する
+    WARMUP_FRAMES = 30
+    CALIBRATION_FRAMES = 20
+    MAXIMUM_FRAMES = 200  # これを超えたら、ばらつきが大きくても確定する
+    MAXIMUM_STD_X = 0.3
+    MAXIMUM_STD_Y = 1.0
+
+    def __init__(self):
+        self.state = CalibrationState.WARMING_UP
+        self.frame = 0
+        self.calibration_x = np.zeros(self.CALIBRATION_FRAMES, dtype=float)
+        self.calibration_y = np.zeros(self.CALIBRATION_FRAMES, dtype=float)
+
+    def is_calibrated(self):
+        return self.state == CalibrationState.CALIBRATED
+
+    def get_total_frames(self):
+        return self.WARMUP_FRAMES + self.CALIBRATION_FRAMES
+
+    def get_progress_frames(self):
+        return min(self.frame, self.get_total_frames() - 1)
+
+    def update(self, x, y):
+        if self.state == CalibrationState.CALIBRATED:
+            return True
+
+        self.frame += 1
+        if self.state == CalibrationState.WARMING_UP:
+            if self.frame >= self.WARMUP_FRAMES:
+                self.state = CalibrationState.CALIBRATING
+            return False
+
+        # 直近 CALIBRATION_FRAMES フレームをリングバッファに記録
+        index = (self.frame - self.WARMUP_FRAMES - 1) % self.CALIBRATION_FRAMES
+        self.calibration_x[index] = x
+        self.calibration_y[index] = y
+
+        if self.frame - self.WARMUP_FRAMES < self.CALIBRATION_FRAMES:
+            return False
+
+        if (np.std(self.calibration_x) <= self.MAXIMUM_STD_X and np.std(self.calibration_y) <= self.MAXIMUM_STD_Y) \
+                or self.frame >= self.MAXIMUM_FRAMES:
+            self.state = CalibrationState.CALIBRATED
+            return True
+
+        return False
+
+    def result(self):
+        return float(np.average(self.calibration_x)), float(np.average(self.calibration_y))
 
-        return new_x, new_y
 
 class TimerThread(QThread):
-    updateSignal = pyqtSignal(float, float)
+    updateSignal = pyqtSignal(float, float, 'qlonglong')  # x, y, センサの値を読んだ時刻[ns]
+    calibrationProgressSignal = pyqtSignal(int, int)
+    calibrationFinishedSignal = pyqtSignal(float, float)
+    deviceConnectedSignal = pyqtSignal(str)
+    deviceDisconnectedSignal = pyqtSignal(str)
+    legPresenceSignal = pyqtSignal(bool)  # 膝がセンサの前に来た・離れた
+    gestureSignal = pyqtSignal(str, 'qlonglong', 'qlonglong')  # GestureType の名前, 判定したフレームの時刻[ns], 判定の遅れ[ns]
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        self.kneePosition = KneePosition()  # 膝の座標を取得するためのクラス
-        print("Success Establish Connection.")
+        # センサの接続は run の中で探す（起動時間がセンサに左右されないように）
+        self.device_manager = DeviceManager.DeviceManager(NUM_OF_SENSORS, framing=SENSOR_FRAMING)
+        self.kneePosition = KneePosition(num_of_sensors=NUM_OF_SENSORS * NUM_OF_SENSOR_ARRAYS)  # 膝の座標を取得するためのクラス
 
-        self.kneePosition.calibrate_knee_position()
+        # キャリブレーションは run の中で進める（GUIスレッドを止めないため）
+        self.calibration = KneeCalibration()
+        self.is_leg_present = False
+        self.gesture_recognizer = KneeGesture.KneeGestureRecognizer()
 
     def run(self):
-        while True:
+        if NUM_OF_SENSOR_ARRAYS > 1:
+            self.run_sensor_arrays()
+            return
+
+        while not self.isInterruptionRequested():
+            connection = self.device_manager.connect(self.isInterruptionRequested)
+            if connection is None:
+                break
+
+            try:
+                self.kneePosition.set_communication(connection)
+                print("Success Establish Connection.")
+                self.deviceConnectedSignal.emit(connection.port)
+                self.read_positions()
+
+            except (serial.SerialException, OSError) as e:
+                # 抜かれたら探し直す。キャリブレーションの結果はそのまま使う
+                self.kneePosition.position_filter.reset()
+                self.gesture_recognizer.reset()
+                self.deviceDisconnectedSignal.emit(str(e))
+
+            finally:
+                self.kneePosition.close_communication()
+
+    def run_sensor_arrays(self):
+        # 各センサアレイは別スレッドで読み込み、切断されたものはそのスレッドの中で再接続する
+        # ポートを指定していない時は、どれが先に接続しても同じ並びになるようポート名の順に連結する
+        ports = SENSOR_ARRAY_PORTS if SENSOR_ARRAY_PORTS else [None] * NUM_OF_SENSOR_ARRAYS
+        sources = [SensorFusion.SensorSource("sensor_array{}".format(i), NUM_OF_SENSORS,
+                                             lambda port=port: self.device_manager.connect(
+                                                 self.isInterruptionRequested, port),
+                                             framing=SENSOR_FRAMING)
+                   for i, port in enumerate(ports)]
+        sensor_stream = SensorFusion.FusedSensorStream(sources, is_ordered_by_port=not SENSOR_ARRAY_PORTS)
+        self.kneePosition.set_sensor_stream(sensor_stream)
+        sensor_stream.start()
+
+        while not self.isInterruptionRequested():
+            try:
+                self.read_positions()
+            except serial.SerialException as e:
+                # 全てのセンサアレイから値が来ていない
+                self.kneePosition.position_filter.reset()
+                self.gesture_recognizer.reset()
+                self.deviceDisconnectedSignal.emit(str(e))
+
+        sensor_stream.stop()
+
+    def read_positions(self):
+        while not self.isInterruptionRequested():
             x, y = self.kneePosition.get_position()
+
+            # 膝が無い間は座標を送らず、キャリブレーションも進めない
+            if self.kneePosition.leg_flag != self.is_leg_present:
+                self.is_leg_present = self.kneePosition.leg_flag
+                self.legPresenceSignal.emit(self.is_leg_present)
+                self.gesture_recognizer.reset()
+            if not self.is_leg_present:
+                continue
+
+            if not self.calibration.is_calibrated():
+                if self.calibration.update(x, y):
+                    calibrate_value_x, calibrate_value_y = self.calibration.result()
+                    self.kneePosition.apply_calibration(calibrate_value_x, calibrate_value_y)
+                    print("Success Calibration with x: {}, y: {} .".format(calibrate_value_x, calibrate_value_y))
+                    self.calibrationFinishedSignal.emit(calibrate_value_x, calibrate_value_y)
+                else:
+                    self.calibrationProgressSignal.emit(self.calibration.get_progress_frames(),
+                                                        self.calibration.get_total_frames())
+                continue
+
+            for event in self.gesture_recognizer.update(self.kneePosition.sensor_val,
+                                                        self.kneePosition.read_timestamp_ns,
+                                                        self.kneePosition.knee_pos_y_maximum):
+                self.gestureSignal.emit(event.gesture.name, event.timestamp_ns, event.latency_ns)
+
             # x: 2  <-> 6
             # y: 46 <-> 48 <-> 53
-            self.updateSignal.emit(x, y)
+            self.updateSignal.emit(x, y, self.kneePosition.read_timestamp_ns)
             self.msleep(10)
 
-        # スレッドが終了してから
-        # TODO: スレッド停止後の処理
\ No newline at end of file
+    def set_gesture_params(self, **params):
+        # 操作モードが変わった時に GUI スレッドから呼ぶ
+        self.gesture_recognizer.set_params(**params)
+
+    def start_raw_logging(self, file_path: str):
+        self.kneePosition.start_raw_logging(file_path)
+
+    def stop_raw_logging(self):
+        self.kneePosition.stop_raw_logging()
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
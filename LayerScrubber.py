@@ -0,0 +1,193 @@
+from PyQt5.QtCore import QObject, QRect, QRectF, QRunnable, QThreadPool, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QImage, QPainter, QPen
+from PyQt5.QtWidgets import QWidget
+
+import StepQuantizer
+import Timing
+
+THUMBNAIL_SIZE = 48  # サムネイル1枚の大きさ[px]
+THUMBNAIL_MARGIN = 4
+LAYER_DWELL_TIME = 0.35  # 同じレイヤをこの時間[s]指し続けたら操作レイヤを切り替える
+LAYER_HYSTERESIS = 0.15  # レイヤの幅に対する割合（StepQuantizer.HYSTERESIS と同じ意味）
+
+
+class ThumbnailRenderTask(QRunnable):
+    # Canvas.prepare_render が GUI スレッドで作った paint をワーカスレッドで縮小して描く
+    def __init__(self, cache, canvas, paint, scale):
+        super().__init__()
+        self.cache = cache
+        self.canvas = canvas
+        self.paint = paint
+        self.scale = scale
+        self.is_cancelled = False
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def run(self):
+        if self.is_cancelled:
+            return
+        image = QImage(THUMBNAIL_SIZE, THUMBNAIL_SIZE, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.white)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.scale(self.scale, self.scale)
+        self.paint(painter, lambda: self.is_cancelled)
+        painter.end()
+        if not self.is_cancelled:
+            self.cache.thumbnailRenderedSignal.emit(self.canvas, self, image)
+
+
+class ThumbnailCache(QObject):
+    # レイヤ（Canvas）ごとのサムネイル。内容が変わったレイヤだけ、表示する時にスレッドプールで描き直す
+    # budget（MemoryBudget）を渡すと、使われていないレイヤのサムネイルから捨てる
+    thumbnailUpdatedSignal = pyqtSignal()
+    thumbnailRenderedSignal = pyqtSignal(object, object, QImage)  # ワーカスレッドから GUI スレッドへ渡すため
+
+    def __init__(self, document_size, thread_pool=None, budget=None, parent=None):
+        super().__init__(parent)
+        self.document_size = document_size
+        self.budget = budget
+        self.thread_pool = thread_pool if thread_pool is not None else QThreadPool.globalInstance()
+        self.thumbnails = {}  # Canvas -> QImage
+        self.stale_canvases = set()  # 描き直すまで古いサムネイルを表示しておくレイヤ
+        self.pending_tasks = {}  # Canvas -> 描画中の ThumbnailRenderTask
+        self.thumbnailRenderedSignal.connect(self.thumbnail_rendered)
+
+    def watch(self, canvas):
+        canvas.contentChangedSignal.connect(self.canvas_changed)
+
+    def canvas_changed(self):
+        self.invalidate(self.sender())
+
+    def invalidate(self, canvas):
+        if canvas in self.thumbnails:
+            self.stale_canvases.add(canvas)
+        task = self.pending_tasks.pop(canvas, None)
+        if task is not None:
+            task.cancel()
+
+    def remove(self, canvas):
+        self.invalidate(canvas)
+        canvas.contentChangedSignal.disconnect(self.canvas_changed)
+        self.evict(canvas)
+        if self.budget is not None:
+            self.budget.discard(self, canvas)
+
+    def evict(self, canvas):
+        self.thumbnails.pop(canvas, None)
+        self.stale_canvases.discard(canvas)
+
+    def get_memory_usage(self, canvas) -> int:
+        image = self.thumbnails.get(canvas)
+        return 0 if image is None else image.sizeInBytes()
+
+    def get_thumbnail(self, canvas):
+        # 無い・古い時は描き直しを頼み、それまでは古いもの（無ければ None）を返す
+        image = self.thumbnails.get(canvas)
+        if image is not None and self.budget is not None:
+            self.budget.touch(self, canvas)
+        if (image is None or canvas in self.stale_canvases) and canvas not in self.pending_tasks:
+            document_rect = QRectF(0, 0, self.document_size.width(), self.document_size.height())
+            scale = THUMBNAIL_SIZE / max(self.document_size.width(), self.document_size.height())
+            task = ThumbnailRenderTask(self, canvas, canvas.prepare_render(document_rect), scale)
+            self.pending_tasks[canvas] = task
+            self.thread_pool.start(task)
+        return image
+
+    def thumbnail_rendered(self, canvas, task, image):
+        if self.pending_tasks.get(canvas) is not task:
+            return  # 描いている間に内容が変わった
+        del self.pending_tasks[canvas]
+        self.thumbnails[canvas] = image
+        self.stale_canvases.discard(canvas)
+        if self.budget is not None:
+            self.budget.add(self, canvas, image.sizeInBytes())
+        self.thumbnailUpdatedSignal.emit()
+
+
+class LayerScrubber():
+    # 膝の x で指すレイヤ（highlighted_layer）はセンサの値ごとに動かし、
+    # 同じレイヤを LAYER_DWELL_TIME 指し続けた時だけ操作レイヤの切り替えを返す
+    def __init__(self, num_of_layers: int, dwell_time=LAYER_DWELL_TIME, hysteresis=LAYER_HYSTERESIS):
+        self.dwell_time = dwell_time
+        self.step_quantizer = StepQuantizer.StepQuantizer(num_of_layers, 0.0, 360.0, hysteresis, dwell_time=0.0)
+        self.highlighted_layer = None
+        self.highlighted_since = None
+
+    def reset(self, num_of_layers: int, active_layer: int):
+        self.step_quantizer.set_steps(num_of_layers)
+        self.highlighted_layer = active_layer
+        self.highlighted_since = None
+
+    def update(self, x, timestamp_ns, active_layer):
+        # 指すレイヤが変わったかと、切り替えるレイヤ（無ければ None）を返す
+        timestamp = Timing.to_seconds(timestamp_ns)
+        is_highlight_changed = self.step_quantizer.update(x, timestamp) and \
+            self.step_quantizer.step != self.highlighted_layer
+        if is_highlight_changed or self.highlighted_since is None:
+            self.highlighted_layer = self.step_quantizer.step
+            self.highlighted_since = timestamp
+
+        if self.highlighted_layer != active_layer and timestamp - self.highlighted_since >= self.dwell_time:
+            return is_highlight_changed, self.highlighted_layer
+        return is_highlight_changed, None
+
+    def release(self, active_layer):
+        # 膝の操作を終えた時は、指していたレイヤをそのまま確定する
+        if self.highlighted_layer is not None and self.highlighted_layer != active_layer:
+            return self.highlighted_layer
+        return None
+
+
+class LayerStrip(QWidget):
+    # 指しているレイヤを中心にサムネイルを横に並べる（レイヤが多くても表示する数は幅で決まる）
+    def __init__(self, thumbnail_cache, parent=None):
+        super().__init__(parent)
+        self.thumbnail_cache = thumbnail_cache
+        self.thumbnail_cache.thumbnailUpdatedSignal.connect(self.update)
+        self.canvases = []  # MainWindow.canvas（表示する時に参照だけ受け取る）
+        self.highlighted_layer = 0
+        self.active_layer = 0
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+
+    def set_layers(self, canvases, active_layer):
+        self.canvases = canvases
+        self.active_layer = active_layer
+        self.highlighted_layer = active_layer
+        self.update()
+
+    def set_highlighted_layer(self, layer):
+        if layer != self.highlighted_layer:
+            self.highlighted_layer = layer
+            self.update()
+
+    def get_cell_rect(self, position):
+        cell_width = THUMBNAIL_SIZE + THUMBNAIL_MARGIN
+        num_of_cells = max(1, self.width() // cell_width)
+        left = (self.width() - num_of_cells * cell_width) // 2 + position * cell_width + THUMBNAIL_MARGIN // 2
+        return QRect(left, (self.height() - THUMBNAIL_SIZE) // 2, THUMBNAIL_SIZE, THUMBNAIL_SIZE), num_of_cells
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(40, 40, 40, 180))
+        if len(self.canvases) == 0:
+            return
+
+        _, num_of_cells = self.get_cell_rect(0)
+        first_layer = min(max(0, self.highlighted_layer - num_of_cells // 2), max(0, len(self.canvases) - num_of_cells))
+        for position, layer in enumerate(range(first_layer, min(len(self.canvases), first_layer + num_of_cells))):
+            rect, _ = self.get_cell_rect(position)
+            image = self.thumbnail_cache.get_thumbnail(self.canvases[layer])
+            if image is None:
+                painter.fillRect(rect, Qt.lightGray)
+            else:
+                painter.drawImage(rect, image)
+            painter.setPen(Qt.black)
+            painter.drawText(rect.adjusted(2, 0, 0, 0), Qt.AlignLeft | Qt.AlignBottom, str(layer))
+            if layer == self.active_layer:
+                painter.setPen(QPen(Qt.white, 1, Qt.DashLine))
+                painter.drawRect(rect.adjusted(-1, -1, 0, 0))
+            if layer == self.highlighted_layer:
+                painter.setPen(QPen(QColor(255, 160, 0), 3))
+                painter.drawRect(rect.adjusted(-2, -2, 1, 1))
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+TILE_BUDGET = 256 * 1024 * 1024  # 全レイヤのタイルに使ってよい量[byte]
+THUMBNAIL_BUDGET = 16 * 1024 * 1024  # サムネイルに使ってよい量[byte]
+PICTURE_CACHE_BUDGET = 128 * 1024 * 1024  # ImageLoader が残しておく変換済みの画像に使ってよい量[byte]
+
+# 大きさの見積もりに使う値[byte]（Python のオブジェクトの分も含めたおおよその値）
+PATH_ELEMENT_BYTES = 24  # QPainterPath の要素1つ（x, y と種類）
+POINT_BYTES = 64  # QPoint 1つ
+COLOR_BYTES = 48  # QColor 1つ
+INDEX_ENTRY_BYTES = 120  # R-tree の矩形1つ
+RECORD_VALUE_BYTES = 8  # 計測の記録の値1つ
+
+
+def get_image_bytes(image) -> int:
+    return 0 if image.isNull() else image.sizeInBytes()
+
+
+def get_path_bytes(path) -> int:
+    return path.elementCount() * PATH_ELEMENT_BYTES
+
+
+def format_bytes(num_of_bytes: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if num_of_bytes < 1024:
+            return "{:.0f} {}".format(num_of_bytes, unit) if unit == "B" else "{:.1f} {}".format(num_of_bytes, unit)
+        num_of_bytes /= 1024
+    return "{:.1f} GiB".format(num_of_bytes)
+
+
+class MemoryBudget():
+    # 作り直せるキャッシュ（タイル・サムネイルなど）の合計の大きさを budget 以内に保つ
+    # 使われていない順に、持ち主の evict(key) を呼んで捨てさせる（持ち主は次に必要になった時に作り直す）
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.entries = OrderedDict()  # (持ち主, key) -> 大きさ[byte]（古い順）
+        self.used_bytes = 0
+        self.num_of_evictions = 0
+
+    def add(self, owner, key, num_of_bytes: int):
+        self.discard(owner, key)
+        self.entries[(owner, key)] = num_of_bytes
+        self.used_bytes += num_of_bytes
+        self.evict_over_budget()
+
+    def touch(self, owner, key):
+        if (owner, key) in self.entries:
+            self.entries.move_to_end((owner, key))
+
+    def discard(self, owner, key):
+        num_of_bytes = self.entries.pop((owner, key), None)
+        if num_of_bytes is not None:
+            self.used_bytes -= num_of_bytes
+
+    def set_budget(self, budget: int):
+        self.budget = budget
+        self.evict_over_budget()
+
+    def evict_over_budget(self):
+        # 最後に加えたものは残す（1つで budget を越える時に、描いては捨てるのを繰り返さないように）
+        while self.used_bytes > self.budget and len(self.entries) > 1:
+            (owner, key), num_of_bytes = self.entries.popitem(last=False)
+            self.used_bytes -= num_of_bytes
+            self.num_of_evictions += 1
+            owner.evict(key)
@@ -0,0 +1,114 @@
+import queue
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+# ファイル形式
+#   ヘッダ: magic(8byte), チャンネル数(uint16), 値の型(uint8), 予約(5byte)
+#   チャンク: フレーム数(uint32), 時刻[ns](int64 x フレーム数), 値(型 x フレーム数 x チャンネル数)
+FILE_MAGIC = b"KNEERAW1"
+FILE_HEADER = struct.Struct("<8sHB5x")
+CHUNK_HEADER = struct.Struct("<I")
+VALUE_TYPES = {1: np.dtype(np.uint8), 2: np.dtype("<u2")}
+CHUNK_FRAMES = 1024
+
+
+class RawSensorLogger():
+    def __init__(self, file_path: str, num_of_channels: int, value_type=np.uint8, chunk_frames=CHUNK_FRAMES):
+        self.value_type = np.dtype(value_type).newbyteorder("<")
+        self.value_type_code = [code for code, t in VALUE_TYPES.items() if t == self.value_type][0]
+        self.value_maximum = np.iinfo(self.value_type).max
+        self.num_of_channels = num_of_channels
+        self.chunk_frames = chunk_frames
+        self.num_of_frames = 0
+
+        self.file = open(file_path, "wb")
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, num_of_channels, self.value_type_code))
+
+        # センサを読むスレッドでは配列に書き込むだけにして、ファイル書き込みは別スレッドで行う
+        self.lock = threading.Lock()
+        self.chunks = queue.Queue()
+        self.allocate_chunk()
+        self.writer_thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer_thread.start()
+
+    def allocate_chunk(self):
+        self.timestamps = np.empty(self.chunk_frames, dtype="<i8")
+        self.values = np.empty((self.chunk_frames, self.num_of_channels), dtype=self.value_type)
+        self.count = 0
+
+    def append(self, values, timestamp_ns=None):
+        if timestamp_ns is None:
+            timestamp_ns = time.perf_counter_ns()
+
+        with self.lock:
+            if self.file is None:
+                return
+            self.timestamps[self.count] = timestamp_ns
+            self.values[self.count] = np.clip(np.rint(np.asarray(values, dtype=float)), 0, self.value_maximum)
+            self.count += 1
+            self.num_of_frames += 1
+            if self.count == self.chunk_frames:
+                self.chunks.put((self.timestamps, self.values))
+                self.allocate_chunk()
+
+    def write_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            timestamps, values = chunk
+            self.file.write(CHUNK_HEADER.pack(len(timestamps)))
+            self.file.write(timestamps.tobytes())
+            self.file.write(values.tobytes())
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            if self.count > 0:
+                self.chunks.put((self.timestamps[:self.count], self.values[:self.count]))
+            self.chunks.put(None)
+            self.writer_thread.join()
+            self.file.close()
+            self.file = None
+
+
+def read_raw_log(file_path: str):
+    with open(file_path, "rb") as f:
+        data = f.read()
+
+    magic, num_of_channels, value_type_code = FILE_HEADER.unpack_from(data, 0)
+    if magic != FILE_MAGIC:
+        raise ValueError("{} is not a raw sensor log.".format(file_path))
+    value_type = VALUE_TYPES[value_type_code]
+
+    timestamps = []
+    values = []
+    offset = FILE_HEADER.size
+    while offset + CHUNK_HEADER.size <= len(data):
+        num_of_frames, = CHUNK_HEADER.unpack_from(data, offset)
+        offset += CHUNK_HEADER.size
+        chunk_size = num_of_frames * (8 + num_of_channels * value_type.itemsize)
+        if offset + chunk_size > len(data):
+            break  # 書き込み途中で終了したチャンクは読まない
+
+        timestamps.append(np.frombuffer(data, dtype="<i8", count=num_of_frames, offset=offset))
+        offset += num_of_frames * 8
+        values.append(np.frombuffer(data, dtype=value_type, count=num_of_frames * num_of_channels,
+                                    offset=offset).reshape(num_of_frames, num_of_channels))
+        offset += num_of_frames * num_of_channels * value_type.itemsize
+
+    if len(timestamps) == 0:
+        return np.empty(0, dtype="<i8"), np.empty((0, num_of_channels), dtype=value_type)
+    return np.concatenate(timestamps), np.concatenate(values)
+
+
+if __name__ == '__main__':
+    for file_path in sys.argv[1:]:
+        timestamps, values = read_raw_log(file_path)
+        duration = (timestamps[-1] - timestamps[0]) / 1e9 if len(timestamps) > 1 else 0
+        print("{}: {} frames, {} channels, {:.2f} s".format(file_path, values.shape[0], values.shape[1], duration))
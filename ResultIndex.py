@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+INDEX_DIR = ".result_index"
+INDEX_FILE_NAME = "index.json"
+INDEX_VERSION = 1
+RESULT_DIR_PREFIX = "result_"
+
+# StepControlKnee.save_records はディレクトリとファイル名を区切りなしで連結するため、
+# "steps_10/step_visibletest_frameRecords_20200615_140839.csv" のように条件名がファイル名の先頭に付く
+FILE_NAME_PATTERN = re.compile(r"^(?P<prefix>.*?)test_(?P<kind>frameRecords|operationRecords)_"
+                               r"(?P<date>\d{8}_\d{6})\.csv$")
+CALIBRATION_PATTERN = re.compile(r"calibration x:(?P<x>[-0-9.eE]+) y:(?P<y>[-0-9.eE]+)")
+PARTICIPANT_PATTERN = re.compile(r"^p(?P<no>\d+)$")
+STEPS_PATTERN = re.compile(r"^steps_(?P<steps>\d+)$")
+
+
+def parse_file_name(relative_path: str):
+    directories = relative_path.replace(os.sep, "/").split("/")
+    file_name = directories.pop()
+
+    metadata = {"result_dir": directories[0] if directories else ""}
+    match = FILE_NAME_PATTERN.match(file_name)
+    if match is None:
+        return None
+
+    metadata["kind"] = match.group("kind")
+    metadata["date"] = match.group("date")
+
+    # 区切りなしで連結された条件名（例: step_visible）
+    prefix = match.group("prefix")
+    if prefix.startswith("step_"):
+        metadata["step"] = prefix[len("step_"):]
+    elif prefix:
+        metadata["prefix"] = prefix
+
+    for directory in directories[1:]:
+        participant = PARTICIPANT_PATTERN.match(directory)
+        steps = STEPS_PATTERN.match(directory)
+        if participant:
+            metadata["participant"] = int(participant.group("no"))
+        elif steps:
+            metadata["steps"] = int(steps.group("steps"))
+        elif directory in ("horizontal", "vertical"):
+            metadata["orientation"] = directory
+        elif directory in ("knee", "mouse"):
+            metadata["device"] = directory
+
+    return metadata
+
+
+def parse_header(header_line: str):
+    # np.savetxt(comments=' ') で書かれたヘッダ。calibration 等は列名に混ざって書かれている
+    columns = []
+    metadata = {}
+    for field in header_line.strip().lstrip("#").split(","):
+        field = field.strip()
+        if not field:
+            continue
+        calibration = CALIBRATION_PATTERN.search(field)
+        if calibration:
+            metadata["calibration_x"] = float(calibration.group("x"))
+            metadata["calibration_y"] = float(calibration.group("y"))
+        elif ":" in field:
+            key, value = field.split(":", 1)
+            metadata[key.strip()] = value.strip()
+        else:
+            columns.append(field)
+    return columns, metadata
+
+
+def read_result_file(file_path: str):
+    with open(file_path, "r") as f:
+        header_line = f.readline()
+    columns, metadata = parse_header(header_line)
+    data = np.loadtxt(file_path, delimiter=",", skiprows=1, ndmin=2)
+    if data.size == 0:
+        data = np.empty((0, len(columns)), dtype=float)
+    return columns, metadata, data
+
+
+class ResultIndex():
+    def __init__(self, root=".", index_dir=INDEX_DIR):
+        self.root = os.path.abspath(root)
+        self.index_dir = os.path.join(self.root, index_dir)
+        self.cache_dir = os.path.join(self.index_dir, "columns")
+        self.index_path = os.path.join(self.index_dir, INDEX_FILE_NAME)
+        self.entries = {}
+        self.failed_files = []  # 前回の update で読めなかったファイルと理由（キャッシュせず、次の update で読み直す）
+        self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if index.get("version") == INDEX_VERSION:
+            self.entries = index.get("entries", {})
+
+    def save_index(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "entries": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def find_result_files(self, result_dirs=None):
+        if result_dirs is None:
+            result_dirs = sorted(d for d in os.listdir(self.root)
+                                 if d.startswith(RESULT_DIR_PREFIX) and os.path.isdir(os.path.join(self.root, d)))
+
+        for result_dir in result_dirs:
+            for dir_path, dir_names, file_names in os.walk(os.path.join(self.root, result_dir)):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.endswith(".csv"):
+                        yield os.path.relpath(os.path.join(dir_path, file_name), self.root)
+
+    def cache_path(self, relative_path: str):
+        key = hashlib.sha1(relative_path.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def is_up_to_date(self, relative_path: str, stat):
+        entry = self.entries.get(relative_path)
+        return (entry is not None
+                and entry["mtime_ns"] == stat.st_mtime_ns
+                and entry["size"] == stat.st_size
+                and os.path.exists(self.cache_path(relative_path)))
+
+    def update(self, result_dirs=None):
+        # 新規・変更されたファイルだけを読み込み、他はキャッシュを使う
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if result_dirs is not None:
+            # "result_x/" や "./result_x" でも記録のパスの先頭と比べられるように
+            result_dirs = [os.path.normpath(result_dir) for result_dir in result_dirs]
+        found = set()
+        parsed = []
+        self.failed_files = []
+
+        for relative_path in self.find_result_files(result_dirs):
+            found.add(relative_path)
+            stat = os.stat(os.path.join(self.root, relative_path))
+            if self.is_up_to_date(relative_path, stat):
+                continue
+
+            file_metadata = parse_file_name(relative_path)
+            if file_metadata is None:
+                continue
+
+            try:
+                columns, header_metadata, data = read_result_file(os.path.join(self.root, relative_path))
+            except (ValueError, OSError) as e:
+                # 書き込み中に落ちたセッションなど。他のファイルの索引は続ける
+                print("skipped {}: {}".format(relative_path, e), file=sys.stderr)
+                self.failed_files.append((relative_path, str(e)))
+                found.discard(relative_path)  # 古い記録も取り除く
+                continue
+            file_metadata.update(header_metadata)
+            np.save(self.cache_path(relative_path), np.ascontiguousarray(data))
+
+            self.entries[relative_path] = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "columns": columns,
+                "rows": int(data.shape[0]),
+                "metadata": file_metadata,
+            }
+            parsed.append(relative_path)
+
+        # 消されたファイルの記録を取り除く（対象ディレクトリを指定した時はその中だけ）
+        for relative_path in list(self.entries.keys()):
+            if relative_path in found:
+                continue
+            if result_dirs is not None and relative_path.split(os.sep)[0] not in result_dirs:
+                continue
+            try:
+                os.remove(self.cache_path(relative_path))
+            except FileNotFoundError:
+                pass
+            del self.entries[relative_path]
+
+        self.save_index()
+        return parsed
+
+    def select(self, **conditions):
+        for relative_path, entry in sorted(self.entries.items()):
+            metadata = entry["metadata"]
+            if all(metadata.get(key) == value for key, value in conditions.items()):
+                yield relative_path, entry
+
+    def load(self, relative_path: str):
+        entry = self.entries[relative_path]
+        if entry["rows"] == 0:
+            return np.empty((0, len(entry["columns"])), dtype=float)
+        return np.load(self.cache_path(relative_path), mmap_mode="r")
+
+    def load_columns(self, relative_path: str):
+        data = self.load(relative_path)
+        return {name: data[:, i] for i, name in enumerate(self.entries[relative_path]["columns"])}
+
+
+if __name__ == '__main__':
+    result_index = ResultIndex()
+    updated_files = result_index.update(sys.argv[1:] or None)
+    print("indexed: {}, parsed: {}, skipped: {}".format(len(result_index.entries), len(updated_files),
+                                                        len(result_index.failed_files)))
@@ -0,0 +1,167 @@
+import os
+import threading
+
+import numpy as np
+import serial
+
+import RawSensorLog
+import SensorProtocol
+import Timing
+
+HISTORY_FRAMES = 256  # 各センサで残しておくフレーム数
+DROPOUT_TIMEOUT = 0.1  # この時間[s]新しい値が来ないセンサは欠落とみなす
+STOP_TIMEOUT = 2.0  # 止める時に読み込みのスレッドの終了を待つ時間[s]（読み込みのタイムアウトより長く）
+FAR_DISTANCE = 64  # 欠落したセンサの値（何も検出していない時の距離）
+SKIP_FRAMES = 10  # 接続直後に読み飛ばすフレーム数(欠けたデータが読み込まれるのを避ける)
+
+
+class SensorSource(threading.Thread):
+    # 1つのポートからセンサの値を読み続けるスレッド
+    # 切断されたら connect で再接続し、その間は他のセンサを止めない
+    def __init__(self, name: str, num_of_channels: int, connect, on_new_frame=None,
+                 framing=SensorProtocol.FramingMode.TEXT):
+        super().__init__(name=name, daemon=True)
+        self.num_of_channels = num_of_channels
+        self.frame_parser = SensorProtocol.SensorFrameParser(num_of_channels, framing)
+        self.connect = connect  # () -> serial.Serial or None（None の時は読み込みを終える）
+        self.on_new_frame = on_new_frame
+        self.is_running = True
+        self.connection = None
+        self.port = None  # 最後に接続したポート（切断中も残す。チャンネルの並びを決めるのに使う）
+        self.raw_logger = None  # 読んだフレームを全て記録する（start_raw_logging で有効になる）
+
+        self.lock = threading.Lock()
+        self.timestamps = np.zeros(HISTORY_FRAMES, dtype=np.int64)
+        self.values = np.full((HISTORY_FRAMES, num_of_channels), FAR_DISTANCE, dtype=float)
+        self.num_of_frames = 0
+
+    def run(self):
+        while self.is_running:
+            self.connection = self.connect()
+            if self.connection is None:
+                break
+            self.port = self.connection.port
+            try:
+                self.frame_parser.reset(SKIP_FRAMES)
+                self.read_frames()
+            except (serial.SerialException, OSError):
+                pass
+            finally:
+                try:
+                    self.connection.close()
+                except (serial.SerialException, OSError):
+                    pass
+                self.connection = None
+
+    def read_frames(self):
+        while self.is_running:
+            data = self.connection.read(max(1, self.connection.in_waiting))
+            timestamp = Timing.now_ns()  # 読み込んだ時点の時刻（1度に読んだフレームは同じ時刻にする）
+            if not data:
+                raise serial.SerialException("No data from {}.".format(self.name))
+
+            frames = self.frame_parser.feed(data)
+            if len(frames) == 0:
+                continue
+
+            raw_logger = self.raw_logger
+            if raw_logger is not None:
+                for frame in frames:
+                    raw_logger.append(frame, timestamp)
+
+            with self.lock:
+                index = np.arange(self.num_of_frames, self.num_of_frames + len(frames)) % HISTORY_FRAMES
+                self.timestamps[index] = timestamp
+                self.values[index] = frames
+                self.num_of_frames += len(frames)
+
+            if self.on_new_frame is not None:
+                self.on_new_frame()
+
+    def get_latest(self):
+        with self.lock:
+            if self.num_of_frames == 0:
+                return None, None
+            index = (self.num_of_frames - 1) % HISTORY_FRAMES
+            return self.timestamps[index], self.values[index].copy()
+
+    def start_raw_logging(self, file_path: str):
+        self.stop_raw_logging()
+        self.raw_logger = RawSensorLog.RawSensorLogger(file_path, self.num_of_channels)
+
+    def stop_raw_logging(self):
+        raw_logger = self.raw_logger
+        self.raw_logger = None
+        if raw_logger is not None:
+            raw_logger.close()
+
+    def stop(self):
+        self.is_running = False
+        self.stop_raw_logging()
+
+
+class FusedSensorStream():
+    # 複数のセンサを並べて1つのセンサとして扱う（チャンネルは sources の順に連結する）
+    # is_ordered_by_port の時は、どのスレッドが先に接続したかによらないよう、ポート名の順に連結する
+    # （接続していないセンサは後ろに回るので、全て接続するまでは並びが変わることがある）
+    def __init__(self, sources, dropout_timeout=DROPOUT_TIMEOUT, is_ordered_by_port=False):
+        self.sources = sources
+        self.is_ordered_by_port = is_ordered_by_port
+        self.dropout_timeout_ns = int(dropout_timeout * 1e9)
+        self.num_of_channels = sum(source.num_of_channels for source in sources)
+        self.new_frame = threading.Condition()
+        self.num_of_new_frames = 0
+        self.latest_timestamp = 0  # get_distance で返した値のうち最も新しいフレームを読んだ時刻
+        for source in sources:
+            source.on_new_frame = self.notify_new_frame
+
+    def start(self):
+        for source in self.sources:
+            source.start()
+
+    def stop(self):
+        # 全て止めてから待つ（読み込み中のスレッドは DeviceManager.READ_TIMEOUT までに抜ける）
+        for source in self.sources:
+            source.stop()
+        for source in self.sources:
+            if source.is_alive():
+                source.join(STOP_TIMEOUT)
+
+    def get_ordered_sources(self):
+        if not self.is_ordered_by_port:
+            return self.sources
+        return sorted(self.sources, key=lambda source: (source.port is None, source.port or ""))
+
+    def start_raw_logging(self, file_path: str):
+        # センサごとに読んだ全てのフレームを別のファイルに記録する（file_path にセンサの名前を付け足す）
+        root, extension = os.path.splitext(file_path)
+        for source in self.sources:
+            source.start_raw_logging("{}_{}{}".format(root, source.name, extension))
+
+    def stop_raw_logging(self):
+        for source in self.sources:
+            source.stop_raw_logging()
+
+    def notify_new_frame(self):
+        with self.new_frame:
+            self.num_of_new_frames += 1
+            self.new_frame.notify_all()
+
+    def get_distance(self, timeout=1.0):
+        # どれかのセンサに新しい値が来るまで待ち、各センサの最新値を連結して返す
+        # 時刻合わせは「DROPOUT_TIMEOUT 以内に読んだ最新のフレーム」を使うだけ（それより古いセンサは欠落として扱う）
+        with self.new_frame:
+            if not self.new_frame.wait_for(lambda: self.num_of_new_frames > 0, timeout):
+                raise serial.SerialException("No data from any sensor array.")
+            self.num_of_new_frames = 0
+
+        timestamp = Timing.now_ns()
+        distances = []
+        for source in self.get_ordered_sources():
+            source_timestamp, values = source.get_latest()
+            if values is None or timestamp - source_timestamp > self.dropout_timeout_ns:
+                values = np.full(source.num_of_channels, FAR_DISTANCE, dtype=float)
+            else:
+                self.latest_timestamp = max(self.latest_timestamp, int(source_timestamp))
+            distances.append(values)
+        return np.concatenate(distances)
@@ -0,0 +1,230 @@
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSignal
+
+import KneePosition
+
+RING_CAPACITY = 4096  # 共有メモリに残しておくサンプル数（10 ms ごとなら約40秒分）
+POLL_INTERVAL = 5  # GUI が新しいサンプルを見に行く間隔[ms]
+STOP_TIMEOUT = 3.0  # 止める時に取得プロセスの終了を待つ時間[s]
+READ_RETRIES = 8  # 読んでいる間に上書きされた時に読み直す回数
+
+# 共有メモリの先頭（int64）: [0] seqlock の番号, [1] 容量
+# 番号は書き込みを始める時と終わった時に1ずつ増やす（奇数の間は 番号 // 2 番目のサンプルを書いている）
+HEADER_SIZE = 2
+SEQUENCE = 0
+CAPACITY = 1
+SAMPLE_DTYPE = np.dtype([("timestamp_ns", np.int64), ("x", np.float64), ("y", np.float64)])
+
+
+class SampleRing():
+    # 膝の座標を時刻付きで共有メモリのリングバッファに置く（書くのは取得プロセスの1スレッドだけ）
+    # 読む側はロックを取らず、読んだ後に seqlock の番号で上書きされていないかを確かめる
+    def __init__(self, name=None, capacity=RING_CAPACITY):
+        if name is None:
+            self.shared_memory = shared_memory.SharedMemory(
+                create=True, size=HEADER_SIZE * 8 + capacity * SAMPLE_DTYPE.itemsize)
+        else:
+            self.shared_memory = shared_memory.SharedMemory(name=name)
+        self.name = self.shared_memory.name
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.shared_memory.buf)
+        if name is None:
+            self.header[SEQUENCE] = 0
+            self.header[CAPACITY] = capacity
+        self.capacity = int(self.header[CAPACITY])
+        self.samples = np.ndarray((self.capacity,), dtype=SAMPLE_DTYPE, buffer=self.shared_memory.buf,
+                                  offset=HEADER_SIZE * 8)
+
+    def write(self, x, y, timestamp_ns):
+        sequence = int(self.header[SEQUENCE])
+        self.header[SEQUENCE] = sequence + 1
+        self.samples[(sequence // 2) % self.capacity] = (timestamp_ns, x, y)
+        self.header[SEQUENCE] = sequence + 2
+
+    def get_count(self):
+        # 書き終わったサンプルの数（次に書くサンプルの番号）
+        return int(self.header[SEQUENCE]) // 2
+
+    def is_intact(self, start):
+        # start 番目以降のサンプルがまだ上書きされ始めていないか（読んだ後に確かめる）
+        return int(self.header[SEQUENCE]) <= 2 * (start + self.capacity)
+
+    def read_latest(self):
+        # (番号, (timestamp_ns, x, y)) を返す。まだ無ければ None
+        for _ in range(READ_RETRIES):
+            count = self.get_count()
+            if count == 0:
+                return None
+            sample = self.samples[(count - 1) % self.capacity].item()
+            if self.is_intact(count - 1):
+                return count - 1, sample
+        return None
+
+    def get_views(self, start, stop):
+        # start 番目から stop 番目の手前までを、共有メモリをそのまま参照する配列（1つか2つ）で返す
+        # 使い終わったら is_intact(start) で確かめる（容量より古い番号は指定しない）
+        begin = start % self.capacity
+        end = begin + (stop - start)
+        if end <= self.capacity:
+            return [self.samples[begin:end]]
+        return [self.samples[begin:], self.samples[:end - self.capacity]]
+
+    def close(self):
+        # 配列が共有メモリを参照したままだと閉じられない
+        self.header = None
+        self.samples = None
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
+
+
+def run_acquisition(ring_name, command_queue, status_queue):
+    # 取得プロセスの本体。TimerThread をそのまま動かし、膝の座標は共有メモリに、状態はキューで GUI へ送る
+    ring = SampleRing(ring_name)
+    timer_thread = KneePosition.TimerThread()
+    timer_thread.updateSignal.connect(ring.write, Qt.DirectConnection)
+    timer_thread.calibrationProgressSignal.connect(
+        lambda frame, total_frames: status_queue.put(("calibration_progress", frame, total_frames)),
+        Qt.DirectConnection)
+    timer_thread.calibrationFinishedSignal.connect(
+        lambda x, y: status_queue.put(("calibration_finished", x, y)), Qt.DirectConnection)
+    timer_thread.deviceConnectedSignal.connect(
+        lambda port: status_queue.put(("device_connected", port)), Qt.DirectConnection)
+    timer_thread.deviceDisconnectedSignal.connect(
+        lambda reason: status_queue.put(("device_disconnected", reason)), Qt.DirectConnection)
+    timer_thread.legPresenceSignal.connect(
+        lambda is_present: status_queue.put(("leg_presence", is_present)), Qt.DirectConnection)
+    timer_thread.gestureSignal.connect(
+        lambda gesture, timestamp_ns, latency_ns: status_queue.put(("gesture", gesture, timestamp_ns, latency_ns)),
+        Qt.DirectConnection)
+    timer_thread.start()
+
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            command = command_queue.get(timeout=1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                break  # GUI が落ちた
+            continue
+        if command[0] == "start_raw_logging":
+            timer_thread.kneePosition.start_raw_logging(command[1])
+        elif command[0] == "stop_raw_logging":
+            timer_thread.kneePosition.stop_raw_logging()
+        elif command[0] == "gesture_params":
+            timer_thread.set_gesture_params(**command[1])
+        else:
+            break
+
+    timer_thread.stop()
+    timer_thread.kneePosition.stop_raw_logging()
+    ring.close()
+
+
+class SensorProcess(QObject):
+    # TimerThread と同じシグナルを持ち、センサの読み込み・フィルタ・キャリブレーションを別プロセスで行う
+    # GUI が描画などで忙しくても、取得プロセスは GIL を取り合わずに読み続ける
+    updateSignal = pyqtSignal(float, float, 'qlonglong')  # x, y, センサの値を読んだ時刻[ns]
+    calibrationProgressSignal = pyqtSignal(int, int)
+    calibrationFinishedSignal = pyqtSignal(float, float)
+    deviceConnectedSignal = pyqtSignal(str)
+    deviceDisconnectedSignal = pyqtSignal(str)
+    legPresenceSignal = pyqtSignal(bool)
+    gestureSignal = pyqtSignal(str, 'qlonglong', 'qlonglong')
+
+    def __init__(self, capacity=RING_CAPACITY, parent=None):
+        super().__init__(parent)
+        self.ring = SampleRing(capacity=capacity)
+
+        # GUI 側では座標の換算（get_mapped_positions）とキャリブレーションの値だけに使う
+        self.kneePosition = KneePosition.KneePosition(
+            num_of_sensors=KneePosition.NUM_OF_SENSORS * KneePosition.NUM_OF_SENSOR_ARRAYS)
+
+        # Qt のスレッドがあるプロセスを fork しないよう spawn で起動する
+        context = multiprocessing.get_context("spawn")
+        self.command_queue = context.Queue()
+        self.status_queue = context.Queue()
+        self.process = context.Process(target=run_acquisition, name="knee_acquisition", daemon=True,
+                                       args=(self.ring.name, self.command_queue, self.status_queue))
+        self.next_sample = 0  # 次に updateSignal で送るサンプルの番号
+        self.is_calibrated = False  # キャリブレーションの結果を受け取るまでは、サンプルを送らずに残しておく
+        self.num_of_dropped_samples = 0  # GUI が容量分より長く止まって読めなかったサンプルの数
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(POLL_INTERVAL)
+        self.poll_timer.timeout.connect(self.poll)
+
+    def start(self):
+        self.process.start()
+        self.poll_timer.start()
+
+    def stop(self):
+        self.poll_timer.stop()
+        if self.process.is_alive():
+            self.command_queue.put(("stop",))
+            self.process.join(STOP_TIMEOUT)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        if self.ring.samples is not None:
+            self.ring.close()
+            self.ring.unlink()
+
+    def set_gesture_params(self, **params):
+        self.command_queue.put(("gesture_params", params))
+
+    def start_raw_logging(self, file_path: str):
+        self.command_queue.put(("start_raw_logging", file_path))
+
+    def stop_raw_logging(self):
+        self.command_queue.put(("stop_raw_logging",))
+
+    def get_latest_sample(self):
+        return self.ring.read_latest()
+
+    def get_samples(self, start, stop):
+        # 共有メモリを参照する配列を返す（コピーしない）。使い終わったら ring.is_intact(start) で確かめる
+        return self.ring.get_views(max(start, stop - self.ring.capacity + 1, 0), stop)
+
+    def poll(self):
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            if status[0] == "calibration_progress":
+                self.calibrationProgressSignal.emit(status[1], status[2])
+            elif status[0] == "calibration_finished":
+                self.kneePosition.apply_calibration(status[1], status[2])
+                self.is_calibrated = True
+                self.calibrationFinishedSignal.emit(status[1], status[2])
+            elif status[0] == "device_connected":
+                self.deviceConnectedSignal.emit(status[1])
+            elif status[0] == "device_disconnected":
+                self.kneePosition.position_filter.reset()
+                self.deviceDisconnectedSignal.emit(status[1])
+            elif status[0] == "leg_presence":
+                self.legPresenceSignal.emit(status[1])
+            elif status[0] == "gesture":
+                self.gestureSignal.emit(status[1], status[2], status[3])
+
+        if not self.is_calibrated:
+            return
+
+        # 前に見てから届いたサンプルを順に送る（TimerThread の時と同じく、値ごとに1回ずつ）
+        for _ in range(READ_RETRIES):
+            count = self.ring.get_count()
+            start = max(self.next_sample, count - self.ring.capacity + 1)
+            samples = [sample for view in self.ring.get_views(start, count) for sample in view.tolist()]
+            if self.ring.is_intact(start):
+                break
+        else:
+            return
+        self.num_of_dropped_samples += start - self.next_sample
+        self.next_sample = count
+        for timestamp_ns, x, y in samples:
+            self.updateSignal.emit(x, y, timestamp_ns)
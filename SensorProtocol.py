@@ -0,0 +1,185 @@
+from enum import Enum
+
+import numpy as np
+
+# センサアレイから届くフレームの形式
+#   TEXT:   "12,13,...,64\r\n"（値は10進数、小数点可）
+#   BINARY: 同期(0xA5 0x5A), チャンネル数(uint8), 値(uint8 x チャンネル数), チェックサム(uint8)
+#           チェックサムはチャンネル数と値の和の下位8bit（高いサンプリングレート用のファームウェア）
+BINARY_SYNC = b"\xa5\x5a"
+MAX_BUFFERED_BYTES = 4096  # 区切りが見つからないままこれを越えたら、ゴミとして捨てる
+SMALL_BATCH_LINES = 48  # これより少ない行は1行ずつ変換する（配列の処理を準備する時間の方が長いため）
+MAX_EXPONENT = 15  # 桁の重みの表の範囲（10^-15 ... 10^15）
+
+LF = ord("\n")
+CR = ord("\r")
+SPACE = ord(" ")
+COMMA = ord(",")
+DOT = ord(".")
+ZERO = ord("0")
+TEXT_CHARACTERS = b"0123456789.,"
+POWERS_OF_TEN = 10.0 ** np.arange(-MAX_EXPONENT, MAX_EXPONENT + 1)
+
+
+class FramingMode(Enum):
+    TEXT = 0
+    BINARY = 1
+
+
+def make_binary_frame(values) -> bytes:
+    # 試験用・ファームウェアの参考用
+    payload = bytes([len(values)]) + bytes(int(v) for v in values)
+    return BINARY_SYNC + payload + bytes([sum(payload) & 0xff])
+
+
+def parse_text_lines(data: bytes, num_of_channels: int):
+    # parse_text_frames と同じ結果を1行ずつ求める（行が少ない時用）
+    frames = []
+    num_of_malformed = 0
+    for line in data.replace(b"\r", b"").replace(b" ", b"").split(b"\n")[:-1]:
+        if len(line) == 0:
+            continue
+        fields = line.split(b",")
+        if len(fields) != num_of_channels or len(line.translate(None, TEXT_CHARACTERS)) > 0:
+            num_of_malformed += 1
+            continue
+        try:
+            frames.append([float(field) for field in fields])
+        except ValueError:
+            num_of_malformed += 1  # 空の値や "1..2" など
+    return np.array(frames, dtype=np.float32).reshape(-1, num_of_channels), num_of_malformed
+
+
+def parse_text_frames(data: bytes, num_of_channels: int):
+    # 改行で終わる行を全てまとめて変換し、((N, num_of_channels) の float32, 壊れていた行の数) を返す
+    # 空行は数えない。文字列に分けず、バイト列のまま配列で処理する
+    if data.count(b"\n") < SMALL_BATCH_LINES:
+        return parse_text_lines(data, num_of_channels)
+    codes = np.frombuffer(data, dtype=np.uint8)
+    codes = codes[(codes != CR) & (codes != SPACE)]
+    is_line_end = codes == LF
+    codes = codes[~(is_line_end & np.concatenate([[True], is_line_end[:-1]]))]  # 空行を除く
+    if len(codes) == 0:
+        return np.empty((0, num_of_channels), dtype=np.float32), 0
+
+    is_line_end = codes == LF
+    is_separator = is_line_end | (codes == COMMA)
+    is_digit = (codes >= ZERO) & (codes <= ZERO + 9)
+    is_dot = codes == DOT
+
+    # 各バイトが何番目の値に、各値が何番目の行に入るか（区切りはその値の最後に数える）
+    field_end = np.flatnonzero(is_separator)
+    num_of_fields = len(field_end)
+    field = np.repeat(np.arange(num_of_fields, dtype=np.int32), np.diff(field_end, prepend=-1))
+    line_end = np.flatnonzero(codes[field_end] == LF)
+    num_of_lines = len(line_end)
+    field_line = np.repeat(np.arange(num_of_lines), np.diff(line_end, prepend=-1))
+
+    # 値の小数点の位置（無ければ区切りの位置）。小数点が2つ以上、数字が無い値は壊れている
+    digit_position = np.flatnonzero(is_digit)
+    digit_field = field[digit_position]
+    dot_count = np.bincount(field[is_dot], minlength=num_of_fields)
+    digit_count = np.bincount(digit_field, minlength=num_of_fields)
+    dot_position = field_end.copy()
+    dot_position[field[is_dot]] = np.flatnonzero(is_dot)
+
+    is_bad_field = (dot_count > 1) | (digit_count == 0)
+    is_bad_line = np.bincount(field_line[is_bad_field], minlength=num_of_lines) > 0
+    is_bad_line |= np.bincount(field_line[field[~(is_digit | is_dot | is_separator)]], minlength=num_of_lines) > 0
+    is_bad_line |= np.bincount(field_line, minlength=num_of_lines) != num_of_channels
+
+    # 数字ごとに桁の重みを掛けて値ごとに足す
+    exponent = dot_position[digit_field] - digit_position
+    exponent -= exponent > 0  # 小数点より前は 10^(n-1) ... 10^0、後ろは 10^-1 ...
+    weights = POWERS_OF_TEN[np.clip(exponent, -MAX_EXPONENT, MAX_EXPONENT) + MAX_EXPONENT]
+    values = np.bincount(digit_field, weights=(codes[digit_position] - ZERO) * weights, minlength=num_of_fields)
+
+    frames = values[~is_bad_line[field_line]].reshape(-1, num_of_channels).astype(np.float32)
+    return frames, int(np.count_nonzero(is_bad_line))
+
+
+def parse_binary_frames(data: bytes, num_of_channels: int):
+    # 同期パターンの候補を全て調べ、チャンネル数とチェックサムが合うものを重ならないように選ぶ
+    # ((N, num_of_channels) の float32, 壊れていたフレームの数, 使い終わったバイト数) を返す
+    codes = np.frombuffer(data, dtype=np.uint8)
+    frame_size = len(BINARY_SYNC) + num_of_channels + 2
+    if len(codes) < len(BINARY_SYNC):
+        return np.empty((0, num_of_channels), dtype=np.float32), 0, 0
+    starts = np.flatnonzero((codes[:-1] == BINARY_SYNC[0]) & (codes[1:] == BINARY_SYNC[1]))
+    complete = starts[starts + frame_size <= len(codes)]
+
+    frames = codes[complete[:, np.newaxis] + np.arange(frame_size)]
+    payload = frames[:, len(BINARY_SYNC):-1]
+    is_valid = (payload[:, 0] == num_of_channels) & \
+               ((payload.sum(axis=1, dtype=np.int64) & 0xff) == frames[:, -1])
+
+    accepted = []
+    end = 0
+    for i in np.flatnonzero(is_valid):
+        if complete[i] >= end:
+            accepted.append(i)
+            end = complete[i] + frame_size
+
+    # 選んだフレームの中に偶然ある同期パターンは数えない
+    accepted_starts = complete[accepted]
+    covering = np.searchsorted(accepted_starts, complete, side="right") - 1
+    is_covered = (covering >= 0) & (complete < accepted_starts[np.maximum(covering, 0)] + frame_size) \
+        if len(accepted_starts) > 0 else np.zeros(len(complete), dtype=bool)
+    num_of_malformed = int(np.count_nonzero(~is_valid & ~is_covered))
+
+    # まだ届いていないフレームの先頭（最後の同期パターンの候補か、最後の1byte）は次に回す
+    incomplete = starts[(starts + frame_size > len(codes)) & (starts >= end)]
+    if len(incomplete) > 0:
+        consumed = int(incomplete[0])
+    elif codes[-1] == BINARY_SYNC[0]:
+        consumed = len(codes) - 1
+    else:
+        consumed = len(codes)
+    return payload[accepted, 1:].astype(np.float32), num_of_malformed, consumed
+
+
+class SensorFrameParser():
+    # シリアルから読んだバイト列を feed で渡し、揃ったフレームを (N, チャンネル数) の配列で受け取る
+    # 壊れたフレームは例外にせず捨てて数える（num_of_malformed_frames）
+    def __init__(self, num_of_channels: int, mode=FramingMode.TEXT):
+        self.num_of_channels = num_of_channels
+        self.mode = mode
+        self.num_of_frames = 0
+        self.num_of_malformed_frames = 0
+        self.reset()
+
+    def reset(self, skip_frames=0):
+        # 接続し直した時など、途中から読み始める時に呼ぶ（最初の skip_frames フレームは捨てる）
+        self.buffer = b""
+        self.is_synchronized = self.mode == FramingMode.BINARY  # TEXT では最初の改行までを捨てる
+        self.skip_frames = skip_frames
+
+    def feed(self, data: bytes):
+        buffer = self.buffer + data
+        if not self.is_synchronized:
+            line_end = buffer.find(b"\n")
+            if line_end < 0:
+                self.buffer = buffer[-MAX_BUFFERED_BYTES:]
+                return np.empty((0, self.num_of_channels), dtype=np.float32)
+            buffer = buffer[line_end + 1:]
+            self.is_synchronized = True
+
+        if self.mode == FramingMode.TEXT:
+            line_end = buffer.rfind(b"\n")
+            frames, num_of_malformed = parse_text_frames(buffer[:line_end + 1], self.num_of_channels)
+            self.buffer = buffer[line_end + 1:]
+        else:
+            frames, num_of_malformed, consumed = parse_binary_frames(buffer, self.num_of_channels)
+            self.buffer = buffer[consumed:]
+
+        if len(self.buffer) > MAX_BUFFERED_BYTES:
+            self.buffer = b""
+            num_of_malformed += 1
+        self.num_of_malformed_frames += num_of_malformed
+
+        if self.skip_frames > 0:
+            skipped = min(self.skip_frames, len(frames))
+            self.skip_frames -= skipped
+            frames = frames[skipped:]
+        self.num_of_frames += len(frames)
+        return frames
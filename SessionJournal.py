@@ -0,0 +1,99 @@
+import datetime
+import glob
+import json
+import os
+import queue
+import threading
+
+JOURNAL_DIR = "result_paint_experiment/journal/"
+GROUP_COMMIT_INTERVAL = 0.05  # この時間[s]に届いた操作をまとめて書き込む
+
+
+# 1行に1つの操作を JSON で書く追記専用のファイル
+# 正常に終了した時だけ最後に {"op": "close"} を書くので、それが無いファイルは復元の対象になる
+class SessionJournal():
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.file = open(file_path, "a", encoding="utf-8")
+        if self.file.tell() > 0 and not is_terminated_with_newline(file_path):
+            self.file.write("\n")  # 途中で落ちて欠けた行の後ろに続けない
+
+        # GUI スレッドではキューに入れるだけにして、書き込みと fsync は別スレッドでまとめて行う
+        self.operations = queue.Queue()
+        self.writer_thread = threading.Thread(target=self.write_operations, daemon=True)
+        self.writer_thread.start()
+
+    def append(self, op: str, **data):
+        data["op"] = op
+        self.operations.put(json.dumps(data, separators=(',', ':')))
+
+    def write_operations(self):
+        is_closed = False
+        while not is_closed:
+            lines = [self.operations.get()]
+            try:
+                # 最初の操作から GROUP_COMMIT_INTERVAL の間に届いたものを同じ書き込みに入れる
+                while True:
+                    lines.append(self.operations.get(timeout=GROUP_COMMIT_INTERVAL))
+                    if lines[-1] is None:
+                        break
+            except queue.Empty:
+                pass
+            if lines[-1] is None:
+                lines.pop()
+                is_closed = True
+            if len(lines) > 0:
+                self.file.write("\n".join(lines) + "\n")
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self, is_finished=True):
+        if self.file is None:
+            return
+        if is_finished:
+            self.append("close")
+        self.operations.put(None)
+        self.writer_thread.join()
+        self.file.close()
+        self.file = None
+
+
+def make_journal_path(journal_dir=JOURNAL_DIR):
+    try:
+        os.makedirs(journal_dir)
+    except FileExistsError:
+        pass
+    date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(journal_dir, "session_{}.jsonl".format(date))
+
+
+def read_journal(file_path: str):
+    # 途中で落ちた時の欠けた行は読み飛ばす
+    with open(file_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def is_terminated_with_newline(file_path: str):
+    with open(file_path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def is_finished_journal(file_path: str):
+    with open(file_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 64))
+        lines = f.read().splitlines()
+    return len(lines) > 0 and lines[-1].strip() == b'{"op":"close"}'
+
+
+def find_unfinished_journal(journal_dir=JOURNAL_DIR):
+    # 最も新しいジャーナルが正常に終わっていなければ、そのパスを返す
+    file_paths = sorted(glob.glob(os.path.join(journal_dir, "session_*.jsonl")))
+    if len(file_paths) == 0 or is_finished_journal(file_paths[-1]):
+        return None
+    return file_paths[-1]
@@ -1,15 +1,18 @@
 import os
-import sys, serial, random, time, datetime
+import sys, random, datetime
 import numpy as np
 
-from PyQt5.QtCore import QRect, Qt, QPointF
-from PyQt5.QtGui import QPaintEvent, QPainter, QKeyEvent, QKeySequence
+from PyQt5.QtCore import QRect, QRectF, Qt, QPointF
+from PyQt5.QtGui import QPaintEvent, QPainter, QKeyEvent, QKeySequence, QPixmap
 from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QMenuBar, QStatusBar, QAction
 
 import KneePosition
+import StepQuantizer
+import Timing
 
 steps = 5
 participant_No = 3
+is_recording_raw_sensor = False  # 膝センサの生の値も記録する
 
 
 class MainWindow(QMainWindow):
@@ -18,25 +21,27 @@ class MainWindow(QMainWindow):
         self.setupUi()
         self.show()
         self.current_knee_step = 0
+        self.raw_knee_step = 0
+        self.step_quantizer = StepQuantizer.StepQuantizer(steps, 0, 360)
         self.target_step = 5
         self.current_order = 0
         self.is_horizontal = False
         self.is_current_step_visible = True
         self.calibration_position = QPointF(0, 0)
 
-        try:
-            self.timer_thread = KneePosition.TimerThread()
-            self.timer_thread.updateSignal.connect(self.control_params_with_knee)
-            self.timer_thread.start()
-            self.kneePosition = self.timer_thread.kneePosition
-            self.calibration_position = QPointF(self.kneePosition.knee_pos_x_center, self.kneePosition.knee_pos_y_center)
-
-        except serial.serialutil.SerialException as e:
-            pass
-            # self.statusbar.showMessage("膝操作が無効：シリアル通信が確保できていません。原因：" + str(e))
+        self.timer_thread = KneePosition.TimerThread()
+        self.timer_thread.updateSignal.connect(self.control_params_with_knee)
+        self.timer_thread.calibrationProgressSignal.connect(self.knee_calibration_progressed)
+        self.timer_thread.calibrationFinishedSignal.connect(self.knee_calibration_finished)
+        self.timer_thread.deviceConnectedSignal.connect(self.knee_device_connected)
+        self.timer_thread.deviceDisconnectedSignal.connect(self.knee_device_disconnected)
+        self.kneePosition = self.timer_thread.kneePosition
+        self.timer_thread.start()
 
         self.rectangles = []
         self.rect_orders = []
+        self.grid_pixmap = None  # 段階の枠を描いておく画像（段階数・向き・大きさが変わった時だけ作り直す）
+        self.grid_pixmap_key = None
         self.setup_rect(steps)
         self.setup_experiment()
 
@@ -68,25 +73,54 @@ class MainWindow(QMainWindow):
         switch_current_step_visible_action.setShortcut(QKeySequence("Ctrl+V"))
         switch_current_step_visible_action.triggered.connect(self.switch_current_step_visible)
 
+        switch_vertical_and_horizontal_action = QAction("縦/横の切り替え", self)
+        switch_vertical_and_horizontal_action.setShortcut(QKeySequence("Ctrl+H"))
+        switch_vertical_and_horizontal_action.triggered.connect(self.switch_vertical_and_horizontal)
+
         operation_menus = self.menubar.addMenu("experiments")
         operation_menus.addAction(start_experiment_action)
         operation_menus.addAction(save_records_action)
+        operation_menus.addAction(switch_vertical_and_horizontal_action)
 
-    # def switch_vertical_and_horizontal(self):
-    #     self.is_horizontal = not self.is_horizontal
-    #     self.setup_rect(steps)
-    #     self.centralwidget.update()
-    #     self.update()
+    def switch_vertical_and_horizontal(self):
+        if not self.is_started_experiment:
+            self.is_horizontal = not self.is_horizontal
+            self.setup_rect(steps)
+            self.step_quantizer.reset()
+            self.update()
 
     def setup_rect(self, num_of_rects: int):
+        self.rectangles = []
         if self.is_horizontal:
             rect_width = 1080 / num_of_rects
             for i in range(num_of_rects):
-                self.rectangles.append(QRect(100 + rect_width * i, 260, rect_width, 100))
+                left = 100 + round(rect_width * i)
+                self.rectangles.append(QRect(left, 260, 100 + round(rect_width * (i + 1)) - left, 100))
         else:
             rect_height = 620 / num_of_rects
             for i in range(num_of_rects):
-                self.rectangles.append(QRect(540, 50 + rect_height * i, 100, rect_height))
+                top = 50 + round(rect_height * i)
+                self.rectangles.append(QRect(540, top, 100, 50 + round(rect_height * (i + 1)) - top))
+        self.grid_pixmap_key = None
+
+    def get_grid_pixmap(self):
+        device_pixel_ratio = self.devicePixelRatioF()
+        key = (len(self.rectangles), self.is_horizontal, self.width(), self.height(), device_pixel_ratio)
+        if self.grid_pixmap_key != key:
+            self.grid_pixmap = QPixmap(round(self.width() * device_pixel_ratio),
+                                       round(self.height() * device_pixel_ratio))
+            self.grid_pixmap.setDevicePixelRatio(device_pixel_ratio)
+            self.grid_pixmap.fill(Qt.transparent)
+            painter = QPainter(self.grid_pixmap)
+            for rect in self.rectangles:
+                painter.drawRect(rect)
+            painter.end()
+            self.grid_pixmap_key = key
+        return self.grid_pixmap
+
+    def get_update_rect(self, step: int):
+        # 枠線の分だけ広げる
+        return self.rectangles[step].adjusted(0, 0, 1, 1)
 
     def setup_experiment(self):
         # UIのsetup
@@ -111,19 +145,26 @@ class MainWindow(QMainWindow):
         self.operation_times      = np.empty((steps * 3), dtype=float)
         self.offsets              = np.empty((steps * 3), dtype=int)
         self.current_position     = QPointF(0, 0)
+        self.current_position_time_ns = None  # current_position のセンサの値を読んだ時刻（まだ届いていない時は None）
 
-        # タイマー
+        # タイマー（start_time は Timing.now_ns の値[ns]、previous_operated_time は計測開始からの秒）
         self.start_time    = 0
         self.previous_operated_time = 0
 
         self.is_started_experiment = False
 
-        self.frame_records     = np.empty((0, 3), float) # 操作ごとの記録
-        self.operation_records = np.empty((0, 5), float) # フレーム（膝位置が更新される）ごとの記録
+        # 1行はタプルで、列は save_records のヘッダの順
+        self.frame_records     = [] # 操作ごとの記録
+        self.operation_records = [] # フレーム（膝位置が更新される）ごとの記録
 
     def start_experiment(self):
-        self.start_time            = time.time()
+        self.start_time            = Timing.now_ns()
         self.is_started_experiment = True
+        self.update(self.get_update_rect(self.current_knee_step))  # 見えない条件では現在の段階を消す
+
+        if is_recording_raw_sensor:
+            date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.kneePosition.start_raw_logging(self.make_result_dir() + "test_rawSensor_{}.bin".format(date))
 
         self.statusbar.showMessage("Experiment started p{}, {}, steps_{}, step_{}"
                                        .format(participant_No,
@@ -137,76 +178,124 @@ class MainWindow(QMainWindow):
 
     def record_frame(self):
         if self.is_started_experiment:
-            current_time   = time.time()  - self.start_time
-            self.frame_records = np.append(self.frame_records, np.array(
-                                                [[self.current_position.x(),
-                                                 self.current_position.y(),
-                                                 current_time]]
-                                          ), axis=0)
+            current_time_ns = Timing.now_ns() - self.start_time
+            self.frame_records.append((self.current_position.x(),
+                                       self.current_position.y(),
+                                       Timing.to_seconds(current_time_ns),
+                                       self.raw_knee_step,
+                                       self.current_knee_step,
+                                       Timing.next_sequence(),
+                                       current_time_ns,
+                                       self.get_knee_time_ns()))
+
+    def get_knee_time_ns(self):
+        # 膝の値がまだ届いていない時は -1（列は整数で書き出すため NaN は使わない）
+        if self.current_position_time_ns is None:
+            return -1
+        return self.current_position_time_ns - self.start_time
 
     def record_operation(self):
-        current_time = time.time() - self.start_time
+        current_time_ns = Timing.now_ns() - self.start_time
+        current_time = Timing.to_seconds(current_time_ns)
 
         operation_times = current_time - self.previous_operated_time
         offsets         = self.current_knee_step - self.rect_orders[self.current_order]
 
-        self.operation_records = np.append(self.operation_records, np.array(
-                                            [[self.current_position.x(),
-                                             self.current_position.y(),
-                                             operation_times,
-                                             self.current_knee_step,
-                                             self.rect_orders[self.current_order]]]
-                                      ), axis=0)
+        self.operation_records.append((self.current_position.x(),
+                                       self.current_position.y(),
+                                       operation_times,
+                                       self.current_knee_step,
+                                       self.rect_orders[self.current_order],
+                                       Timing.next_sequence(),
+                                       current_time_ns,
+                                       self.get_knee_time_ns()))
         self.previous_operated_time = current_time
         self.statusbar.showMessage(str(current_time))
 
+    def make_result_dir(self):
+        file_path = "result_preliminary/p{}/{}/steps_{}/step_{}".format(participant_No,
+                                                                 ("horizontal" if self.is_horizontal
+                                                                                  else "vertical"),
+                                                                 steps,
+                                                                 ("visible" if self.is_current_step_visible
+                                                                                  else "invisible")
+                                                                )
+        try:
+            os.makedirs(file_path)
+        except FileExistsError:
+            pass
+        return file_path
+
     def save_records(self):
         date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         if not self.is_started_experiment:
-            file_path = "result_preliminary/p{}/{}/steps_{}/step_{}".format(participant_No,
-                                                                     ("horizontal" if self.is_horizontal
-                                                                                      else "vertical"),
-                                                                     steps,
-                                                                     ("visible" if self.is_current_step_visible
-                                                                                      else "invisible")
-                                                                    )
-            try:
-                os.makedirs(file_path)
-            except FileExistsError:
-                pass
-
-            np.savetxt(file_path + "test_frameRecords_{}.csv".format(date), self.frame_records, delimiter=',',
-                       fmt=['%.5f', '%.5f', '%.5f'],
-                       header='knee_pos_x, knee_pos_y, time',
+            file_path = self.make_result_dir()
+
+            # 時刻[ns]の列（計測開始 start_ns からの時間）は桁が落ちないよう int のまま書き出す
+            # knee_time_ns はその行の膝の位置のセンサの値を読んだ時刻（膝の値がまだ無い行は -1）
+            np.savetxt(file_path + "test_frameRecords_{}.csv".format(date),
+                       np.array(self.frame_records, dtype=object).reshape(-1, 8), delimiter=',',
+                       fmt=['%.5f', '%.5f', '%.5f', '%.0f', '%.0f', '%d', '%d', '%d'],
+                       header='knee_pos_x, knee_pos_y, time, raw_step, quantized_step, sequence, time_ns, knee_time_ns, '
+                              'start_ns:{}, filter:{}, step_hysteresis:{}, step_dwell_time:{}'
+                                .format(self.start_time, self.kneePosition.position_filter.describe(),
+                                        self.step_quantizer.hysteresis, self.step_quantizer.dwell_time),
                        comments=' ')
-            np.savetxt(file_path + "test_operationRecords_{}.csv".format(date), self.operation_records, delimiter=',',
-                       fmt=['%.5f', '%.5f', '%.5f', '%.0f', '%.0f'],
-                       header="knee_pos_x, knee_pos_y, time, selected_No, target_No, calibration x:{} y:{}"
-                                .format(self.kneePosition.knee_pos_x_center, self.kneePosition.knee_pos_y_center),
+            np.savetxt(file_path + "test_operationRecords_{}.csv".format(date),
+                       np.array(self.operation_records, dtype=object).reshape(-1, 8), delimiter=',',
+                       fmt=['%.5f', '%.5f', '%.5f', '%.0f', '%.0f', '%d', '%d', '%d'],
+                       header="knee_pos_x, knee_pos_y, time, selected_No, target_No, sequence, time_ns, knee_time_ns, "
+                              "start_ns:{}, calibration x:{} y:{}, filter:{}"
+                                .format(self.start_time, self.kneePosition.knee_pos_x_center,
+                                        self.kneePosition.knee_pos_y_center,
+                                        self.kneePosition.position_filter.describe()),
                        comments=' ')
             self.statusbar.showMessage("Saved.")
 
     def switch_current_step_visible(self):
         if not self.is_started_experiment:
             self.is_current_step_visible = not self.is_current_step_visible
+            self.update(self.get_update_rect(self.current_knee_step))
 
-    def control_params_with_knee(self, x, y):
+    def knee_device_connected(self, port):
+        self.statusbar.showMessage("Connected: {}".format(port))
+
+    def knee_device_disconnected(self, reason):
+        self.statusbar.showMessage("Disconnected, waiting for the sensor: {}".format(reason))
+
+    def knee_calibration_progressed(self, frame, total_frames):
+        self.statusbar.showMessage("Calibrating knee position: {}/{}".format(frame, total_frames))
+
+    def knee_calibration_finished(self, x, y):
+        self.calibration_position = QPointF(x, y)
+        self.statusbar.showMessage("Calibrated with x: {:.2f}, y: {:.2f}".format(x, y))
+
+    def control_params_with_knee(self, x, y, timestamp_ns):
+        # timestamp_ns: センサの値を読んだ時刻（GUI スレッドに届いた時刻ではない）
         self.current_position.setX(x)
         self.current_position.setY(y)
-        self.record_frame()
+        self.current_position_time_ns = timestamp_ns
         x, y = self.kneePosition.get_mapped_positions(x, y, 1, 359)
-        if self.is_horizontal:
-            self.current_knee_step = (int)(x / (360 / steps))
-        else:
-            self.current_knee_step = steps - (int)(y / (360 / steps)) - 1
+
+        # 段階の境界でのぶれを抑えるため、ヒステリシスと滞留時間をもって段階を確定する
+        self.step_quantizer.is_reversed = not self.is_horizontal
+        previous_knee_step = self.current_knee_step
+        is_step_changed = self.step_quantizer.update(x if self.is_horizontal else y, Timing.to_seconds(timestamp_ns))
+        self.current_knee_step = self.step_quantizer.step
+        self.raw_knee_step = self.step_quantizer.raw_step
+        self.record_frame()
 
         # status_str = "x: " + str(x) + "y: " + str(y)
         # self.statusbar.showMessage(status_str)
-        self.update()
+        if is_step_changed:
+            # 状態が変わった2つの段階だけ再描画する
+            self.update(self.get_update_rect(previous_knee_step))
+            self.update(self.get_update_rect(self.current_knee_step))
 
     def keyPressEvent(self, keyevent: QKeyEvent):
         if keyevent.key() == Qt.Key_Return:
             if self.is_started_experiment:
+                previous_target_step = self.rect_orders[self.current_order % 20]
                 self.record_operation()
                 self.current_order = self.current_order + 1
 
@@ -214,24 +303,38 @@ class MainWindow(QMainWindow):
                     self.statusbar.showMessage("End. Save data with Cmd+S.")
                     self.is_started_experiment = False
                     self.current_order = 0
+                    self.kneePosition.stop_raw_logging()
+                    self.update()  # 現在の段階の表示が変わることがあるので全体を描き直す
 
+                else:
+                    self.update(self.get_update_rect(previous_target_step))
+                    self.update(self.get_update_rect(self.rect_orders[self.current_order % 20]))
 
-        self.update()
+    def closeEvent(self, event):
+        self.timer_thread.stop()
+        super().closeEvent(event)
 
     def paintEvent(self, event: QPaintEvent):
         painter = QPainter(self)
+        update_rect = event.rect()
 
-        for rect in self.rectangles:
-            painter.drawRect(rect)
+        # 枠は画像から必要な範囲だけ写す
+        device_pixel_ratio = self.devicePixelRatioF()
+        painter.drawPixmap(QRectF(update_rect), self.get_grid_pixmap(),
+                           QRectF(update_rect.x() * device_pixel_ratio, update_rect.y() * device_pixel_ratio,
+                                  update_rect.width() * device_pixel_ratio, update_rect.height() * device_pixel_ratio))
 
         # ターゲットの段階
-        painter.setBrush(Qt.green)
-        painter.drawRect(self.rectangles[self.rect_orders[self.current_order % 20]])
+        target_rect = self.rectangles[self.rect_orders[self.current_order % 20]]
+        if target_rect.intersects(update_rect):
+            painter.setBrush(Qt.green)
+            painter.drawRect(target_rect)
 
         # 現在の段階
-        if self.is_current_step_visible or not self.is_started_experiment:
+        current_rect = self.rectangles[self.current_knee_step]
+        if (self.is_current_step_visible or not self.is_started_experiment) and current_rect.intersects(update_rect):
             painter.setBrush(Qt.blue)
-            painter.drawRect(self.rectangles[self.current_knee_step])
+            painter.drawRect(current_rect)
 
 
 if __name__ == '__main__':
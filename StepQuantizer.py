@@ -0,0 +1,67 @@
+HYSTERESIS = 0.2  # 段階の幅に対する割合。境界をこれだけ越えるまでは段階を変えない
+DWELL_TIME = 0.03  # 新しい段階にこの時間[s]留まったら確定する
+
+
+class StepQuantizer():
+    def __init__(self, steps: int, lower_limit=0.0, upper_limit=360.0, hysteresis=HYSTERESIS,
+                 dwell_time=DWELL_TIME, is_reversed=False):
+        self.lower_limit = lower_limit
+        self.upper_limit = upper_limit
+        self.hysteresis = hysteresis
+        self.dwell_time = dwell_time
+        self.is_reversed = is_reversed  # True の時は大きい値ほど小さい段階になる（縦並び）
+        self.set_steps(steps)
+
+    def set_steps(self, steps: int):
+        self.steps = steps
+        self.step_width = (self.upper_limit - self.lower_limit) / steps
+        self.reset()
+
+    def reset(self):
+        self.index = None  # 確定している段階（反転前）
+        self.raw_index = None
+        self.pending_index = None
+        self.pending_since = 0.0
+
+    def get_index(self, position):
+        index = int((position - self.lower_limit) / self.step_width)
+        return min(max(index, 0), self.steps - 1)
+
+    def to_step(self, index):
+        if index is None:
+            return None
+        return self.steps - index - 1 if self.is_reversed else index
+
+    @property
+    def step(self):
+        return self.to_step(self.index)
+
+    @property
+    def raw_step(self):
+        return self.to_step(self.raw_index)
+
+    def update(self, position, timestamp):
+        # 確定している段階が変わったら True を返す
+        self.raw_index = self.get_index(position)
+        if self.index is None:
+            self.index = self.raw_index
+            return True
+
+        margin = self.hysteresis * self.step_width
+        current_lower = self.lower_limit + self.index * self.step_width - margin
+        current_upper = self.lower_limit + (self.index + 1) * self.step_width + margin
+        if current_lower <= position < current_upper:
+            self.pending_index = None
+            return False
+
+        # 今の段階から出ている時間を測る（速く動かした時に途中の段階で待たされないよう、行き先は最新の値を使う）
+        if self.pending_index is None:
+            self.pending_since = timestamp
+        self.pending_index = self.raw_index
+
+        if timestamp - self.pending_since >= self.dwell_time:
+            self.index = self.pending_index
+            self.pending_index = None
+            return True
+
+        return False
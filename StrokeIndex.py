@@ -0,0 +1,201 @@
+import numpy as np
+
+MAX_ENTRIES = 16  # ノード1つに入れる矩形の最大数
+MIN_ENTRIES = 6  # これより少なくなったノードは解体して入れ直す
+
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def area(rect):
+    return (rect[2] - rect[0]) * (rect[3] - rect[1])
+
+
+def get_distance_to_polylines(polylines, x, y):
+    # 折れ線（(N, 2) の配列のリスト）と点 (x, y) の最短距離
+    point = np.array([x, y], dtype=float)
+    distance = np.inf
+    for polyline in polylines:
+        if len(polyline) == 0:
+            continue
+        if len(polyline) == 1:
+            distance = min(distance, float(np.hypot(*(polyline[0] - point))))
+            continue
+        start = polyline[:-1]
+        segment = polyline[1:] - start
+        length = np.einsum('ij,ij->i', segment, segment)
+        t = np.einsum('ij,ij->i', point - start, segment) / np.where(length > 0, length, 1.0)
+        closest = start + segment * np.clip(t, 0.0, 1.0)[:, np.newaxis]
+        distance = min(distance, float(np.min(np.hypot(closest[:, 0] - x, closest[:, 1] - y))))
+    return distance
+
+
+class RTreeNode():
+    def __init__(self, is_leaf: bool):
+        self.is_leaf = is_leaf
+        self.entries = []  # [矩形, 線の番号（葉）または子ノード]
+        self.parent = None
+
+    def get_bounds(self):
+        bounds = self.entries[0][0]
+        for rect, _ in self.entries[1:]:
+            bounds = union(bounds, rect)
+        return bounds
+
+
+class StrokeRTree():
+    # 線の外接矩形 (left, top, right, bottom) を R-tree に登録し、矩形と交わる線を探す
+    def __init__(self, max_entries=MAX_ENTRIES, min_entries=MIN_ENTRIES):
+        self.max_entries = max_entries
+        self.min_entries = min_entries
+        self.clear()
+
+    def __len__(self):
+        return len(self.rects)
+
+    def clear(self):
+        self.root = RTreeNode(True)
+        self.rects = {}
+        self.leaf_of = {}  # 線の番号 -> 入っている葉
+
+    def get_rect(self, stroke_id):
+        return self.rects.get(stroke_id)
+
+    def insert(self, stroke_id, rect):
+        self.rects[stroke_id] = rect
+        node = self.root
+        while not node.is_leaf:
+            # 広げる面積が最も小さい子を選ぶ（同じなら面積が小さい方）
+            node = min(node.entries, key=lambda entry: (area(union(entry[0], rect)) - area(entry[0]),
+                                                        area(entry[0])))[1]
+        node.entries.append([rect, stroke_id])
+        self.leaf_of[stroke_id] = node
+        self.adjust(node)
+
+    def remove(self, stroke_id):
+        if self.rects.pop(stroke_id, None) is None:
+            return
+        leaf = self.leaf_of.pop(stroke_id)
+        leaf.entries = [entry for entry in leaf.entries if entry[1] != stroke_id]
+        self.condense(leaf)
+
+    def update(self, stroke_id, rect):
+        if self.rects.get(stroke_id) == rect:
+            return
+        self.remove(stroke_id)
+        self.insert(stroke_id, rect)
+
+    def query(self, rect):
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for entry_rect, item in node.entries:
+                if intersects(entry_rect, rect):
+                    if node.is_leaf:
+                        found.append(item)
+                    else:
+                        stack.append(item)
+        return found
+
+    def adjust(self, node):
+        # 溢れたノードを分割しながら、根まで親の矩形を更新する
+        while True:
+            sibling = self.split(node) if len(node.entries) > self.max_entries else None
+            parent = node.parent
+            if parent is None:
+                if sibling is not None:
+                    self.root = RTreeNode(False)
+                    for child in (node, sibling):
+                        child.parent = self.root
+                        self.root.entries.append([child.get_bounds(), child])
+                return
+
+            for entry in parent.entries:
+                if entry[1] is node:
+                    entry[0] = node.get_bounds()
+                    break
+            if sibling is not None:
+                sibling.parent = parent
+                parent.entries.append([sibling.get_bounds(), sibling])
+            node = parent
+
+    def split(self, node):
+        # 二次分割：一緒にすると最も無駄な面積が出る2つを種にして振り分ける
+        entries = node.entries
+        seeds = (0, 1)
+        worst_waste = None
+        for i in range(len(entries)):
+            for j in range(i + 1, len(entries)):
+                waste = area(union(entries[i][0], entries[j][0])) - area(entries[i][0]) - area(entries[j][0])
+                if worst_waste is None or waste > worst_waste:
+                    worst_waste = waste
+                    seeds = (i, j)
+
+        groups = [[entries[seeds[0]]], [entries[seeds[1]]]]
+        bounds = [entries[seeds[0]][0], entries[seeds[1]][0]]
+        remaining = [entry for k, entry in enumerate(entries) if k not in seeds]
+        while remaining:
+            for g in range(2):
+                if len(groups[g]) + len(remaining) <= self.min_entries:
+                    groups[g].extend(remaining)
+                    remaining = []
+                    break
+            if not remaining:
+                break
+
+            # どちらに入れるかの差が最も大きいものから振り分ける
+            growths = [(area(union(bounds[0], entry[0])) - area(bounds[0]),
+                        area(union(bounds[1], entry[0])) - area(bounds[1])) for entry in remaining]
+            k = max(range(len(remaining)), key=lambda k: abs(growths[k][0] - growths[k][1]))
+            entry = remaining.pop(k)
+            g = 0 if (growths[k][0], area(bounds[0]), len(groups[0])) <= \
+                     (growths[k][1], area(bounds[1]), len(groups[1])) else 1
+            groups[g].append(entry)
+            bounds[g] = union(bounds[g], entry[0])
+
+        node.entries = groups[0]
+        sibling = RTreeNode(node.is_leaf)
+        sibling.entries = groups[1]
+        for _, item in sibling.entries:
+            if node.is_leaf:
+                self.leaf_of[item] = sibling
+            else:
+                item.parent = sibling
+        return sibling
+
+    def condense(self, node):
+        # 少なくなったノードを木から外し、その中の線を入れ直す
+        orphans = []
+        while node.parent is not None:
+            parent = node.parent
+            if len(node.entries) < self.min_entries:
+                parent.entries = [entry for entry in parent.entries if entry[1] is not node]
+                orphans.append(node)
+            else:
+                for entry in parent.entries:
+                    if entry[1] is node:
+                        entry[0] = node.get_bounds()
+                        break
+            node = parent
+
+        while not self.root.is_leaf and len(self.root.entries) == 1:
+            self.root = self.root.entries[0][1]
+            self.root.parent = None
+        if not self.root.is_leaf and len(self.root.entries) == 0:
+            self.root = RTreeNode(True)
+
+        for orphan in orphans:
+            stack = [orphan]
+            while stack:
+                node = stack.pop()
+                for rect, item in node.entries:
+                    if node.is_leaf:
+                        self.insert(item, rect)
+                    else:
+                        stack.append(item)
@@ -0,0 +1,170 @@
+import math
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QRectF, QRunnable, QThreadPool, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QPainter
+
+TILE_SIZE = 256  # タイル1枚の大きさ[デバイスピクセル]
+MAX_TILES = 64  # レイヤ1枚あたりに残しておくタイルの数
+
+
+class TileRenderTask(QRunnable):
+    # prepare が GUI スレッドで作った paint(painter, is_cancelled) をワーカスレッドで実行する
+    def __init__(self, cache, key, paint):
+        super().__init__()
+        self.cache = cache
+        self.key = key
+        self.paint = paint
+        self.is_cancelled = False
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def run(self):
+        if self.is_cancelled:
+            return
+        pixel_scale, tile_x, tile_y = self.key
+        image = QImage(TILE_SIZE, TILE_SIZE, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)  # ドラッグ中の線以外はタイルから綺麗に描く
+        painter.translate(-tile_x * TILE_SIZE, -tile_y * TILE_SIZE)
+        painter.scale(pixel_scale, pixel_scale)
+        self.paint(painter, lambda: self.is_cancelled)
+        painter.end()
+        if not self.is_cancelled:
+            self.cache.tileRenderedSignal.emit(self.key, self, image)
+
+
+class TileCache(QObject):
+    # 拡大率ごとにレイヤを TILE_SIZE 四方のタイルに分け、スレッドプールで描いておく
+    # prepare(document_rect) は GUI スレッドで呼ばれ、その時点の内容を写した
+    # paint(painter, is_cancelled) を返す（paint はレイヤの状態に触れてはいけない）
+    # budget（MemoryBudget）を渡すと、全レイヤのタイルの合計の大きさも使われていない順に抑える
+    tileUpdatedSignal = pyqtSignal(QRectF)  # 描き終わったタイルの範囲（ドキュメント座標）
+    tileRenderedSignal = pyqtSignal(object, object, QImage)  # ワーカスレッドから GUI スレッドへ渡すため
+
+    def __init__(self, prepare, document_size, max_tiles=MAX_TILES, thread_pool=None, budget=None, parent=None):
+        super().__init__(parent)
+        self.prepare = prepare
+        self.document_size = document_size
+        self.max_tiles = max_tiles
+        self.budget = budget
+        self.thread_pool = thread_pool if thread_pool is not None else QThreadPool.globalInstance()
+        self.tiles = OrderedDict()  # (拡大率, tx, ty) -> QImage
+        self.stale_keys = set()  # 描き直しが必要だが、新しいタイルができるまで表示しておくタイル
+        self.pending_tasks = {}  # (拡大率, tx, ty) -> 描画中の TileRenderTask
+        self.tileRenderedSignal.connect(self.tile_rendered)
+
+    def clear(self):
+        self.cancel_all()
+        if self.budget is not None:
+            for key in self.tiles:
+                self.budget.discard(self, key)
+        self.tiles.clear()
+        self.stale_keys.clear()
+
+    def evict(self, key):
+        # MemoryBudget から呼ばれる（表示する時にまた描く）
+        self.tiles.pop(key, None)
+        self.stale_keys.discard(key)
+
+    def get_memory_usage(self) -> int:
+        return sum(image.sizeInBytes() for image in self.tiles.values())
+
+    def cancel_all(self):
+        for task in self.pending_tasks.values():
+            task.cancel()
+        self.pending_tasks.clear()
+
+    def get_tile_document_rect(self, key):
+        pixel_scale, tile_x, tile_y = key
+        size = TILE_SIZE / pixel_scale
+        return QRectF(tile_x * size, tile_y * size, size, size)
+
+    def invalidate(self, document_rect=None):
+        # 古いタイルは新しいタイルができるまで表示し、描画中の古い内容の仕事は取り消す
+        if document_rect is None:
+            self.stale_keys.update(self.tiles)
+            self.cancel_all()
+            return
+        for key in self.tiles:
+            if self.get_tile_document_rect(key).intersects(document_rect):
+                self.stale_keys.add(key)
+        for key in [key for key in self.pending_tasks if self.get_tile_document_rect(key).intersects(document_rect)]:
+            self.pending_tasks.pop(key).cancel()
+
+    def get_visible_tiles(self, view_rect, scale, origin, device_pixel_ratio):
+        pixel_scale = scale * device_pixel_ratio
+        left = (origin.x() * scale + view_rect.left()) * device_pixel_ratio
+        top = (origin.y() * scale + view_rect.top()) * device_pixel_ratio
+        right = (origin.x() * scale + view_rect.right() + 1) * device_pixel_ratio
+        bottom = (origin.y() * scale + view_rect.bottom() + 1) * device_pixel_ratio
+
+        # ドキュメントの外のタイルは描かない
+        right = min(right, self.document_size.width() * pixel_scale)
+        bottom = min(bottom, self.document_size.height() * pixel_scale)
+        for tile_y in range(max(0, math.floor(top / TILE_SIZE)), math.ceil(bottom / TILE_SIZE)):
+            for tile_x in range(max(0, math.floor(left / TILE_SIZE)), math.ceil(right / TILE_SIZE)):
+                yield pixel_scale, tile_x, tile_y
+
+    def request_tile(self, key):
+        if key in self.pending_tasks:
+            return
+        # 取り消しには Python 側の属性だけを使う（C++ 側はスレッドプールが実行後に消す）
+        task = TileRenderTask(self, key, self.prepare(self.get_tile_document_rect(key)))
+        self.pending_tasks[key] = task
+        self.thread_pool.start(task)
+
+    def tile_rendered(self, key, task, image):
+        if self.pending_tasks.get(key) is not task:
+            return  # 描いている間に内容が変わった
+        del self.pending_tasks[key]
+        self.tiles[key] = image
+        self.tiles.move_to_end(key)
+        self.stale_keys.discard(key)
+        while len(self.tiles) > self.max_tiles:
+            old_key, _ = self.tiles.popitem(last=False)
+            self.stale_keys.discard(old_key)
+            if self.budget is not None:
+                self.budget.discard(self, old_key)
+        if self.budget is not None:
+            self.budget.add(self, key, image.sizeInBytes())
+        self.tileUpdatedSignal.emit(self.get_tile_document_rect(key))
+
+    def draw_fallback(self, painter, key, target):
+        # 新しい拡大率のタイルができるまで、他の拡大率のタイルを拡大・縮小して表示する
+        document_rect = self.get_tile_document_rect(key)
+        target_scale = target.width() / document_rect.width()
+        for other_key, image in self.tiles.items():
+            if other_key[0] == key[0]:
+                continue
+            other_rect = self.get_tile_document_rect(other_key)
+            overlap = other_rect.intersected(document_rect)
+            if overlap.isEmpty():
+                continue
+            source = QRectF((overlap.left() - other_rect.left()) * other_key[0],
+                            (overlap.top() - other_rect.top()) * other_key[0],
+                            overlap.width() * other_key[0], overlap.height() * other_key[0])
+            painter.drawImage(QRectF(target.left() + (overlap.left() - document_rect.left()) * target_scale,
+                                     target.top() + (overlap.top() - document_rect.top()) * target_scale,
+                                     overlap.width() * target_scale, overlap.height() * target_scale),
+                              image, source)
+
+    def draw(self, painter, view_rect, scale, origin, device_pixel_ratio):
+        # 表示範囲 view_rect（ウィジェット座標）と交わるタイルだけ描く
+        tile_size = TILE_SIZE / device_pixel_ratio
+        for key in list(self.get_visible_tiles(view_rect, scale, origin, device_pixel_ratio)):
+            _, tile_x, tile_y = key
+            target = QRectF(tile_x * tile_size - origin.x() * scale, tile_y * tile_size - origin.y() * scale,
+                            tile_size, tile_size)
+            image = self.tiles.get(key)
+            if image is None or key in self.stale_keys:
+                self.request_tile(key)
+            if image is None:
+                self.draw_fallback(painter, key, target)
+            else:
+                self.tiles.move_to_end(key)
+                if self.budget is not None:
+                    self.budget.touch(self, key)
+                painter.drawImage(target, image)
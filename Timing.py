@@ -0,0 +1,34 @@
+import threading
+import time
+
+# 記録に使う時刻はすべて time.perf_counter_ns（単調増加・整数[ns]）にそろえる
+# センサのスレッドで読んだ時刻と GUI スレッドで記録した時刻を同じ時間軸で比べられるようにするため
+now_ns = time.perf_counter_ns
+
+sequence_lock = threading.Lock()
+next_sequence_number = 0
+
+
+def next_sequence():
+    # 全ての記録に通しで付ける番号（記録の種類やファイルをまたいで順序を復元できる）
+    global next_sequence_number
+    with sequence_lock:
+        sequence = next_sequence_number
+        next_sequence_number += 1
+    return sequence
+
+
+def get_sequence():
+    with sequence_lock:
+        return next_sequence_number
+
+
+def set_sequence(sequence: int):
+    # 入力の再生で、記録した時と同じ番号から始めるため
+    global next_sequence_number
+    with sequence_lock:
+        next_sequence_number = sequence
+
+
+def to_seconds(duration_ns: int) -> float:
+    return duration_ns / 1e9
@@ -0,0 +1,156 @@
+import os
+import re
+import sys
+from xml.sax.saxutils import escape, quoteattr
+
+from PyQt5.QtCore import QMarginsF, QPointF, QRectF, QSizeF, Qt
+from PyQt5.QtGui import QColor, QGuiApplication, QImage, QPageSize, QPainter, QPainterPath, QPdfWriter, QPen
+
+DOCUMENT_WIDTH = 2400  # paintSoft の DOCUMENT_SIZE と同じ
+DOCUMENT_HEIGHT = 2400
+PEN_WIDTH = 2
+POINT_PATTERN = re.compile(r"\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*\)")
+
+
+# レイヤは (名前, 画像のファイル名, 線) のタプルで渡す
+# 線は (QPainterPath, QColor, 太さ) を1本ずつ返すイテラブルで、書き出しながら読み進める
+# （全ての線をメモリに載せないため、レイヤは順番に1度だけ読む）
+
+def get_svg_path_data(path: QPainterPath) -> str:
+    commands = []
+    i = 0
+    while i < path.elementCount():
+        element = path.elementAt(i)
+        if element.isMoveTo():
+            commands.append("M{:.2f} {:.2f}".format(element.x, element.y))
+            i += 1
+        elif element.isLineTo():
+            commands.append("L{:.2f} {:.2f}".format(element.x, element.y))
+            i += 1
+        else:
+            # CurveToElement の後に制御点の CurveToDataElement が2つ続く
+            control = path.elementAt(i + 1)
+            end = path.elementAt(i + 2)
+            commands.append("C{:.2f} {:.2f} {:.2f} {:.2f} {:.2f} {:.2f}"
+                            .format(element.x, element.y, control.x, control.y, end.x, end.y))
+            i += 3
+    return "".join(commands)
+
+
+class SvgStreamWriter():
+    def __init__(self, file_path: str, width=DOCUMENT_WIDTH, height=DOCUMENT_HEIGHT):
+        self.file = open(file_path, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                        'width="{0}" height="{1}" viewBox="0 0 {0} {1}">\n'.format(width, height))
+        self.width = width
+        self.height = height
+
+    def begin_layer(self, name: str, picture_file_name=""):
+        # id に使えない文字（canvas[0] の括弧など）は置き換え、元の名前は title に残す
+        self.file.write('<g id={} fill="none" stroke-linecap="square" stroke-linejoin="bevel">\n<title>{}</title>\n'
+                        .format(quoteattr(re.sub(r"[^\w-]", "_", name)), escape(name)))
+        if picture_file_name:
+            self.file.write('<image x="0" y="0" width="{}" height="{}" preserveAspectRatio="none" xlink:href={}/>\n'
+                            .format(self.width, self.height, quoteattr(os.path.abspath(picture_file_name))))
+
+    def write_stroke(self, path: QPainterPath, color: QColor, width):
+        opacity = ' stroke-opacity="{:.3f}"'.format(color.alphaF()) if color.alpha() < 255 else ''
+        self.file.write('<path d="{}" stroke="{}" stroke-width="{}"{}/>\n'
+                        .format(get_svg_path_data(path), color.name(), width, opacity))
+
+    def end_layer(self):
+        self.file.write('</g>\n')
+
+    def close(self):
+        self.file.write('</svg>\n')
+        self.file.close()
+
+
+class PdfStreamWriter():
+    # 1ページに全てのレイヤを重ねて描く（1単位 = 1pt）
+    def __init__(self, file_path: str, width=DOCUMENT_WIDTH, height=DOCUMENT_HEIGHT):
+        self.writer = QPdfWriter(file_path)
+        self.writer.setResolution(72)
+        self.writer.setPageSize(QPageSize(QSizeF(width, height), QPageSize.Point, "", QPageSize.ExactMatch))
+        self.writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+        self.painter = QPainter(self.writer)
+        self.painter.setBrush(Qt.NoBrush)
+        self.width = width
+        self.height = height
+
+    def begin_layer(self, name: str, picture_file_name=""):
+        if picture_file_name:
+            picture = QImage(picture_file_name)
+            if not picture.isNull():
+                self.painter.drawImage(QRectF(0, 0, self.width, self.height), picture)
+
+    def write_stroke(self, path: QPainterPath, color: QColor, width):
+        self.painter.setPen(QPen(color, width))
+        self.painter.drawPath(path)
+
+    def end_layer(self):
+        pass
+
+    def close(self):
+        self.painter.end()
+
+
+def open_writer(file_path: str, width=DOCUMENT_WIDTH, height=DOCUMENT_HEIGHT):
+    if os.path.splitext(file_path)[1].lower() == ".pdf":
+        return PdfStreamWriter(file_path, width, height)
+    return SvgStreamWriter(file_path, width, height)
+
+
+def export_layers(file_path: str, layers, width=DOCUMENT_WIDTH, height=DOCUMENT_HEIGHT):
+    # 拡張子（.svg / .pdf）で形式を選び、書き出した線の数を返す
+    writer = open_writer(file_path, width, height)
+    num_of_strokes = 0
+    try:
+        for name, picture_file_name, strokes in layers:
+            writer.begin_layer(name, picture_file_name)
+            for path, color, pen_width in strokes:
+                writer.write_stroke(path, color, pen_width)
+                num_of_strokes += 1
+            writer.end_layer()
+    finally:
+        writer.close()
+    return num_of_strokes
+
+
+# -- points_record.txt からの書き出し --
+def get_stroke_path(points) -> QPainterPath:
+    # paintSoft の RoundedPolygon と同じ曲線（確定時と同じく終点を重ねてから作る）
+    from paintSoft import RoundedPolygon
+    return RoundedPolygon(10000).get_path(points + [points[-1]])
+
+
+def read_points_record(file_path: str, color=QColor(Qt.black), pen_width=PEN_WIDTH):
+    # save_all_points_and_paths の形式を1行ずつ読む（色は記録されていないので color を使う）
+    with open(file_path) as f:
+        layer_index = 0
+        for line in f:
+            if line.strip() == "[":
+                yield "canvas{}".format(layer_index), "", read_points_record_strokes(f, color, pen_width)
+                layer_index += 1
+
+
+def read_points_record_strokes(f, color, pen_width):
+    for line in f:
+        line = line.strip()
+        if line.startswith("]"):
+            return
+        points = [QPointF(float(x), float(y)) for x, y in POINT_PATTERN.findall(line)]
+        if len(points) >= 2:  # 1点だけの線はパスにならない
+            yield get_stroke_path(points), color, pen_width
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("usage: python VectorExport.py points_record.txt output.svg|output.pdf")
+        sys.exit(1)
+    if os.path.splitext(sys.argv[2])[1].lower() == ".pdf":
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # 画面が無くても書き出せるように
+        app = QGuiApplication(sys.argv)
+    num_of_strokes = export_layers(sys.argv[2], read_points_record(sys.argv[1]))
+    print("exported: {} strokes".format(num_of_strokes))
@@ -1,22 +1,49 @@
+import bisect
 import datetime
 import os
-import sys, math, serial
+import sys, math
 import time
 
+import ColorField
+import ImageLoader
+import InputRecorder
+import KneeGesture
 import KneePosition
+import LayerScrubber
+import MemoryBudget
+import SensorProcess
+import SessionJournal
+import StrokeIndex
+import TileCache
+import Timing
+import VectorExport
 from PyQt5.QtCore import Qt, QPoint, QPointF, QRect, QSize, QMetaObject, QCoreApplication, QAbstractTableModel, \
     QModelIndex, QTimer, QThread, QObject, pyqtSignal, QRectF
-from PyQt5.QtGui import QPainter, QPainterPath, QPolygon, QMouseEvent, QImage, qRgb, QPalette, QColor, QPaintEvent, \
-    QPixmap, QDragLeaveEvent, QDragMoveEvent, QKeySequence, QPen
+from PyQt5.QtGui import QPainter, QPainterPath, QPolygon, QPolygonF, QMouseEvent, QImage, qRgb, QPalette, QColor, \
+    QPaintEvent, QPixmap, QDragLeaveEvent, QDragMoveEvent, QKeySequence, QPen, QTransform, QWheelEvent, QFont
 from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QVBoxLayout, QSlider, QTableView, QMenuBar, QStatusBar, \
     QPushButton, QTextEdit, QAbstractItemView, QFileDialog, QLabel, QToolButton, QColorDialog, QRadioButton, QAction, \
-    QDialog
+    QDialog, QMessageBox
 import PyQt5.sip
 import numpy as np
 from enum import Enum
 
 participant_No = 0
 
+CANVAS_VIEW_RECT = QRect(0, 0, 600, 600)  # レイヤを表示する範囲（ウィンドウ内）
+DOCUMENT_SIZE = QSize(2400, 2400)  # 描画できる範囲（ドキュメント座標）
+MINIMUM_VIEW_SCALE = 0.25
+MAXIMUM_VIEW_SCALE = 8.0
+VIEW_SCALE_STEP = 1.25
+SELECT_DISTANCE = 8  # 線を選択できるカーソルからの距離[画面上のpx]
+ERASER_RADIUS = 10  # 消しゴムの半径[画面上のpx]
+NEAREST_POINT_DISTANCE = 20  # 制御点を動かせるカーソルからの距離（ドキュメント座標）
+INTERACTION_IDLE_TIME = 150  # ドラッグ中の入力がこの時間[ms]途切れたら、動かした線をタイルに戻して綺麗に描き直す
+LIVE_STROKE_TOLERANCE = 1.5  # ドラッグ中に直接描く線を間引く間隔[画面上のpx]
+is_recording_raw_sensor = False  # 膝センサの生の値も記録する
+is_acquiring_in_process = False  # 膝センサの読み込みを別プロセスで行い、共有メモリで受け取る（SensorProcess）
+is_journaling = True  # 操作をジャーナルに記録し、落ちた時に復元する
+
 
 class OperationMode(Enum):
     NONE = 0
@@ -24,6 +51,20 @@ class OperationMode(Enum):
     MOVING_POINTS = 2
     SWITCH_LAYER = 3
     COLOR_PICKER = 4
+    SELECTING_STROKES = 5
+    ERASING_STROKES = 6
+
+
+# 膝操作のモードごとの、モードを切り替えるジェスチャと判定のパラメータ（KneeGestureRecognizer.set_params）
+# 膝の上下で値を選ぶモードでは、上限を少し越えただけで切り替わらないようにする
+KNEE_SWITCH_GESTURES = {
+    OperationMode.MOVING_POINTS: KneeGesture.GestureType.TAP,
+    OperationMode.COLOR_PICKER: KneeGesture.GestureType.HOLD,
+}
+KNEE_GESTURE_PARAMS = {
+    OperationMode.MOVING_POINTS: {"lift_margin": 3.0},
+    OperationMode.COLOR_PICKER: {"lift_margin": 4.0, "hold_time": 0.4},
+}
 
 
 # 任意の点を通る曲線を描くためのパスを作る
@@ -99,24 +140,36 @@ class RoundedPolygon(QPolygon):
         return m_path
 
 
+class LayerEntry():
+    def __init__(self, name: str, is_visible=True):
+        self.name = name
+        self.is_visible = is_visible
+
+
 class CanvasNameTableModel(QAbstractTableModel):
+    # 行 = レイヤ（MainWindow.canvas と同じ順）。変更は行ごとに通知し、表全体を作り直さない
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.canvas_name: List[str] = ["canvas[0]"]
-        self.is_visible: List[bool] = [True]
+        self.layers: List[LayerEntry] = [LayerEntry("canvas[0]")]
+        self.active_row = 0  # 太字で表示する操作レイヤ
 
     def rowCount(self, parent=None):
-        return len(self.canvas_name)
+        return len(self.layers)
 
     def columnCount(self, parent=None):
         return 2
 
     def data(self, index: QModelIndex, role: int):
+        layer = self.layers[index.row()]
         if role == Qt.DisplayRole:
             if index.column() == 0:
-                return self.canvas_name[index.row()]
+                return layer.name
             elif index.column() == 1:
-                return "O" if self.is_visible[index.row()] else "X"
+                return "O" if layer.is_visible else "X"
+        elif role == Qt.FontRole and index.row() == self.active_row:
+            font = QFont()
+            font.setBold(True)
+            return font
 
     def headerData(self, section: int, orientation: int, role: int):
         if role == Qt.DisplayRole & orientation == Qt.Horizontal:
@@ -127,21 +180,48 @@ class CanvasNameTableModel(QAbstractTableModel):
         else:
             return ""
 
-    def add_canvas(self, canvasName: str):
-        self.canvas_name.append(canvasName)
-        self.is_visible.append(True)
+    def get_name(self, row: int):
+        return self.layers[row].name
+
+    def is_visible(self, row: int):
+        return self.layers[row].is_visible
 
-    def set_canvas_visible(self, index: int, to: bool):
-        self.is_visible[index] = to
-        return self.is_visible[index]
+    def insert_layer(self, row: int, name: str):
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.layers.insert(row, LayerEntry(name))
+        self.endInsertRows()
 
-    def delete_last_canvas(self):
-        self.canvas_name.pop()
-        self.is_visible.pop()
+    def remove_layer(self, row: int):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.layers[row]
+        self.endRemoveRows()
+
+    def move_layer(self, row: int, to_row: int):
+        # beginMoveRows の移動先は「移動前の行番号で、この行の前に入れる」で指定する
+        if row == to_row:
+            return
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), to_row + 1 if to_row > row else to_row)
+        self.layers.insert(to_row, self.layers.pop(row))
+        self.endMoveRows()
+
+    def set_canvas_visible(self, row: int, to: bool):
+        if self.layers[row].is_visible != to:
+            self.layers[row].is_visible = to
+            self.dataChanged.emit(self.index(row, 1), self.index(row, 1))
+        return to
+
+    def set_active_row(self, row: int):
+        previous_row = self.active_row
+        self.active_row = row
+        for changed_row in {previous_row, row}:
+            if changed_row < len(self.layers):
+                self.dataChanged.emit(self.index(changed_row, 0), self.index(changed_row, 1))
 
 
 class Canvas(QWidget):
-    def __init__(self, parent=None):
+    contentChangedSignal = pyqtSignal()  # 線や画像が変わった（サムネイルの描き直し用）
+
+    def __init__(self, parent=None, tile_budget=None):
         super(Canvas, self).__init__(parent)
 
         self.is_enable_knee_control = False
@@ -150,7 +230,7 @@ class Canvas(QWidget):
         # 1度Trueになったら2度とFalseにならないことを意図する
         self.is_picture_canvas = False
         self.picture_file_name = ""
-        self.image = QImage()
+        self.picture_image = QImage()  # ドキュメントの大きさに変換済みの画像
 
         # マウストラック有効化
         self.setMouseTracking(True)
@@ -165,7 +245,7 @@ class Canvas(QWidget):
 
         self.existing_paths = []  # 確定したパスを保存
         self.recorded_points = []  # 確定した点を保存（実験の記録用）
-        self.clicked_points = []  # 今描いている線の制御点を記録
+        self.clicked_points = []  # 今描いている線の制御点を記録（ドキュメント座標）
         self.cursor_position = QPointF()
         self.cursor_position_mousePressed = QPointF()
         self.knee_position = QPointF()
@@ -179,20 +259,86 @@ class Canvas(QWidget):
         self.nearest_path = QPainterPath()
         self.nearest_distance = 50.0
         self.nearest_index = 0
+        self.nearest_stroke = -1  # nearest_path の existing_paths での位置
         self.is_dragging = False
 
         self.pen_width = 2
 
+        # 表示範囲（ドキュメント座標の origin がウィジェットの左上に来る）と拡大率
+        self.document_size = DOCUMENT_SIZE
+        self.view_scale = 1.0
+        self.view_origin = QPointF(0, 0)
+
+        # 線の外接矩形の索引と、拡大率ごとのタイル
+        self.stroke_ids = []  # existing_paths と同じ順に並べた線の番号
+        self.next_stroke_id = 0
+        self.stroke_index = StrokeIndex.StrokeRTree()
+        self.stroke_polylines = {}  # 線の番号 -> 折れ線に直したパス（距離の計算用）
+        self.selected_stroke = -1  # 選択中の線の番号
+
+        # 操作と入力の記録（MainWindow が設定する）
+        self.journal = None
+        self.input_recorder = None
+        self.layer_index = 0
+        self.tile_cache = TileCache.TileCache(self.prepare_render, self.document_size, budget=tile_budget, parent=self)
+        self.tile_cache.tileUpdatedSignal.connect(self.tile_updated)
+
+        # ドラッグ中の線はタイルから外し、アンチエイリアスなしで間引いて直接描く
+        # 入力が止まったらタイルを描き直し、できるまでは綺麗に描いた線を重ねておく（settling）
+        self.live_stroke_id = None
+        self.settling_stroke_id = None
+        self.live_rect = QRectF()  # ドラッグ中に線が通った範囲（ドキュメント座標）
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(INTERACTION_IDLE_TIME)
+        self.idle_timer.timeout.connect(self.end_live_stroke)
+
         self.show()
 
     def set_experiment_controller(self, excontroller):
         self.experiment_controller = excontroller
 
+    def record_operation(self, op: str, **data):
+        if self.journal is not None:
+            self.journal.append(op, layer=self.layer_index, **data)
+
+    # -- 表示範囲 --
+    def set_view(self, scale: float, origin: QPointF):
+        self.view_scale = scale
+        self.view_origin = QPointF(origin)
+        self.update()
+
+    def get_view_transform(self) -> QTransform:
+        transform = QTransform()
+        transform.scale(self.view_scale, self.view_scale)
+        transform.translate(-self.view_origin.x(), -self.view_origin.y())
+        return transform
+
+    def map_to_document(self, pos) -> QPoint:
+        return QPointF(self.view_origin.x() + pos.x() / self.view_scale,
+                       self.view_origin.y() + pos.y() / self.view_scale).toPoint()
+
+    def map_from_document_rect(self, document_rect: QRectF) -> QRect:
+        return self.get_view_transform().mapRect(document_rect).toAlignedRect().adjusted(-1, -1, 1, 1)
+
+    def get_stroke_rect(self, path: QPainterPath) -> QRectF:
+        # 制御点の円（半径3）と線の太さの分だけ広げる
+        margin = max(self.pen_width, 4)
+        return path.controlPointRect().adjusted(-margin, -margin, margin, margin)
+
+    def update_document_rect(self, document_rect: QRectF):
+        self.tile_cache.invalidate(document_rect)
+        self.update(self.map_from_document_rect(document_rect))
+        self.contentChangedSignal.emit()
+
     def mousePressEvent(self, event: QMouseEvent):
+        if self.input_recorder is not None:
+            self.input_recorder.record_mouse(self.layer_index, "press", event)
+        position = self.map_to_document(event.pos())
         if self.current_drawing_mode == OperationMode.DRAWING_POINTS:
             # 制御点の追加
             if event.button() == Qt.LeftButton:
-                self.clicked_points.append(event.pos())
+                self.clicked_points.append(position)
                 # print(self.clickedPoints)
 
             # 直前の制御点の消去
@@ -207,121 +353,357 @@ class Canvas(QWidget):
                 if self.is_enable_knee_control:
                     self.recode_knee_and_cursor_position()
 
-                self.cursor_position = event.pos()
+                self.cursor_position = position
                 self.update()
 
+        elif self.current_drawing_mode == OperationMode.SELECTING_STROKES:
+            if event.button() == Qt.LeftButton:
+                self.select_stroke_at(position)
+
+        elif self.current_drawing_mode == OperationMode.ERASING_STROKES:
+            if event.button() == Qt.LeftButton:
+                self.is_dragging = True
+                self.cursor_position = position
+                self.erase_strokes_at(position)
+
     def mouseMoveEvent(self, event: QMouseEvent):
-        self.experiment_controller.current_mouse_position = event.pos()
+        if self.input_recorder is not None:
+            self.input_recorder.record_mouse(self.layer_index, "move", event)
+        position = self.map_to_document(event.pos())
+        self.experiment_controller.current_mouse_position = position
         self.experiment_controller.record_frame(self.current_drawing_mode, self.current_knee_operation_mode)
         if self.current_drawing_mode == OperationMode.DRAWING_POINTS:
-            self.clicked_points.append(event.pos())
+            self.clicked_points.append(position)
             self.is_line_prediction = True
             self.update()
 
         elif self.current_drawing_mode == OperationMode.MOVING_POINTS:
-            print(self.nearest_distance)
-            self.cursor_position = event.pos()
+            # 最も近い点の強調はカーソルの近くにしか出ないので、カーソルの前後だけ描き直す
+            margin = NEAREST_POINT_DISTANCE + 4
+            cursor_rect = QRectF(self.cursor_position.x() - margin, self.cursor_position.y() - margin,
+                                 2 * margin, 2 * margin)
+            self.cursor_position = position
             if self.is_dragging:
                 self.move_point()
-            self.update()
+            self.update(self.map_from_document_rect(cursor_rect.united(cursor_rect.translated(
+                position.x() - cursor_rect.center().x(), position.y() - cursor_rect.center().y()))))
+
+        elif self.current_drawing_mode == OperationMode.ERASING_STROKES:
+            # 消しゴムの円の前後だけ描き直す
+            radius = ERASER_RADIUS / self.view_scale + 1
+            eraser_rect = QRectF(self.cursor_position.x() - radius, self.cursor_position.y() - radius,
+                                 2 * radius, 2 * radius)
+            self.cursor_position = position
+            self.update(self.map_from_document_rect(eraser_rect.united(eraser_rect.translated(
+                position.x() - eraser_rect.center().x(), position.y() - eraser_rect.center().y()))))
+            if self.is_dragging:
+                self.erase_strokes_at(position)
 
     def mouseReleaseEvent(self, event: QMouseEvent):
+        if self.input_recorder is not None:
+            self.input_recorder.record_mouse(self.layer_index, "release", event)
         self.is_dragging = False
+        self.end_live_stroke()
+
+    def prepare_render(self, document_rect: QRectF):
+        # タイルの描画の準備。document_rect と交わる線を写しておき、ワーカスレッドで描く関数を返す
+        if self.is_picture_canvas:
+            picture_image = self.picture_image
+
+            def paint_picture(painter: QPainter, is_cancelled):
+                painter.drawImage(document_rect, picture_image, document_rect)
+
+            return paint_picture
+
+        rect = (document_rect.left(), document_rect.top(), document_rect.right(), document_rect.bottom())
+        stroke_ids = sorted(stroke_id for stroke_id in self.stroke_index.query(rect)  # 番号順 = 描いた順
+                            if stroke_id != self.live_stroke_id)
+        strokes = [(QPainterPath(self.existing_paths[i]), QColor(self.__line_color[i]))
+                   for i in self.get_stroke_positions(stroke_ids)]
+        pen_width = self.pen_width
+        is_showing_control_points = self.current_drawing_mode == OperationMode.MOVING_POINTS
+
+        def paint_strokes(painter: QPainter, is_cancelled):
+            for path, color in strokes:
+                if is_cancelled():
+                    return
+                painter.setPen(QPen(color, pen_width))
+                painter.drawPath(path)
+
+            # すでに確定されているパスの制御点の描画
+            if is_showing_control_points:
+                painter.setPen(Qt.black)
+                painter.setBrush(Qt.NoBrush)
+                for path, _ in strokes:
+                    for j in range(path.elementCount()):
+                        painter.drawEllipse(QPointF(path.elementAt(j).x, path.elementAt(j).y), 3, 3)
+
+        return paint_strokes
+
+    def render_document(self, painter: QPainter, document_rect: QRectF):
+        # GUI スレッドでそのまま描く（保存用。タイルと同じくアンチエイリアスをかける）
+        painter.setRenderHint(QPainter.Antialiasing)
+        self.prepare_render(document_rect)(painter, lambda: False)
+
+    def tile_updated(self, document_rect: QRectF):
+        self.update(self.map_from_document_rect(document_rect))
+        if self.settling_stroke_id is not None and len(self.tile_cache.pending_tasks) == 0:
+            # 描き直したタイルに線が入ったので、重ねて描くのをやめる
+            self.settling_stroke_id = None
+            self.update(self.map_from_document_rect(self.live_rect))
+
+    def get_stroke_positions(self, stroke_ids):
+        # 線の番号から existing_paths での位置を求める（番号は昇順に並んでいる）
+        positions = []
+        for stroke_id in stroke_ids:
+            i = bisect.bisect_left(self.stroke_ids, stroke_id)
+            if i < len(self.stroke_ids) and self.stroke_ids[i] == stroke_id:
+                positions.append(i)
+        return positions
+
+    def update_nearest_point(self):
+        # 現在のカーソル位置から最も近い点と、その点が属するpathを記録、更新
+        self.nearest_distance = 50.0
+        x = self.cursor_position.x()
+        y = self.cursor_position.y()
+        near_rect = (x - self.nearest_distance, y - self.nearest_distance,
+                     x + self.nearest_distance, y + self.nearest_distance)
+        for i in self.get_stroke_positions(sorted(self.stroke_index.query(near_rect))):
+            path = self.existing_paths[i]
+            for j in range(path.elementCount()):
+                element = path.elementAt(j)
+                distance = math.sqrt((element.x - x) ** 2 + (element.y - y) ** 2)
+                if distance < self.nearest_distance:
+                    self.nearest_distance = distance
+                    self.nearest_path = path
+                    self.nearest_index = j
+                    self.nearest_stroke = i
 
     def paintEvent(self, event: QPaintEvent):
         # if not self.event_Locker:
         painter = QPainter(self)
 
+        # 確定した線（と画像）はタイルから描く
+        self.tile_cache.draw(painter, event.rect(), self.view_scale, self.view_origin, self.devicePixelRatioF())
+
         if self.is_picture_canvas:
-            painter.drawImage(QRect(0, 0, 600, 600), self.image)
+            return
+
+        painter.setTransform(self.get_view_transform())
+
+        # タイルから外している線（ドラッグ中は簡略化して、描き直し待ちの間は綺麗に描く）
+        stroke_id = self.live_stroke_id if self.live_stroke_id is not None else self.settling_stroke_id
+        positions = self.get_stroke_positions([stroke_id]) if stroke_id is not None else []
+        if len(positions) > 0:
+            path = self.existing_paths[positions[0]]
+            painter.setPen(QPen(self.__line_color[positions[0]], self.pen_width))
+            if self.live_stroke_id is not None:
+                for polygon in self.get_live_polygons(path):
+                    painter.drawPolyline(polygon)
+            else:
+                painter.setRenderHint(QPainter.Antialiasing)
+                painter.drawPath(path)
+                painter.setRenderHint(QPainter.Antialiasing, False)
+            if self.current_drawing_mode == OperationMode.MOVING_POINTS:
+                painter.setPen(Qt.black)
+                for j in range(path.elementCount()):
+                    painter.drawEllipse(QPointF(path.elementAt(j).x, path.elementAt(j).y), 3, 3)
 
-        else:
-            # すでに確定されているパスの描画
-            if len(self.existing_paths) > 0:
-                for i in range(len(self.existing_paths)):
-                    print("linecolor {}: {}".format(i, self.__line_color[i].hue()))
-                    painter.setPen(QPen(self.__line_color[i], self.pen_width))
-                    painter.drawPath(self.existing_paths[i])
+        if self.current_drawing_mode == OperationMode.DRAWING_POINTS:
+            # 　現在描いているパスの描画
+            if len(self.clicked_points) > 3:
+                painter.setPen(QPen(self.current_line_color, self.pen_width))
+                # print(self.clickedPoints)
+                # クリックした点まで線を伸ばすため、終点を一時的にリストに入れている
+                self.clicked_points.append(self.clicked_points[len(self.clicked_points) - 1])
+                painter_path = self.rounded_polygon.get_path(self.clicked_points)
 
-            if self.current_drawing_mode == OperationMode.DRAWING_POINTS:
-                # 　現在描いているパスの描画
-                if len(self.clicked_points) > 3:
-                    painter.setPen(QPen(self.current_line_color, self.pen_width))
-                    # print(self.clickedPoints)
-                    # クリックした点まで線を伸ばすため、終点を一時的にリストに入れている
-                    self.clicked_points.append(self.clicked_points[len(self.clicked_points) - 1])
-                    painter_path = self.rounded_polygon.get_path(self.clicked_points)
-
-                    # 設置した点の描画
-                    painter.setPen(Qt.black)
+                # 設置した点の描画
+                painter.setPen(Qt.black)
+                for i in range(len(self.clicked_points)):
+                    painter.drawEllipse(self.clicked_points[i], 2, 2)
+                painter.setPen(QPen(self.current_line_color, self.pen_width))
+                # 現在のマウス位置での予告線
+                if self.is_line_prediction:
+                    self.clicked_points.pop()
+                    self.is_line_prediction = False
+                painter.drawPath(painter_path)
+                self.clicked_points.pop()
+
+            # 線が描けない時
+            else:
+                # 現在のマウス位置での予告線
+                if self.is_line_prediction:
+                    painter.setPen(Qt.red)
                     for i in range(len(self.clicked_points)):
                         painter.drawEllipse(self.clicked_points[i], 2, 2)
-                    painter.setPen(QPen(self.current_line_color, self.pen_width))
-                    # 現在のマウス位置での予告線
-                    if self.is_line_prediction:
+                    if not len(self.clicked_points) == 0:
                         self.clicked_points.pop()
-                        self.is_line_prediction = False
-                    painter.drawPath(painter_path)
-                    self.clicked_points.pop()
+                    self.is_line_prediction = False
 
-                # 線が描けない時
+                # 予告線でもない場合は単に点を書く
                 else:
-                    # 現在のマウス位置での予告線
-                    if self.is_line_prediction:
-                        painter.setPen(Qt.red)
-                        for i in range(len(self.clicked_points)):
-                            painter.drawEllipse(self.clicked_points[i], 2, 2)
-                        if not len(self.clicked_points) == 0:
-                            self.clicked_points.pop()
-                        self.is_line_prediction = False
-
-                    # 予告線でもない場合は単に点を書く
-                    else:
-                        for i in range(len(self.clicked_points)):
-                            painter.drawEllipse(self.clicked_points[i], 2, 2)
-
-            # 制御点を移動するとき
-            elif self.current_drawing_mode == OperationMode.MOVING_POINTS:
-                # すでに確定されているパスの制御点の描画
-                self.nearest_distance = 50.0
-                painter.setPen(Qt.black)
-                for path in self.existing_paths:
-                    for i in range(path.elementCount()):
-                        control_point = QPointF(path.elementAt(i).x, path.elementAt(i).y)
-                        painter.drawEllipse(control_point, 3, 3)
-
-                        # 現在のカーソル位置から最も近い点と、その点が属するpathを記録、更新
-                        # if not self.is_dragging & self.is_enable_knee_control:
-                        distance = math.sqrt((control_point.x() - self.cursor_position.x()) ** 2 + (
-                                control_point.y() - self.cursor_position.y()) ** 2)
-                        if distance < self.nearest_distance:
-                            self.nearest_distance = distance
-                            self.nearest_path = path
-                            self.nearest_index = i
-
-                # 一定の距離未満かつ最も近い点を赤く描画
-                if self.nearest_distance < 20:
-                    painter.setPen(QPen(Qt.red, self.pen_width))
-                    nearest_control_point = QPointF(self.nearest_path.elementAt(self.nearest_index).x,
-                                                    self.nearest_path.elementAt(self.nearest_index).y)
-                    painter.drawEllipse(nearest_control_point, 3, 3)
+                    for i in range(len(self.clicked_points)):
+                        painter.drawEllipse(self.clicked_points[i], 2, 2)
+
+        # 制御点を移動するとき
+        elif self.current_drawing_mode == OperationMode.MOVING_POINTS:
+            self.update_nearest_point()
+
+            # 一定の距離未満かつ最も近い点を赤く描画
+            if self.nearest_distance < NEAREST_POINT_DISTANCE:
+                painter.setPen(QPen(Qt.red, self.pen_width))
+                nearest_control_point = QPointF(self.nearest_path.elementAt(self.nearest_index).x,
+                                                self.nearest_path.elementAt(self.nearest_index).y)
+                painter.drawEllipse(nearest_control_point, 3, 3)
+
+        elif self.current_drawing_mode == OperationMode.SELECTING_STROKES:
+            # 選択中の線を強調する
+            if self.selected_stroke >= 0:
+                i = self.get_stroke_positions([self.selected_stroke])[0]
+                painter.setPen(QPen(QColor(0, 120, 215, 120), self.pen_width + 4))
+                painter.drawPath(self.existing_paths[i])
+                painter.setPen(QPen(QColor(0, 120, 215), 0, Qt.DashLine))
+                painter.drawRect(self.get_stroke_rect(self.existing_paths[i]))
+
+        elif self.current_drawing_mode == OperationMode.ERASING_STROKES:
+            painter.setPen(QPen(Qt.gray, 0))
+            radius = ERASER_RADIUS / self.view_scale
+            painter.drawEllipse(QPointF(self.cursor_position), radius, radius)
+
+    def get_stroke_polylines(self, i):
+        stroke_id = self.stroke_ids[i]
+        polylines = self.stroke_polylines.get(stroke_id)
+        if polylines is None:
+            polylines = [np.array([(point.x(), point.y()) for point in polygon], dtype=float)
+                         for polygon in self.existing_paths[i].toSubpathPolygons()]
+            self.stroke_polylines[stroke_id] = polylines
+        return polylines
+
+    def get_strokes_at(self, position, radius):
+        # 外接矩形で候補を絞ってから、曲線までの距離で確かめる
+        # (existing_paths での位置, 距離) を描いた順に返す
+        x = position.x()
+        y = position.y()
+        margin = radius + self.pen_width / 2
+        strokes = []
+        for i in self.get_stroke_positions(sorted(self.stroke_index.query((x - margin, y - margin,
+                                                                           x + margin, y + margin)))):
+            distance = StrokeIndex.get_distance_to_polylines(self.get_stroke_polylines(i), x, y)
+            if distance <= margin:
+                strokes.append((i, distance))
+        return strokes
+
+    def select_stroke_at(self, position):
+        strokes = self.get_strokes_at(position, SELECT_DISTANCE / self.view_scale)
+        if len(strokes) > 0:
+            # 最も近い線（同じなら上に描かれている線）を選ぶ
+            i, _ = min(reversed(strokes), key=lambda stroke: stroke[1])
+            self.selected_stroke = self.stroke_ids[i]
+        else:
+            self.selected_stroke = -1
+        self.update()
+
+    def erase_strokes_at(self, position):
+        strokes = self.get_strokes_at(position, ERASER_RADIUS / self.view_scale)
+        for i, _ in reversed(strokes):
+            self.delete_stroke(i)
+
+    def replay_delete_stroke(self, stroke_id):
+        positions = self.get_stroke_positions([stroke_id])
+        if len(positions) > 0:
+            self.delete_stroke(positions[0])
+
+    def delete_selected_stroke(self):
+        if self.selected_stroke >= 0:
+            self.delete_stroke(self.get_stroke_positions([self.selected_stroke])[0])
 
     def move_point(self):
-        if self.is_enable_knee_control:
-            if self.nearest_distance < 20 or self.is_dragging:
-                self.nearest_path.setElementPositionAt(self.nearest_index, self.cursor_position.x(),
-                                                       self.cursor_position.y())
+        if self.nearest_stroke < 0:
+            return
+        old_rect = self.get_stroke_rect(self.nearest_path)
 
-                amount_of_change = QPointF(self.cursor_position.x() +
-                                           (self.knee_position.x() - self.knee_position_mousePressed.x()),
-                                           self.cursor_position.y() -
-                                           (self.knee_position.y() - self.knee_position_mousePressed.y()))
-                self.nearest_path.setElementPositionAt(self.nearest_index, amount_of_change.x(), amount_of_change.y())
+        # 近くに制御点が無い時は何もしない（ジャーナルにも書かず、線もタイルから外さない）
+        if self.is_enable_knee_control:
+            if not (self.nearest_distance < NEAREST_POINT_DISTANCE or self.is_dragging):
+                return
+            amount_of_change = QPointF(self.cursor_position.x() +
+                                       (self.knee_position.x() - self.knee_position_mousePressed.x()),
+                                       self.cursor_position.y() -
+                                       (self.knee_position.y() - self.knee_position_mousePressed.y()))
+            self.nearest_path.setElementPositionAt(self.nearest_index, amount_of_change.x(), amount_of_change.y())
 
         else:
-            if self.nearest_distance < 20:
-                self.nearest_path.setElementPositionAt(self.nearest_index, self.cursor_position.x(),
-                                                       self.cursor_position.y())
+            if not self.nearest_distance < NEAREST_POINT_DISTANCE:
+                return
+            self.nearest_path.setElementPositionAt(self.nearest_index, self.cursor_position.x(),
+                                                   self.cursor_position.y())
+
+        element = self.nearest_path.elementAt(self.nearest_index)
+        self.record_operation("move_point", stroke=self.stroke_ids[self.nearest_stroke], element=self.nearest_index,
+                              x=element.x, y=element.y)
+        self.live_stroke_moved(self.nearest_stroke, old_rect)
+
+    def live_stroke_moved(self, i, old_rect: QRectF):
+        # ドラッグ中はタイルを描き直さず、動かした線の前後の範囲だけを再描画する（ドキュメントの大きさによらない）
+        stroke_id = self.stroke_ids[i]
+        if self.live_stroke_id != stroke_id:
+            self.end_live_stroke()
+            self.live_stroke_id = stroke_id
+            self.settling_stroke_id = None
+            self.live_rect = QRectF(old_rect)
+            self.tile_cache.invalidate(old_rect)  # この線を除いたタイルにする
+
+        new_rect = self.get_stroke_rect(self.existing_paths[i])
+        self.stroke_polylines.pop(stroke_id, None)
+        self.stroke_index.update(stroke_id, (new_rect.left(), new_rect.top(), new_rect.right(), new_rect.bottom()))
+        self.live_rect = self.live_rect.united(new_rect)
+        self.update(self.map_from_document_rect(old_rect.united(new_rect)))
+        self.idle_timer.start()
+
+    def end_live_stroke(self):
+        self.idle_timer.stop()
+        if self.live_stroke_id is None:
+            return
+        self.settling_stroke_id = self.live_stroke_id
+        self.live_stroke_id = None
+        self.update_document_rect(self.live_rect)
+
+    def get_live_polygons(self, path: QPainterPath):
+        # 曲線を折れ線にし、画面上で LIVE_STROKE_TOLERANCE より近い点を間引く
+        tolerance = LIVE_STROKE_TOLERANCE / self.view_scale
+        polygons = []
+        for polygon in path.toSubpathPolygons():
+            points = np.array([(point.x(), point.y()) for point in polygon], dtype=float)
+            if len(points) > 2:
+                # 線に沿った長さが tolerance を越えるごとに1点だけ残す（始点と終点は残す）
+                length = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))])
+                kept = np.flatnonzero(np.diff(np.floor(length / tolerance)) > 0) + 1
+                points = points[np.unique(np.concatenate([[0], kept, [len(points) - 1]]))]
+            polygons.append(QPolygonF([QPointF(x, y) for x, y in points]))
+        return polygons
+
+    def stroke_moved(self, i, old_rect: QRectF):
+        # 索引を更新し、移動前後の範囲のタイルを描き直す
+        new_rect = self.get_stroke_rect(self.existing_paths[i])
+        self.stroke_polylines.pop(self.stroke_ids[i], None)
+        self.stroke_index.update(self.stroke_ids[i],
+                                 (new_rect.left(), new_rect.top(), new_rect.right(), new_rect.bottom()))
+        self.update_document_rect(old_rect.united(new_rect))
+
+    def replay_stroke(self, points, color):
+        self.current_line_color = QColor.fromRgba(color)
+        self.clicked_points = [QPoint(x, y) for x, y in points]
+        self.is_line_prediction = False
+        self.fix_path()
+
+    def replay_move_point(self, stroke_id, element, x, y):
+        positions = self.get_stroke_positions([stroke_id])
+        if len(positions) == 0:
+            return
+        old_rect = self.get_stroke_rect(self.existing_paths[positions[0]])
+        self.existing_paths[positions[0]].setElementPositionAt(element, x, y)
+        self.stroke_moved(positions[0], old_rect)
 
     def set_knee_position(self, x, y):
         self.knee_position.setX(x)
@@ -330,7 +712,6 @@ class Canvas(QWidget):
         if self.is_dragging:
             if self.current_drawing_mode == OperationMode.MOVING_POINTS:
                 self.move_point()
-                self.update()
 
     def set_line_color(self, color):
         self.current_line_color = color
@@ -349,23 +730,42 @@ class Canvas(QWidget):
             self.clicked_points.append(self.clicked_points[len(self.clicked_points) - 1])
             painter_path = self.rounded_polygon.get_path(self.clicked_points)
 
-            # 線と色を記録
+            # 線と色を記録（色はこの時点の値を写しておく）
             self.existing_paths.append(painter_path)
-            self.__line_color.append(self.current_line_color)
-            for i in range(len(self.__line_color)):
-                print("{}, {}".format(i, self.__line_color[i].value()))
+            self.__line_color.append(QColor(self.current_line_color))
             self.clicked_points.pop()
             self.recorded_points.append(self.clicked_points)
+            self.record_operation("stroke", points=[(point.x(), point.y()) for point in self.clicked_points],
+                                  color=self.current_line_color.rgba())
+
+            # 索引に登録
+            stroke_rect = self.get_stroke_rect(painter_path)
+            self.stroke_ids.append(self.next_stroke_id)
+            self.stroke_index.insert(self.next_stroke_id, (stroke_rect.left(), stroke_rect.top(),
+                                                           stroke_rect.right(), stroke_rect.bottom()))
+            self.next_stroke_id += 1
 
             # 点をリセット
             self.clicked_points = []
+            self.update_document_rect(stroke_rect)
             self.update()
 
     def delete_last_path(self):
         if len(self.existing_paths) > 0:
-            self.existing_paths.pop()
-            self.__line_color.pop()
-            self.update()
+            self.delete_stroke(len(self.existing_paths) - 1)
+
+    def delete_stroke(self, i):
+        # existing_paths の i 番目の線を消す
+        stroke_rect = self.get_stroke_rect(self.existing_paths.pop(i))
+        self.__line_color.pop(i)
+        stroke_id = self.stroke_ids.pop(i)
+        self.record_operation("delete_stroke", stroke=stroke_id)
+        self.stroke_index.remove(stroke_id)
+        self.stroke_polylines.pop(stroke_id, None)
+        if self.selected_stroke == stroke_id:
+            self.selected_stroke = -1
+        self.nearest_stroke = -1
+        self.update_document_rect(stroke_rect)
 
     def switch_visible(self, is_visible: bool):
         palette = self.palette()
@@ -376,6 +776,14 @@ class Canvas(QWidget):
         self.setPalette(palette)
 
     def operation_mode_changed(self, to_drawing: OperationMode, to_knee: OperationMode):
+        self.end_live_stroke()
+        # 制御点の表示が変わる時はタイルを描き直す
+        if (self.current_drawing_mode == OperationMode.MOVING_POINTS) != (to_drawing == OperationMode.MOVING_POINTS):
+            self.tile_cache.invalidate()
+            self.update()
+        if to_drawing != OperationMode.SELECTING_STROKES:
+            self.selected_stroke = -1
+        self.is_dragging = False
         self.current_drawing_mode = to_drawing
         self.current_knee_operation_mode = to_knee
         self.fix_path()
@@ -389,56 +797,149 @@ class Canvas(QWidget):
         self.is_enable_knee_control = is_enable_knee_control
 
     def load_picture(self, image: QImage):
-        self.image = image
+        # タイルを描くたびに変換しないよう、ドキュメントの大きさに合わせて一度だけ変換する
+        if image.size() != self.document_size:
+            image = image.scaled(self.document_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        if image.format() != QImage.Format_ARGB32_Premultiplied:
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        self.picture_image = image
         self.is_picture_canvas = True
+        self.tile_cache.invalidate()
         self.update()
+        self.contentChangedSignal.emit()
+
+    def iter_strokes(self):
+        # 書き出し用に (パス, 色, 太さ) を描いた順に返す
+        for path, color in zip(self.existing_paths, self.__line_color):
+            yield path, color, self.pen_width
+
+    def get_memory_usage(self):
+        # このレイヤが使っているおおよその大きさ[byte]（tiles は捨てても作り直せる）
+        num_of_points = sum(len(points) for points in self.recorded_points)
+        return {
+            "strokes": sum(MemoryBudget.get_path_bytes(path) for path in self.existing_paths) +
+                       len(self.existing_paths) * MemoryBudget.COLOR_BYTES +
+                       len(self.stroke_index) * MemoryBudget.INDEX_ENTRY_BYTES +
+                       sum(polyline.nbytes for polylines in self.stroke_polylines.values() for polyline in polylines),
+            "picture": MemoryBudget.get_image_bytes(self.picture_image),
+            "tiles": self.tile_cache.get_memory_usage(),
+            "recorded_points": num_of_points * MemoryBudget.POINT_BYTES,
+        }
+
+    def dispose(self):
+        # レイヤの削除。描画中のタイルを取り消し、線と画像を手放してから Qt 側も消す
+        self.idle_timer.stop()
+        self.live_stroke_id = None
+        self.settling_stroke_id = None
+        self.tile_cache.clear()
+        # 取り消す前に描き終わったタスクが tileRenderedSignal を送れるよう、タイルのキャッシュは Python 側で持つ
+        self.tile_cache.setParent(None)
+        self.existing_paths = []
+        self.__line_color = []
+        self.recorded_points = []
+        self.clicked_points = []
+        self.stroke_ids = []
+        self.stroke_index.clear()
+        self.stroke_polylines = {}
+        self.nearest_path = QPainterPath()
+        self.nearest_stroke = -1
+        self.picture_image = QImage()
+        self.journal = None
+        self.input_recorder = None
+        self.hide()
+        self.deleteLater()
+
+    def render_document_image(self, background=Qt.white) -> QImage:
+        # ドキュメント全体を等倍で画像にする（保存用）
+        image = QImage(self.document_size, QImage.Format_ARGB32_Premultiplied)
+        image.fill(background)
+        painter = QPainter(image)
+        self.render_document(painter, QRectF(0, 0, self.document_size.width(), self.document_size.height()))
+        painter.end()
+        return image
 
 
 class ExperimentController():
     def __init__(self):
         self.is_enabled_knee_control = False
+        self.knee_filter_description = ""
 
         # 取得する指標
         self.current_knee_position = QPointF(0, 0)
         self.current_mouse_position = QPointF(0, 0)
 
-        # タイマー
+        # タイマー（時刻は全て Timing.now_ns の値[ns]）
         self.start_time = 0
         self.previous_operated_time = 0
 
         self.is_started_experiment = False
 
-        self.frame_records = np.empty((0, 7), float)  # 操作ごとの記録
+        # 操作ごとの記録（1行はタプルで、列は save_records のヘッダの順）
+        self.frame_records = []
+        self.journal = None
+        self.clock = Timing.now_ns  # 入力の記録・再生の時は、入力ごとに決まった時刻を返す関数に差し替える
 
     def start_experiment(self):
-        self.start_time = time.time()
+        self.start_time = self.clock()
         self.is_started_experiment = True
+        if self.journal is not None:
+            # perf_counter_ns は再起動で0に戻るので、復元用に実時間も残す
+            self.journal.append("experiment_start", start_time=self.start_time, wall_time=time.time(),
+                                knee=self.is_enabled_knee_control, filter=self.knee_filter_description)
 
-    def record_frame(self, current_drawing_mode, current_knee_operation_mode):
+    def record_frame(self, current_drawing_mode, current_knee_operation_mode, event_time_ns=None):
+        # event_time_ns: 記録のきっかけになった入力の時刻（膝はセンサの値を読んだ時刻、マウスは処理した時刻）
         if self.is_started_experiment:
-            current_time = time.time() - self.start_time
-            self.frame_records = np.append(self.frame_records, np.array(
-                [[self.current_mouse_position.x(),
-                  self.current_mouse_position.y(),
-                  self.current_knee_position.x(),
-                  self.current_knee_position.y(),
-                  current_drawing_mode.value,
-                  current_knee_operation_mode.value,
-                  current_time]]
-            ), axis=0)
-
-    def save_records(self):
-        date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            current_time_ns = self.clock() - self.start_time
+            if event_time_ns is None:
+                event_time_ns = self.start_time + current_time_ns
+            frame = (self.current_mouse_position.x(),
+                     self.current_mouse_position.y(),
+                     self.current_knee_position.x(),
+                     self.current_knee_position.y(),
+                     current_drawing_mode.value,
+                     current_knee_operation_mode.value,
+                     Timing.to_seconds(current_time_ns),
+                     Timing.next_sequence(),
+                     current_time_ns,
+                     event_time_ns - self.start_time)
+            self.frame_records.append(frame)
+            if self.journal is not None:
+                self.journal.append("frame", values=frame)
+
+    def restore_experiment(self, frames, start_time=None, is_enabled_knee_control=False, knee_filter_description=""):
+        # ジャーナルから記録を戻す（start_time がある時は計測中だった）
+        self.frame_records = [tuple(frame) for frame in frames]
+        if len(self.frame_records) > 0:
+            Timing.set_sequence(max(Timing.get_sequence(), self.frame_records[-1][7] + 1))  # 番号を重複させない
+        if start_time is not None:
+            self.start_time = start_time
+            self.is_started_experiment = True
+            self.is_enabled_knee_control = is_enabled_knee_control
+            self.knee_filter_description = knee_filter_description
+
+    def make_result_dir(self):
         file_path = "result_paint_experiment/p{}/{}/".format(participant_No,
                                                              ("knee" if self.is_enabled_knee_control else "mouse"))
         try:
             os.makedirs(file_path)
         except FileExistsError:
             pass
+        return file_path
 
-        np.savetxt(file_path + "test_frameRecords_{}.csv".format(date), self.frame_records, delimiter=',',
-                   fmt=['%.0f', '%.0f', '%.5f', '%.5f', '%.0f', '%.0f', '%.5f'],
-                   header='mouse_pos_x, mouse_pos_y, knee_pos_x, knee_pos_y, drawing_mode, knee_operation_mode, time',
+    def save_records(self):
+        date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_path = self.make_result_dir()
+
+        # 時刻[ns]の列は float にすると桁が落ちるので、Python の int のまま書き出す
+        # （time_ns, event_time_ns は計測開始 start_ns からの時間）
+        np.savetxt(file_path + "test_frameRecords_{}.csv".format(date),
+                   np.array(self.frame_records, dtype=object).reshape(-1, 10), delimiter=',',
+                   fmt=['%.0f', '%.0f', '%.5f', '%.5f', '%.0f', '%.0f', '%.5f', '%d', '%d', '%d'],
+                   header='mouse_pos_x, mouse_pos_y, knee_pos_x, knee_pos_y, drawing_mode, knee_operation_mode, time, '
+                          'sequence, time_ns, event_time_ns, start_ns:{}'.format(self.start_time)
+                          + (', filter:{}'.format(self.knee_filter_description)
+                             if self.is_enabled_knee_control else ''),
                    comments=' ')
 
 
@@ -483,14 +984,32 @@ class MainWindow(QMainWindow):
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
         self.experiment_controller = ExperimentController()
+        # 作り直せるキャッシュの上限[byte]。set_budget で変えると、使われていないものから捨てる
+        self.memory_budgets = {
+            "tiles": MemoryBudget.MemoryBudget(MemoryBudget.TILE_BUDGET),
+            "thumbnails": MemoryBudget.MemoryBudget(MemoryBudget.THUMBNAIL_BUDGET),
+            "pictures": MemoryBudget.MemoryBudget(MemoryBudget.PICTURE_CACHE_BUDGET),
+        }
+        self.image_loader = ImageLoader.ImageLoader(self.memory_budgets["pictures"], self)
+        self.image_loader.imageLoadedSignal.connect(self.picture_loaded)
+        self.loading_picture_canvas = {}  # 読み込み中の画像の番号と読み込み先のレイヤ
         self.pen_color = ColorDialogWithKnee()
         self.pen_color.updateSignal.connect(self.set_pen_color)
+        self.journal = None
+        self.journal_color = None  # 最後に記録した色
+        self.input_recorder = None
+        self.is_updating_sliders = False  # set_pen_color がスライダを動かしている間は入力として記録しない
         self.setupUi()
         self.show()
 
         self.active_canvas = 0  # 操作レイヤの制御
+        self.layer_scrubber = LayerScrubber.LayerScrubber(len(self.canvas))
         self.is_enabled_knee_control = False
         self.is_mode_switched = False
+        self.is_knee_lifted = False  # 膝を上げている間は膝の値で操作しない
+        # 1回の上げ下ろしでは、上げた時のモードのジェスチャで1回だけ切り替える（上げていない間も True）
+        self.knee_lift_mode = OperationMode.NONE
+        self.is_switched_in_lift = True
         self.current_drawing_mode = OperationMode.DRAWING_POINTS
 
         self.current_color_saturation = 127
@@ -500,6 +1019,10 @@ class MainWindow(QMainWindow):
         self.is_fixed_knee_value = False
         self.picked_color = QColor()
 
+        # 全てのレイヤで共通の表示範囲
+        self.view_scale = 1.0
+        self.view_origin = QPointF(0, 0)
+
         # self.timerThread = QThread()
 
         # 実験記録関連の変数
@@ -515,17 +1038,62 @@ class MainWindow(QMainWindow):
         operation_menu.addAction(start_experiment_action)
         operation_menu.addAction(save_records_action)
 
-        try:
-            self.timer_thread = KneePosition.TimerThread()
-            self.timer_thread.updateSignal.connect(self.control_params_with_knee)
-            self.timer_thread.start()
-            self.kneePosition = self.timer_thread.kneePosition
-            self.is_enabled_knee_control = True
-            self.experiment_controller.is_enabled_knee_control = True
-            self.current_knee_operation_mode = OperationMode.DRAWING_POINTS
+        export_vector_action = QAction("SVG/PDFに書き出し", self)
+        export_vector_action.setShortcut(QKeySequence("Ctrl+E"))
+        export_vector_action.triggered.connect(self.export_vector)
+
+        self.record_input_action = QAction("入力を記録", self)
+        self.record_input_action.setShortcut(QKeySequence("Ctrl+R"))
+        self.record_input_action.setCheckable(True)
+        self.record_input_action.triggered.connect(self.switch_input_recording)
+        operation_menu.addAction(self.record_input_action)
+
+        file_menu = self.menubar.addMenu("file")
+        file_menu.addAction(export_vector_action)
+
+        move_canvas_up_action = QAction("レイヤを上へ", self)
+        move_canvas_up_action.setShortcut(QKeySequence("Ctrl+]"))
+        move_canvas_up_action.triggered.connect(self.move_canvas_up)
+
+        move_canvas_down_action = QAction("レイヤを下へ", self)
+        move_canvas_down_action.setShortcut(QKeySequence("Ctrl+["))
+        move_canvas_down_action.triggered.connect(self.move_canvas_down)
 
-        except serial.serialutil.SerialException as e:
-            self.statusbar.showMessage("膝操作が無効：シリアル通信が確保できていません。原因：" + str(e))
+        layer_menu = self.menubar.addMenu("layer")
+        layer_menu.addAction(move_canvas_up_action)
+        layer_menu.addAction(move_canvas_down_action)
+
+        memory_usage_action = QAction("メモリ使用量", self)
+        memory_usage_action.setShortcut(QKeySequence("Ctrl+M"))
+        memory_usage_action.triggered.connect(self.show_memory_usage)
+        layer_menu.addAction(memory_usage_action)
+
+        # センサの接続とキャリブレーションは TimerThread の中で行う
+        if is_acquiring_in_process:
+            self.timer_thread = SensorProcess.SensorProcess(parent=self)
+        else:
+            self.timer_thread = KneePosition.TimerThread()
+        self.timer_thread.updateSignal.connect(self.control_params_with_knee)
+        self.timer_thread.calibrationProgressSignal.connect(self.knee_calibration_progressed)
+        self.timer_thread.calibrationFinishedSignal.connect(self.knee_calibration_finished)
+        self.timer_thread.deviceConnectedSignal.connect(self.knee_device_connected)
+        self.timer_thread.deviceDisconnectedSignal.connect(self.knee_device_disconnected)
+        self.timer_thread.legPresenceSignal.connect(self.knee_leg_presence_changed)
+        self.timer_thread.gestureSignal.connect(self.knee_gesture_detected)
+        self.timer_thread.set_gesture_params(**KNEE_GESTURE_PARAMS.get(self.current_knee_operation_mode, {}))
+        self.kneePosition = self.timer_thread.kneePosition
+        self.timer_thread.start()
+        self.statusbar.showMessage("膝操作が無効：センサを探しています")
+
+        # 操作の記録。前回のセッションが正常に終わっていなければ復元して、同じファイルに続けて書く
+        if is_journaling:
+            journal_path = SessionJournal.find_unfinished_journal()
+            if journal_path is not None:
+                self.replay_journal(journal_path)
+                self.statusbar.showMessage("前回のセッションを復元しました: {}".format(journal_path))
+            else:
+                journal_path = SessionJournal.make_journal_path()
+            self.set_journal(SessionJournal.SessionJournal(journal_path))
 
         self.canvas[0].set_enable_knee_control(self.is_enabled_knee_control)
         self.displayKneeOperationModeTextLabel.setText("Knee mode: \n {}".format(self.current_knee_operation_mode))
@@ -595,6 +1163,7 @@ class MainWindow(QMainWindow):
         self.hueSlider.setObjectName("hueSlider")
         self.hueSlider.setRange(0, 360)
         self.hueSlider.valueChanged.connect(self.pen_color.hue_changed)
+        self.hueSlider.valueChanged.connect(lambda value: self.slider_changed("hue", value))
         self.hueSlider.setTracking(True)
         self.verticalLayout.addWidget(self.hueSlider)
 
@@ -608,6 +1177,7 @@ class MainWindow(QMainWindow):
         self.saturationSlider.setRange(0, 255)
         self.saturationSlider.setValue(255)
         self.saturationSlider.valueChanged.connect(self.pen_color.saturation_changed)
+        self.saturationSlider.valueChanged.connect(lambda value: self.slider_changed("saturation", value))
         self.saturationSlider.setTracking(True)
         self.verticalLayout.addWidget(self.saturationSlider)
 
@@ -619,20 +1189,38 @@ class MainWindow(QMainWindow):
         self.valueSlider.setOrientation(Qt.Horizontal)
         self.valueSlider.setObjectName("valueSlider")
         self.valueSlider.valueChanged.connect(self.pen_color.value_changed)
+        self.valueSlider.valueChanged.connect(lambda value: self.slider_changed("value", value))
         self.valueSlider.setRange(0, 255)
         self.valueSlider.setTracking(True)
         self.verticalLayout.addWidget(self.valueSlider)
 
         self.canvas = []
-        self.canvas.append(Canvas(self.centralwidget))
-        self.canvas[0].setGeometry(QRect(0, 0, 600, 600))
+        self.canvas.append(Canvas(self.centralwidget, self.memory_budgets["tiles"]))
+        self.canvas[0].setGeometry(CANVAS_VIEW_RECT)
         self.canvas[0].setObjectName("canvas0")
         palette = self.canvas[0].palette()
         palette.setColor(QPalette.Background, QColor(255, 255, 255, 0))
         self.canvas[0].setPalette(palette)
         self.canvas[0].setAutoFillBackground(True)
         self.canvas[0].experiment_controller = self.experiment_controller
+        self.canvas[0].layer_index = 0
         self.active_canvas = 0
+        self.next_canvas_number = 1  # レイヤ名の番号（行番号は挿入・削除で変わるので別に数える）
+
+        # 膝でレイヤを選ぶ時に、キャンバスの下端に重ねて表示するサムネイルの列
+        self.thumbnail_cache = LayerScrubber.ThumbnailCache(DOCUMENT_SIZE, budget=self.memory_budgets["thumbnails"],
+                                                            parent=self)
+        self.thumbnail_cache.watch(self.canvas[0])
+        self.layerStrip = LayerScrubber.LayerStrip(self.thumbnail_cache, self.centralwidget)
+        self.layerStrip.setGeometry(QRect(0, CANVAS_VIEW_RECT.bottom() + 1 - 60, CANVAS_VIEW_RECT.width(), 60))
+        self.layerStrip.setObjectName("layerStrip")
+        self.layerStrip.hide()
+
+        # 膝で色を選ぶ時に、キャンバスの下端に重ねて表示する色相×明度の平面
+        self.colorField = ColorField.ColorFieldWidget(parent=self.centralwidget)
+        self.colorField.setGeometry(QRect(0, CANVAS_VIEW_RECT.bottom() + 1 - 120, CANVAS_VIEW_RECT.width(), 120))
+        self.colorField.setObjectName("colorField")
+        self.colorField.hide()
 
         self.setCentralWidget(self.centralwidget)
         self.menubar = QMenuBar(self)
@@ -664,16 +1252,19 @@ class MainWindow(QMainWindow):
 
     def display_statusbar(self):
         self.statusbar.showMessage("現在のレイヤ: {}　膝モード: {}　マウスモード: {}"
-                                   .format(self.canvasNameTableModel.canvas_name[self.active_canvas],
+                                   .format(self.canvasNameTableModel.get_name(self.active_canvas),
                                            self.current_knee_operation_mode.name,
                                            self.current_drawing_mode.name))
 
     # -- レイヤ（canvas）に対する操作 --
-    def add_canvas(self):
-        new_canvas = Canvas(self.centralwidget)
-        new_canvas.setGeometry(QRect(0, 0, 600, 600))
+    # 操作レイヤより上のレイヤは切り替えた時に隠す。切り替えでは前と新しい操作レイヤ（と、下へ切り替えた時に
+    # 間にあるレイヤ）だけを変え、レイヤの数によらない時間で済ませる
+    def create_canvas(self):
+        new_canvas = Canvas(self.centralwidget, self.memory_budgets["tiles"])
+        new_canvas.setGeometry(CANVAS_VIEW_RECT)
         new_canvas.setObjectName("canvas")
         new_canvas.mainWindow = self
+        new_canvas.set_view(self.view_scale, self.view_origin)
         palette = new_canvas.palette()
         palette.setColor(QPalette.Background, QColor(255, 255, 255, 0))
         new_canvas.setPalette(palette)
@@ -682,139 +1273,211 @@ class MainWindow(QMainWindow):
         new_canvas.experiment_controller = self.experiment_controller
         new_canvas.operation_mode_changed(self.current_drawing_mode, self.current_knee_operation_mode)
         new_canvas.current_line_color = self.picked_color
+        new_canvas.journal = self.journal
+        new_canvas.input_recorder = self.input_recorder
+        new_canvas.setEnabled(False)
+        self.thumbnail_cache.watch(new_canvas)
+        return new_canvas
 
-        self.canvas.append(new_canvas)
-        self.active_canvas = len(self.canvas) - 1
-
+    def update_layer_indexes(self, start: int, stop=None):
+        # 行が動いたレイヤだけ番号を振り直す（ジャーナルには番号で記録するため）
+        for i in range(start, len(self.canvas) if stop is None else stop):
+            self.canvas[i].layer_index = i
 
-        canvas_name = 'canvas[' + str(self.active_canvas) + ']'
-        self.canvasNameTableModel.add_canvas(canvas_name)
-        self.canvasTableView.setCurrentIndex(self.canvasNameTableModel.index(self.active_canvas, 0))
-        self.canvasNameTableModel.layoutChanged.emit()
+    def add_canvas(self):
+        # 操作レイヤのすぐ上に追加する
+        self.record_input("ui", slot="add_canvas")
+        self.insert_canvas(self.active_canvas + 1)
+
+    def insert_canvas(self, row: int):
+        new_canvas = self.create_canvas()
+        if row < len(self.canvas):
+            new_canvas.stackUnder(self.canvas[row])  # 重なり順も表の順に合わせる
+        self.canvas.insert(row, new_canvas)
+        self.update_layer_indexes(row)
+        if row <= self.active_canvas:
+            self.active_canvas += 1
+        self.record_operation("add_layer", layer=row)
+
+        self.canvasNameTableModel.insert_layer(row, 'canvas[' + str(self.next_canvas_number) + ']')
+        self.next_canvas_number += 1
+        self.set_active_canvas(row)
+        self.refresh_layer_strip()
         self.display_statusbar()
 
-        # 使用するレイヤだけ使用可能にする
-        for canvas in self.canvas:
-            canvas.setEnabled(False)
-        self.canvas[self.active_canvas].setEnabled(True)
-
     def delete_canvas(self):
+        # 操作レイヤを削除する
+        self.record_input("ui", slot="delete_canvas")
         if len(self.canvas) > 1:
-            if self.active_canvas == len(self.canvas) - 1:
-                self.active_canvas -= 1
-
-            deleted_canvas = self.canvas.pop()
-            self.canvasNameTableModel.delete_last_canvas()
-            self.canvasTableView.setCurrentIndex(self.canvasNameTableModel.index(self.active_canvas, 0))
-            self.canvasNameTableModel.layoutChanged.emit()
-
-            for i in range(len(deleted_canvas.existing_paths)):
-                deleted_canvas.existing_paths.pop()
-
-            deleted_canvas.hide()
-            # 使用するレイヤだけ使用可能にする
-            for canvas in self.canvas:
-                canvas.setEnabled(False)
+            self.remove_canvas(self.active_canvas)
+
+    def remove_canvas(self, row: int):
+        deleted_canvas = self.canvas.pop(row)
+        self.update_layer_indexes(row)
+        self.record_operation("delete_layer", layer=row)
+        self.canvasNameTableModel.remove_layer(row)
+
+        self.thumbnail_cache.remove(deleted_canvas)
+        deleted_canvas.dispose()
+
+        if row < self.active_canvas:
+            self.active_canvas -= 1
+        elif row == self.active_canvas:
+            # 下のレイヤを操作レイヤにする（その上のレイヤはすでに隠れている）
+            self.active_canvas = max(0, row - 1)
             self.canvas[self.active_canvas].setEnabled(True)
+            self.set_layer_visible(self.active_canvas, True)
+        self.canvasNameTableModel.set_active_row(self.active_canvas)
+        self.canvasTableView.setCurrentIndex(self.canvasNameTableModel.index(self.active_canvas, 0))
+        self.refresh_layer_strip()
+        self.display_statusbar()
+
+    def move_canvas_up(self):
+        self.record_input("ui", slot="move_canvas_up")
+        if self.active_canvas + 1 < len(self.canvas):
+            self.move_canvas(self.active_canvas, self.active_canvas + 1)
+
+    def move_canvas_down(self):
+        self.record_input("ui", slot="move_canvas_down")
+        if self.active_canvas > 0:
+            self.move_canvas(self.active_canvas, self.active_canvas - 1)
+
+    def move_canvas(self, row: int, to_row: int):
+        if row == to_row:
+            return
+        active_canvas = self.canvas[self.active_canvas]
+        moved_canvas = self.canvas.pop(row)
+        self.canvas.insert(to_row, moved_canvas)
+        if to_row + 1 < len(self.canvas):
+            moved_canvas.stackUnder(self.canvas[to_row + 1])
+        else:
+            moved_canvas.raise_()
+        self.update_layer_indexes(min(row, to_row), max(row, to_row) + 1)
+        self.record_operation("move_layer", layer=row, to=to_row)
+        self.canvasNameTableModel.move_layer(row, to_row)
+
+        # 操作レイヤとの上下が入れ替わったレイヤの表示を合わせる
+        self.active_canvas = active_canvas.layer_index
+        for i in range(min(row, to_row), max(row, to_row) + 1):
+            if i > self.active_canvas:
+                self.set_layer_visible(i, False)
+        self.canvasNameTableModel.set_active_row(self.active_canvas)
+        self.canvasTableView.setCurrentIndex(self.canvasNameTableModel.index(self.active_canvas, 0))
+        self.refresh_layer_strip()
 
     def table_item_clicked(self, index_clicked: QModelIndex):
         col = index_clicked.column()
         row = index_clicked.row()
+        self.record_input("ui", slot="table_item_clicked", row=row, column=col)
 
         if col == 0:
             self.switch_canvas_from_table(row)
         elif col == 1:
             # if row <= self.active_canvas:
-            origin_state = self.canvasNameTableModel.is_visible[row]
-            is_visible = self.canvasNameTableModel.set_canvas_visible(row, not origin_state)
-            # self.canvas[row].switch_visible(is_visible)
-            self.canvas[row].setVisible(is_visible)
+            origin_state = self.canvasNameTableModel.is_visible(row)
+            self.set_canvas_visible(row, not origin_state)
 
-        self.canvasNameTableModel.layoutChanged.emit()
+    def set_layer_visible(self, row: int, to: bool):
+        self.canvasNameTableModel.set_canvas_visible(row, to)
+        self.canvas[row].setVisible(to)
 
-    def switch_canvas_from_table(self, switch_to: int):
-        self.active_canvas = switch_to
+    def set_canvas_visible(self, row: int, to: bool):
+        self.set_layer_visible(row, to)
+        self.record_operation("visible", layer=row, is_visible=to)
+
+    def set_active_canvas(self, index: int):
+        previous = self.active_canvas
+        self.active_canvas = index
+        self.canvasTableView.setCurrentIndex(self.canvasNameTableModel.index(index, 0))
 
-        self.canvasTableView.setCurrentIndex(self.canvasNameTableModel.index(self.active_canvas, 0))
         # 使用するレイヤだけ使用可能にする
-        for canvas in self.canvas:
-            canvas.setEnabled(False)
-        self.canvas[self.active_canvas].setEnabled(True)
+        if previous != index and previous < len(self.canvas):
+            self.canvas[previous].setEnabled(False)
+        self.canvas[index].setEnabled(True)
+
+        # 選択したレイヤより上のレイヤは見えないようにする（前の操作レイヤより上はすでに隠れている）
+        for i in range(index + 1, min(previous, len(self.canvas) - 1) + 1):
+            self.set_layer_visible(i, False)
+
+        # 選択したレイヤは表示する
+        self.set_layer_visible(index, True)
+        self.canvasNameTableModel.set_active_row(index)
+        self.layerStrip.active_layer = index
+        self.layerStrip.update()
+
+    def switch_canvas_from_table(self, switch_to: int):
+        self.record_operation("switch_layer", layer=switch_to, source="table")
+        self.set_active_canvas(switch_to)
         self.canvas[self.active_canvas].operation_mode_changed(self.current_drawing_mode,
                                                                self.current_knee_operation_mode)
         self.canvas[self.active_canvas].current_line_color = self.picked_color
+        self.display_statusbar()
 
-        # 全てのレイヤに現在の表示状況を反映する
-        visible_states = self.canvasNameTableModel.is_visible
-        for i in range(0, self.active_canvas + 1):
-            self.canvas[i].setVisible(visible_states[i])
-
-        # 選択したレイヤは表示する
-        self.canvas[i].setVisible(True)
-        self.canvasNameTableModel.set_canvas_visible(i, True)
+    # 膝でのレイヤの選択。指すレイヤはサムネイルの枠だけを動かし、留まった時か膝モードを抜けた時に切り替える
+    def begin_layer_scrubbing(self):
+        self.layer_scrubber.reset(len(self.canvas), self.active_canvas)
+        self.layerStrip.set_layers(self.canvas, self.active_canvas)
+        self.layerStrip.raise_()
+        self.layerStrip.show()
 
-        # 選択したレイヤより上のレイヤは見えないようにする
-        for i in range(self.active_canvas + 1, len(self.canvas)):
-            self.canvas[i].setVisible(False)
-            self.canvasNameTableModel.set_canvas_visible(i, False)
-        self.canvasNameTableModel.layoutChanged.emit()
+    def end_layer_scrubbing(self):
+        self.layerStrip.hide()
+        target_number = self.layer_scrubber.release(self.active_canvas)
+        if target_number is not None:
+            self.switch_canvas_from_index(target_number)
 
-        self.display_statusbar()
+    def refresh_layer_strip(self):
+        # 選んでいる間にレイヤが増減・移動したら選び直す
+        if not self.layerStrip.isHidden():
+            self.begin_layer_scrubbing()
 
     def switch_canvas_from_index(self, index: int):
-        self.active_canvas = index
-
-        self.canvasTableView.setCurrentIndex(self.canvasNameTableModel.index(self.active_canvas, 0))
-        # 使用するレイヤだけ使用可能にする
-        for canvas in self.canvas:
-            canvas.setEnabled(False)
-        self.canvas[self.active_canvas].setEnabled(True)
+        self.record_operation("switch_layer", layer=index, source="knee")
+        self.set_active_canvas(index)
         self.canvas[self.active_canvas].operation_mode_changed(self.current_knee_operation_mode,
                                                                self.current_knee_operation_mode)
         self.canvas[self.active_canvas].current_line_color = self.picked_color
-
-        # 選択したレイヤより下のレイヤは現在の表示状況を反映する
-        visible_states = self.canvasNameTableModel.is_visible
-        for i in range(0, self.active_canvas + 1):
-            self.canvas[i].setVisible(visible_states[i])
-
-        # 選択したレイヤは表示する
-        self.canvas[i].setVisible(True)
-        self.canvasNameTableModel.set_canvas_visible(i, True)
-
-        # 選択したレイヤより上のレイヤは見えないようにする
-        for i in range(self.active_canvas + 1, len(self.canvas)):
-            self.canvas[i].setVisible(False)
-            self.canvasNameTableModel.set_canvas_visible(i, False)
-        self.canvasNameTableModel.layoutChanged.emit()
-
         self.display_statusbar()
 
+    # -- メモリ使用量 --
+    def get_memory_usage(self):
+        # レイヤごとの使用量（名前, {種類: byte}）と、レイヤによらない使用量を返す
+        layers = []
+        for i, canvas in enumerate(self.canvas):
+            usage = canvas.get_memory_usage()
+            usage["thumbnail"] = self.thumbnail_cache.get_memory_usage(canvas)
+            layers.append((self.canvasNameTableModel.get_name(i), usage))
+        num_of_values = len(self.experiment_controller.frame_records) * 10
+        session = {
+            "frame_records": num_of_values * MemoryBudget.RECORD_VALUE_BYTES,
+            "picture_cache": self.image_loader.get_memory_usage(),
+        }
+        return layers, session
+
+    def show_memory_usage(self):
+        layers, session = self.get_memory_usage()
+        lines = ["{}: ".format(name) + ", ".join("{} {}".format(kind, MemoryBudget.format_bytes(num_of_bytes))
+                                                 for kind, num_of_bytes in usage.items())
+                 for name, usage in layers + [("session", session)]]
+        total = sum(sum(usage.values()) for _, usage in layers) + sum(session.values())
+        summary = "メモリ使用量: {}（{}レイヤ）　キャッシュ: ".format(MemoryBudget.format_bytes(total), len(layers)) + \
+                  "　".join("{} {}/{}".format(name, MemoryBudget.format_bytes(budget.used_bytes),
+                                              MemoryBudget.format_bytes(budget.budget))
+                           for name, budget in self.memory_budgets.items())
+        self.statusbar.showMessage(summary)
+        QMessageBox.information(self, "メモリ使用量", summary + "\n\n" + "\n".join(lines))
+
     # -- 絵のセーブとロード --
     def save_all_picture(self):
-        origin_visible_states = self.canvasNameTableModel.is_visible
-        origin_active_canvas = self.active_canvas
-
-        picture = QPixmap()
+        # 表示範囲に関係なく、各レイヤのドキュメント全体を等倍で保存する
         for i in range(len(self.canvas)):
-            self.switch_canvas_from_index(i)  # レイヤを切り替え（上部のレイヤは見えない）
-            for j in range(i):
-                self.canvas[j].setVisible(False)  # キャプチャするレイヤより下のレイヤを非表示にする
-
-            picture = self.centralwidget.grab(QRect(0, 0, 600, 600))
+            picture = self.canvas[i].render_document_image()
             picture.save("result_paint_experiment/p{}/{}/canvas{}.png"
                          .format(participant_No,
                                  ("knee" if self.is_enabled_knee_control else "mouse"),
                                  i)
                          )
 
-        # 元の状態に戻す
-        self.switch_canvas_from_index(origin_active_canvas)
-
-        for i in range(origin_active_canvas):
-            is_visible = self.canvasNameTableModel.set_canvas_visible(i, origin_visible_states[i])
-            self.canvas[i].setVisible(origin_visible_states[i])
-
     def save_all_points_and_paths(self):
         points_record_file = open('result_paint_experiment/p{}/{}/points_record.txt'
                                   .format(participant_No,
@@ -834,25 +1497,105 @@ class MainWindow(QMainWindow):
 
     def save_picture(self):
         picture = QPixmap()
-        picture = self.centralwidget.grab(QRect(0, 0, 600, 600))
+        picture = self.centralwidget.grab(CANVAS_VIEW_RECT)
         picture.save("test.png")
 
+    def export_vector(self):
+        file_name, _ = QFileDialog.getSaveFileName(self, "SVG/PDFに書き出し", "drawing.svg",
+                                                   "SVG (*.svg);;PDF (*.pdf)")
+        if not file_name:
+            return
+        layers = [(self.canvasNameTableModel.get_name(i), canvas.picture_file_name, canvas.iter_strokes())
+                  for i, canvas in enumerate(self.canvas)]
+        num_of_strokes = VectorExport.export_layers(file_name, layers, DOCUMENT_SIZE.width(), DOCUMENT_SIZE.height())
+        self.statusbar.showMessage("書き出しました（{}本）: {}".format(num_of_strokes, file_name))
+
     def file_read(self):
-        file_name = "sampleImages/1.png"
-        image = QImage(file_name)
-        self.canvas[self.active_canvas].load_picture(image)
+        file_name, _ = QFileDialog.getOpenFileName(self, "画像を読込む",
+                                                   self.readFileNametextEdit.toPlainText() or "sampleImages",
+                                                   "Images (*.png *.jpg *.jpeg *.bmp *.gif)")
+        if not file_name:
+            return
+        self.readFileNametextEdit.setPlainText(file_name)
+
+        self.record_input("picture", layer=self.active_canvas, file_name=file_name)
+        self.load_picture_file(self.active_canvas, file_name)
+
+    def load_picture_file(self, layer: int, file_name: str):
+        # デコードはワーカスレッドで行い、終わったら picture_loaded でレイヤに貼る
+        canvas = self.canvas[layer]
+        request_id = self.image_loader.load(file_name, DOCUMENT_SIZE)
+        self.loading_picture_canvas[request_id] = canvas
+        canvas.picture_file_name = file_name
+        self.record_operation("picture", layer=layer, file_name=file_name)
+        self.statusbar.showMessage("読込み中: {}".format(file_name))
+
+    def picture_loaded(self, request_id, image):
+        canvas = self.loading_picture_canvas.pop(request_id, None)
+        if canvas is None or canvas not in self.canvas:
+            return  # 読み込み中にレイヤが消された
+        if image.isNull():
+            self.statusbar.showMessage("画像を読込めませんでした: {}".format(canvas.picture_file_name))
+            return
+        canvas.load_picture(image)
+        self.display_statusbar()
+
+    # -- 表示範囲（拡大・スクロール） --
+    def wheelEvent(self, event: QWheelEvent):
+        # レイヤはホイールを使わないので、ここに届く
+        if self.input_recorder is not None:
+            self.input_recorder.record_wheel(event)
+        position = self.canvas[self.active_canvas].mapFrom(self, event.pos())
+        if not CANVAS_VIEW_RECT.contains(position):
+            event.ignore()
+            return
+
+        if event.modifiers() & Qt.ControlModifier:
+            # Ctrl + ホイールでカーソル位置を中心に拡大・縮小
+            steps = event.angleDelta().y() / 120
+            scale = self.view_scale * VIEW_SCALE_STEP ** steps
+            minimum_scale = max(MINIMUM_VIEW_SCALE, CANVAS_VIEW_RECT.width() / DOCUMENT_SIZE.width(),
+                                CANVAS_VIEW_RECT.height() / DOCUMENT_SIZE.height())
+            scale = min(max(scale, minimum_scale), MAXIMUM_VIEW_SCALE)
+            anchor = QPointF(self.view_origin.x() + position.x() / self.view_scale,
+                             self.view_origin.y() + position.y() / self.view_scale)
+            origin = QPointF(anchor.x() - position.x() / scale, anchor.y() - position.y() / scale)
+        else:
+            # ホイールでスクロール（Shift で横方向）
+            scale = self.view_scale
+            delta = event.angleDelta() if not event.modifiers() & Qt.ShiftModifier \
+                else QPoint(event.angleDelta().y(), event.angleDelta().x())
+            origin = QPointF(self.view_origin.x() - delta.x() / scale, self.view_origin.y() - delta.y() / scale)
+
+        self.set_view(scale, origin)
+        event.accept()
+
+    def set_view(self, scale: float, origin: QPointF):
+        # ドキュメントの外が見えないように表示範囲を制限する
+        maximum_x = max(0.0, DOCUMENT_SIZE.width() - CANVAS_VIEW_RECT.width() / scale)
+        maximum_y = max(0.0, DOCUMENT_SIZE.height() - CANVAS_VIEW_RECT.height() / scale)
+        self.view_scale = scale
+        self.view_origin = QPointF(min(max(origin.x(), 0.0), maximum_x), min(max(origin.y(), 0.0), maximum_y))
+        for canvas in self.canvas:
+            canvas.set_view(self.view_scale, self.view_origin)
 
     # -*- 色変更 -*-
     def set_pen_color(self, color):
         self.picked_color = color
         self.canvas[self.active_canvas].set_line_color(color)
+        hsv = (self.pen_color.hue, self.pen_color.saturation, self.pen_color.value)
+        if hsv != self.journal_color:
+            self.journal_color = hsv
+            self.record_operation("color", hue=hsv[0], saturation=hsv[1], value=hsv[2])
 
+        self.is_updating_sliders = True
         self.hueLabel.setText("Hue: {}".format(self.pen_color.hue))
         self.hueSlider.setSliderPosition(self.pen_color.hue)
         self.saturationLabel.setText("Saturation: {}".format(self.pen_color.saturation))
         self.saturationSlider.setSliderPosition(self.pen_color.saturation)
         self.valueLabel.setText("Brightness: {}".format(self.pen_color.value))
         self.valueSlider.setSliderPosition(self.pen_color.value)
+        self.is_updating_sliders = False
 
         color_string = "background-color: rgb({},{},{})".format(self.pen_color.color.red(),
                                                                 self.pen_color.color.green(),
@@ -862,10 +1605,17 @@ class MainWindow(QMainWindow):
 
     # -*- 操作モードの切り替え -*-
     def switch_drawing_mode(self):
+        self.record_input("ui", slot="switch_drawing_mode")
         if self.current_drawing_mode == OperationMode.DRAWING_POINTS:
             self.current_drawing_mode = OperationMode.MOVING_POINTS
 
         elif self.current_drawing_mode == OperationMode.MOVING_POINTS:
+            self.current_drawing_mode = OperationMode.SELECTING_STROKES
+
+        elif self.current_drawing_mode == OperationMode.SELECTING_STROKES:
+            self.current_drawing_mode = OperationMode.ERASING_STROKES
+
+        elif self.current_drawing_mode == OperationMode.ERASING_STROKES:
             self.current_drawing_mode = OperationMode.DRAWING_POINTS
         else:
             self.current_drawing_mode = OperationMode.NONE
@@ -880,11 +1630,7 @@ class MainWindow(QMainWindow):
             else:
                 self.current_knee_operation_mode = OperationMode.DRAWING_POINTS
 
-        self.canvas[self.active_canvas].operation_mode_changed(self.current_drawing_mode,
-                                                               self.current_knee_operation_mode)
-        self.selectOperationModeButton.setText("{}".format(self.current_drawing_mode.name))
-        self.displayKneeOperationModeTextLabel.setText("Knee mode: \n {}".format(self.current_knee_operation_mode))
-        self.display_statusbar()
+        self.apply_operation_mode(self.current_drawing_mode, self.current_knee_operation_mode)
 
     def switch_knee_operation_mode(self):
         if self.current_knee_operation_mode == OperationMode.NONE:
@@ -910,8 +1656,30 @@ class MainWindow(QMainWindow):
         else:
             self.current_knee_operation_mode = OperationMode.NONE
 
-        self.canvas[self.active_canvas].operation_mode_changed(self.current_drawing_mode,
-                                                               self.current_knee_operation_mode)
+        self.apply_operation_mode(self.current_drawing_mode, self.current_knee_operation_mode)
+
+    def apply_operation_mode(self, to_drawing: OperationMode, to_knee: OperationMode, is_keeping_stroke=False):
+        # is_keeping_stroke: 描画中の線を確定させない（描画のモードが変わらない時だけ使う）
+        if self.current_knee_operation_mode == OperationMode.SWITCH_LAYER and to_knee != OperationMode.SWITCH_LAYER:
+            self.end_layer_scrubbing()
+        elif self.current_knee_operation_mode != OperationMode.SWITCH_LAYER and to_knee == OperationMode.SWITCH_LAYER:
+            self.begin_layer_scrubbing()
+        if to_knee == OperationMode.COLOR_PICKER:
+            self.colorField.set_fixed(self.is_fixed_knee_value)
+            self.colorField.raise_()
+            self.colorField.show()
+        else:
+            self.colorField.hide()
+        if to_knee != self.current_knee_operation_mode:
+            self.timer_thread.set_gesture_params(**KNEE_GESTURE_PARAMS.get(to_knee, {}))
+        self.current_drawing_mode = to_drawing
+        self.current_knee_operation_mode = to_knee
+        self.record_operation("mode", drawing=to_drawing.name, knee=to_knee.name)
+        if is_keeping_stroke:
+            self.canvas[self.active_canvas].current_knee_operation_mode = self.current_knee_operation_mode
+        else:
+            self.canvas[self.active_canvas].operation_mode_changed(self.current_drawing_mode,
+                                                                   self.current_knee_operation_mode)
         self.selectOperationModeButton.setText("{}".format(self.current_drawing_mode.name))
         self.displayKneeOperationModeTextLabel.setText("Knee mode: \n {}".format(self.current_knee_operation_mode))
         self.display_statusbar()
@@ -919,44 +1687,222 @@ class MainWindow(QMainWindow):
     # -*- イベント処理（継承元のオーバーライド）-*-
     def keyPressEvent(self, keyEvent):
         # print(keyEvent.key())
+        if self.input_recorder is not None:
+            self.input_recorder.record_key("press", keyEvent)
         if keyEvent.key() == Qt.Key_Return:
             self.canvas[self.active_canvas].fix_path()
 
         if keyEvent.key() == Qt.Key_Backspace:
             self.canvas[self.active_canvas].delete_last_path()
 
+        if keyEvent.key() == Qt.Key_Delete:
+            self.canvas[self.active_canvas].delete_selected_stroke()
+
         if keyEvent.key() == Qt.Key_Shift:
+            # 膝で色を選んでいる時は、Shift を押した時のカーソルの色をペンの色にする
+            if not self.is_fixed_knee_value and self.current_knee_operation_mode == OperationMode.COLOR_PICKER:
+                self.pen_color.color_changed(self.colorField.get_color())
             self.is_fixed_knee_value = True
-
+            self.colorField.set_fixed(True)
 
     def keyReleaseEvent(self, keyEvent):
+        if self.input_recorder is not None:
+            self.input_recorder.record_key("release", keyEvent)
         if keyEvent.key() == Qt.Key_Shift:
             self.is_fixed_knee_value = False
+            self.colorField.set_fixed(False)
+
+    def closeEvent(self, event):
+        self.timer_thread.stop()
+        if self.input_recorder is not None:
+            self.switch_input_recording()
+        if self.journal is not None:
+            self.journal.close()
+        super().closeEvent(event)
+
+    # -*- 操作の記録と復元 -*-
+    def set_journal(self, journal):
+        self.journal = journal
+        self.experiment_controller.journal = journal
+        for canvas in self.canvas:
+            canvas.journal = journal
+
+    def record_operation(self, op: str, **data):
+        if self.journal is not None:
+            self.journal.append(op, **data)
+
+    # 入力（マウス・キー・膝など）の記録。再生は InputRecorder.py で行う
+    def record_input(self, kind: str, **data):
+        if self.input_recorder is not None:
+            self.input_recorder.record(kind, **data)
+
+    def slider_changed(self, name: str, value: int):
+        if not self.is_updating_sliders:
+            self.record_input("slider", name=name, value=value)
+
+    def switch_input_recording(self):
+        if self.input_recorder is None:
+            date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            file_path = self.experiment_controller.make_result_dir() + "input_{}.jsonl".format(date)
+            self.input_recorder = InputRecorder.InputRecorder(file_path, self)
+            self.experiment_controller.clock = self.input_recorder.get_time
+            self.statusbar.showMessage("入力の記録を開始しました: {}".format(file_path))
+        else:
+            self.input_recorder.close(self)
+            self.statusbar.showMessage("入力の記録を終了しました: {}".format(self.input_recorder.file_path))
+            self.input_recorder = None
+            self.experiment_controller.clock = Timing.now_ns
+        for canvas in self.canvas:
+            canvas.input_recorder = self.input_recorder
+        self.record_input_action.setChecked(self.input_recorder is not None)
+
+    def replay_journal(self, journal_path: str):
+        # 記録を取らずに操作をやり直す（self.journal はまだ None）
+        frames = []
+        experiment = None
+        for operation in SessionJournal.read_journal(journal_path):
+            op = operation["op"]
+            if op == "stroke":
+                self.canvas[operation["layer"]].replay_stroke(operation["points"], operation["color"])
+            elif op == "move_point":
+                self.canvas[operation["layer"]].replay_move_point(operation["stroke"], operation["element"],
+                                                                  operation["x"], operation["y"])
+            elif op == "delete_stroke":
+                self.canvas[operation["layer"]].replay_delete_stroke(operation["stroke"])
+            elif op == "add_layer":
+                self.insert_canvas(operation["layer"])
+            elif op == "delete_layer":
+                self.remove_canvas(operation["layer"])
+            elif op == "move_layer":
+                self.move_canvas(operation["layer"], operation["to"])
+            elif op == "switch_layer":
+                if operation["source"] == "table":
+                    self.switch_canvas_from_table(operation["layer"])
+                else:
+                    self.switch_canvas_from_index(operation["layer"])
+            elif op == "visible":
+                self.set_canvas_visible(operation["layer"], operation["is_visible"])
+            elif op == "color":
+                self.pen_color.hue = operation["hue"]
+                self.pen_color.saturation = operation["saturation"]
+                self.pen_color.value = operation["value"]
+                self.pen_color.color.setHsv(operation["hue"], operation["saturation"], operation["value"], 255)
+                self.set_pen_color(self.pen_color.color)
+            elif op == "mode":
+                self.apply_operation_mode(OperationMode[operation["drawing"]], OperationMode[operation["knee"]])
+            elif op == "picture":
+                self.load_picture_file(operation["layer"], operation["file_name"])
+            elif op == "experiment_start":
+                experiment = operation
+            elif op == "frame":
+                frames.append(operation["values"])
+            elif op == "experiment_saved":
+                experiment = None
+
+        if experiment is not None:
+            # 落ちてから今までの時間も計測中として数える
+            start_time = Timing.now_ns() - int((time.time() - experiment["wall_time"]) * 1e9)
+            self.experiment_controller.restore_experiment(frames, start_time, experiment["knee"],
+                                                          experiment["filter"])
+        else:
+            self.experiment_controller.restore_experiment(frames)
 
     # -*- 実験を記録する関係 -*-
     def start_experiment(self):
+        self.record_input("action", name="start_experiment")
         self.experiment_controller.start_experiment()
+        if self.is_enabled_knee_control and is_recording_raw_sensor:
+            date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            file_path = self.experiment_controller.make_result_dir()
+            self.timer_thread.start_raw_logging(file_path + "raw_sensor_{}.bin".format(date))
+
         self.statusbar.showMessage("Experiment started p{}"
                                    .format(participant_No)
                                    )
 
     def save_picture_and_experiment(self):
+        self.record_input("action", name="save_picture_and_experiment")
         if self.experiment_controller.is_started_experiment:
             self.experiment_controller.is_started_experiment = False
+            if self.is_enabled_knee_control:
+                self.timer_thread.stop_raw_logging()
             self.experiment_controller.save_records()  # save系統の処理で一番最初に来るように（保存パスが作られるため）
             self.save_all_points_and_paths()
+            self.record_operation("experiment_saved")
 
         self.save_all_picture()
 
+    # -*- 膝操作の有効化 -*-
+    def knee_device_connected(self, port):
+        self.statusbar.showMessage("センサに接続しました: {}".format(port))
+
+    def knee_device_disconnected(self, reason):
+        self.is_knee_lifted = False
+        self.is_switched_in_lift = True
+        self.statusbar.showMessage("膝操作が無効：シリアル通信が切断されました。再接続を待っています。原因：" + reason)
+
+    def knee_leg_presence_changed(self, is_present):
+        self.is_knee_lifted = False
+        self.is_switched_in_lift = True
+        if is_present:
+            self.statusbar.showMessage("膝を検出しました")
+        else:
+            self.statusbar.showMessage("膝がセンサから離れました（膝操作は止まっています）")
+
+    def knee_calibration_progressed(self, frame, total_frames):
+        self.statusbar.showMessage("膝のキャリブレーション中（マウスは操作可能）: {}/{}".format(frame, total_frames))
+
+    def knee_calibration_finished(self, x, y):
+        # キャリブレーションが終わったら膝操作を有効にする
+        self.record_input("knee_enabled", x=x, y=y)
+        self.is_enabled_knee_control = True
+        self.experiment_controller.is_enabled_knee_control = True
+        self.experiment_controller.knee_filter_description = self.kneePosition.position_filter.describe()
+        for canvas in self.canvas:
+            canvas.set_enable_knee_control(self.is_enabled_knee_control)
+        # switch_drawing_mode と同じく、膝で操作できない描画のモードの時は DRAWING_POINTS にする
+        if self.current_drawing_mode == OperationMode.MOVING_POINTS:
+            to_knee = OperationMode.MOVING_POINTS
+        else:
+            to_knee = OperationMode.DRAWING_POINTS
+        self.apply_operation_mode(self.current_drawing_mode, to_knee, is_keeping_stroke=True)  # 描画中の線は確定させない
+        self.statusbar.showMessage("膝操作が有効になりました（x: {:.2f}, y: {:.2f}）".format(x, y))
+
     # -*- 膝操作の操作振り分け -*-
-    def control_params_with_knee(self, x, y):
+    def knee_gesture_detected(self, gesture: str, timestamp_ns, latency_ns):
+        # timestamp_ns: 判定したフレームのセンサの値を読んだ時刻, latency_ns: 動き始めてから判定するまでの時間
+        self.record_input("knee_gesture", gesture=gesture, timestamp_ns=timestamp_ns, latency_ns=latency_ns)
+        if not self.is_enabled_knee_control:
+            return
+        gesture = KneeGesture.GestureType[gesture]
+        if gesture == KneeGesture.GestureType.LIFT_OFF:
+            self.is_knee_lifted = True
+            self.knee_lift_mode = self.current_knee_operation_mode
+            self.is_switched_in_lift = False
+        elif gesture in (KneeGesture.GestureType.TAP, KneeGesture.GestureType.RELEASE):
+            self.is_knee_lifted = False
+
+        # 切り替えた後のモードのジェスチャ（LIFT_OFF の後の TAP など）でもう一度切り替えないように
+        if not self.is_switched_in_lift and \
+                gesture == KNEE_SWITCH_GESTURES.get(self.knee_lift_mode, KneeGesture.GestureType.LIFT_OFF):
+            self.is_switched_in_lift = True
+            self.switch_knee_operation_mode()
+            self.statusbar.showMessage("switch: {}（判定の遅れ {:.0f} ms）".format(gesture.name, latency_ns / 1e6))
+
+    def control_params_with_knee(self, x, y, timestamp_ns=None):
+        # timestamp_ns: センサの値を読んだ時刻（TimerThread のスレッドで Timing.now_ns で取ったもの）
+        self.record_input("knee", x=x, y=y, timestamp_ns=timestamp_ns)
         self.experiment_controller.current_knee_position = QPointF(x, y)
-        self.experiment_controller.record_frame(self.current_drawing_mode, self.current_knee_operation_mode)
+        self.experiment_controller.record_frame(self.current_drawing_mode, self.current_knee_operation_mode,
+                                                timestamp_ns)
         if y == 0:
+            # 以前の記録（膝を上げると y が 0 になっていた）を再生する時用
             if not self.is_mode_switched:
                 self.statusbar.showMessage("switch")
                 self.switch_knee_operation_mode()
                 self.is_mode_switched = True
+        elif self.is_knee_lifted:
+            pass
         else:
             if self.current_knee_operation_mode == OperationMode.NONE:
                 pass
@@ -976,8 +1922,13 @@ class MainWindow(QMainWindow):
                 if not self.is_fixed_knee_value:
                     self.fixed_knee_value = QPointF(x, y)
 
-                target_number = (int)(self.fixed_knee_value.x() / (360 / self.canvasNameTableModel.rowCount()))
-                if not self.active_canvas == target_number:
+                if timestamp_ns is None:
+                    timestamp_ns = self.experiment_controller.clock()
+                is_highlight_changed, target_number = \
+                    self.layer_scrubber.update(self.fixed_knee_value.x(), timestamp_ns, self.active_canvas)
+                if is_highlight_changed:
+                    self.layerStrip.set_highlighted_layer(self.layer_scrubber.highlighted_layer)
+                if target_number is not None:
                     self.switch_canvas_from_index(target_number)
 
 
@@ -985,10 +1936,9 @@ class MainWindow(QMainWindow):
                 x, _ = self.kneePosition.get_mapped_positions(x, y, 1, 359)
                 _, y = self.kneePosition.get_mapped_positions(x, y, 0, 255)
                 if not self.is_fixed_knee_value:
+                    # 値ごとにはカーソルだけを動かす（ペンの色は Shift を押した時に決める）
                     self.fixed_knee_value = QPointF(x, y)
-                    next_color = self.pen_color.color
-                    next_color.setHsv(self.fixed_knee_value.x(), 255, self.fixed_knee_value.y(), 255)
-                    self.pen_color.color_changed(next_color)
+                    self.colorField.set_cursor(int(x), int(y))
 
             else:
                 self.current_knee_operation_mode = OperationMode.NONE